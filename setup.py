@@ -40,7 +40,6 @@ setup(
         'bin/docserv-createconfig',
         'bin/docserv-build-navigation',
         'bin/docserv-dchash',
-        'bin/docserv-write-param-file',
     ],
     install_requires=[],
     data_files=[
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from docserv.repocache import directory_size
+from docserv.transfer import reflink
+
+logger = logging.getLogger('docserv')
+
+CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
+
+# Written into every stored artifact, contains the directory it was
+# built in, so paths in the d2d file list can be rewritten.
+META_FILE = '.docserv-artifact'
+
+
+def link_or_copy(source, destination):
+    """
+    Hard link a file, reflink or copy it if that is not possible (for
+    example across file systems).
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        try:
+            reflink(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+    return destination
+
+
+def copy_parts(source, destination, filelist):
+    """
+    Copy the files and directories in filelist (absolute paths inside
+    source) and the big files in source/.tmp to destination, and write
+    filelist as its d2d file list.
+    """
+    os.makedirs(destination)
+    tmp_dir = os.path.join(source, '.tmp')
+    bigfiles = [os.path.join(tmp_dir, name) for name in
+                (os.listdir(tmp_dir) if os.path.isdir(tmp_dir) else [])
+                if name.endswith('_bigfile.xml')]
+    for path in list(filelist) + bigfiles:
+        path = path.rstrip('/')
+        relative = os.path.relpath(path, source)
+        if relative.startswith('..') or not os.path.lexists(path):
+            continue
+        target = os.path.join(destination, relative)
+        if os.path.lexists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.copytree(path, target, symlinks=True, copy_function=link_or_copy)
+        else:
+            link_or_copy(path, target)
+    with open(os.path.join(destination, 'filelist'), 'w') as f:
+        f.write(''.join(line + '\n' for line in filelist))
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of d2d_runner output directories in
+    /var/cache/docserv/[SERVER_NAME]-artifacts/. Artifacts are keyed by
+    the fingerprint of all build inputs (see Deliverable.fingerprint()),
+    so a deliverable with the same inputs, for example the same document
+    for another target, or one that was built shortly before, can be
+    taken from the store instead of running a container.
+
+    When the store grows beyond max_size bytes, the least recently used
+    artifacts are removed.
+    """
+
+    def __init__(self, server_name, max_size):
+        self.path = os.path.join(CACHE_DIR, server_name + '-artifacts')
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # fingerprint -> size in bytes, least recently used first
+        self.artifacts = OrderedDict()
+        self.size = 0
+        self.statistics = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        self.load()
+
+    def load(self):
+        if not os.path.isdir(self.path):
+            return
+        found = []
+        for name in os.listdir(self.path):
+            artifact_dir = os.path.join(self.path, name)
+            if name.startswith('.'):
+                # incomplete or evicted artifact of an earlier run
+                shutil.rmtree(artifact_dir, ignore_errors=True)
+                continue
+            found.append((os.path.getmtime(artifact_dir), name, directory_size(artifact_dir)))
+        for _, fingerprint, size in sorted(found):
+            self.artifacts[fingerprint] = size
+            self.size += size
+
+    def artifact_dir(self, fingerprint):
+        return os.path.join(self.path, fingerprint)
+
+    def lookup(self, fingerprint, destination):
+        """
+        Copy (hard link) the artifact with this fingerprint into the
+        empty directory destination and rewrite the paths in its d2d file
+        list. Returns False if there is no such artifact.
+        """
+        with self.lock:
+            if fingerprint not in self.artifacts:
+                self.statistics['misses'] += 1
+                return False
+            self.artifacts.move_to_end(fingerprint)
+        artifact_dir = self.artifact_dir(fingerprint)
+        try:
+            with open(os.path.join(artifact_dir, META_FILE), 'r') as f:
+                built_in = json.load(f)['dir']
+            shutil.rmtree(destination, ignore_errors=True)
+            shutil.copytree(artifact_dir, destination, symlinks=True,
+                            copy_function=link_or_copy)
+            os.utime(artifact_dir)
+            filelist = os.path.join(destination, 'filelist')
+            with open(filelist, 'r') as f:
+                lines = f.read().replace(built_in, destination.rstrip('/'))
+            # The file list is a hard link to the stored one, replace it.
+            os.remove(filelist)
+            with open(filelist, 'w') as f:
+                f.write(lines)
+        except (OSError, ValueError, KeyError) as error:
+            # The artifact was evicted in the meantime or is broken.
+            logger.warning("Could not use artifact %s: %s", fingerprint, error)
+            shutil.rmtree(destination, ignore_errors=True)
+            os.makedirs(destination, exist_ok=True)
+            with self.lock:
+                self.statistics['misses'] += 1
+            return False
+        with self.lock:
+            self.statistics['hits'] += 1
+        return True
+
+    def store(self, fingerprint, source, filelist=None):
+        """
+        Add the d2d_runner output directory source to the store. If
+        several formats were built into source, filelist is the part of
+        the d2d file list that belongs to the artifact: only the paths
+        in it and the big files (needed for the titles) are stored.
+        """
+        with self.lock:
+            if fingerprint in self.artifacts:
+                return
+        os.makedirs(self.path, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='.new_', dir=self.path)
+        artifact_dir = os.path.join(tmp_dir, 'artifact')
+        try:
+            if filelist is None:
+                shutil.copytree(source, artifact_dir, symlinks=True,
+                                copy_function=link_or_copy)
+            else:
+                copy_parts(source, artifact_dir, filelist)
+            with open(os.path.join(artifact_dir, META_FILE), 'w') as f:
+                json.dump({'dir': source.rstrip('/'), 'stored': time.time()}, f)
+            size = directory_size(artifact_dir)
+            os.rename(artifact_dir, self.artifact_dir(fingerprint))
+        except OSError as error:
+            # Another thread stored the same artifact or the disk is full.
+            logger.warning("Could not store artifact %s: %s", fingerprint, error)
+            return
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        with self.lock:
+            self.artifacts[fingerprint] = size
+            self.size += size
+            self.statistics['stored'] += 1
+            evicted = self.evict()
+        for fingerprint in evicted:
+            # Rename first, so lookups fail cleanly while it is removed.
+            trash = tempfile.mkdtemp(prefix='.evicted_', dir=self.path)
+            try:
+                os.rename(self.artifact_dir(fingerprint), os.path.join(trash, 'artifact'))
+            except OSError:
+                pass
+            shutil.rmtree(trash, ignore_errors=True)
+
+    def evict(self):
+        """
+        Drop least recently used artifacts until the store fits into
+        max_size. Must be called with self.lock held. Returns the
+        fingerprints of the artifacts to remove.
+        """
+        evicted = []
+        while self.size > self.max_size and self.artifacts:
+            fingerprint, size = self.artifacts.popitem(last=False)
+            self.size -= size
+            self.statistics['evicted'] += 1
+            evicted.append(fingerprint)
+        return evicted
+
+    def dict(self):
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics['artifacts'] = len(self.artifacts)
+            statistics['size'] = self.size
+        return statistics
@@ -1,18 +1,23 @@
 import json
 import logging
 import os
-import random
-import shlex
 import shutil
-import string
-import subprocess
 import tempfile
 import threading
+import time
+from collections import OrderedDict
 from lxml import etree
 
 from docserv.deliverable import Deliverable
+from docserv.fingerprint import tree_hashes
+from docserv.generations import (collect_garbage, current_generation, generation_path,
+                                 new_generation)
 from docserv.functions import feedback_message, resource_to_filename
-from docserv.repolock import RepoLock
+from docserv.pipeline import Pipeline, describe, execute, remove
+from docserv.publisher import Publisher, docset_paths
+from docserv.repocache import RepoCache, referenced_paths
+from docserv.scheduler import MAX_PRIORITY, MIN_PRIORITY, valid_priority
+from docserv.transfer import TransferStats, is_local
 
 BIN_DIR = os.getenv('DOCSERV_BIN_DIR', "/usr/bin/")
 CONF_DIR = os.getenv('DOCSERV_CONFIG_DIR', "/etc/docserv/")
@@ -30,7 +35,8 @@ class BuildInstructionHandler:
     configuration creates a set of Deliverables.
     """
 
-    def __init__(self, build_instruction, config, stitch_tmp_dir, gitLocks, gitLocksLock, thread_id):
+    def __init__(self, build_instruction, config, stitch_tmp_dir, gitLocks, gitLocksLock, thread_id, history=None,
+                 repo_cache=None, artifacts=None, image=None, publisher=None):
         # A dict with meta information about a Deliverable.
         # It is filled with Deliverable.dict().
         self.deliverables = {}
@@ -48,11 +54,41 @@ class BuildInstructionHandler:
         # running daps for them.
         self.deliverables_building = []
         self.deliverables_building_lock = threading.Lock()
+        # Deliverable objects that are currently building, mapped with
+        # the Deliverable ID. Needed to cancel them. This also uses the
+        # deliverables_building_lock.
+        self.deliverables_running = {}
+        # True if the whole build instruction was cancelled.
+        self.cancelled = False
 
         self.cleanup_done = False
         self.cleanup_lock = threading.Lock()
 
+        # Git tree hashes of the source directories of deliverables,
+        # for incremental builds
+        self.source_trees = {}
+        self.source_trees_lock = threading.Lock()
+
         self.stitch_tmp_dir = stitch_tmp_dir
+        # DurationHistory, records how long builds take
+        self.history = history
+        # RepoCache, shares fetches of the cached repositories
+        if repo_cache is None:
+            repo_cache = RepoCache(config, gitLocks, gitLocksLock)
+        self.repo_cache = repo_cache
+        # ArtifactStore, shares build results between deliverables
+        self.artifacts = artifacts
+        # ID of the container image all deliverables are built with
+        self.container_image = None
+        # How the output got to the backup path, see transfer.py
+        self.transfer_stats = TransferStats()
+        # Duration of each stage of the cleanup, filled by the Pipeline
+        self.step_durations = {}
+        # Publisher, builds the navigation pages and syncs the changed
+        # paths to the target path for batches of build instructions
+        if publisher is None:
+            publisher = Publisher(config['server']['name'], 0)
+        self.publisher = publisher
 
         if self.validate(build_instruction, config):
             self.initialized = True
@@ -63,13 +99,18 @@ class BuildInstructionHandler:
             if 'deliverables' in build_instruction:
                 self.deliverables = build_instruction['deliverables']
             self.config = config
+            # Pin the image, so an image update in the middle of the build
+            # does not mix results of different images. A build
+            # instruction can also name the image to build with.
+            if 'container_image' not in build_instruction and image is not None:
+                build_instruction['container_image'] = image.pinned_image()
+            self.container_image = build_instruction.get('container_image')
             if not self.read_conf_dir():
                 self.initialized = False
                 return
-            self.git_lock = RepoLock(resource_to_filename(
-                self.remote_repo), thread_id, gitLocks, gitLocksLock)
+            start = time.time()
             self.prepare_repo(thread_id)
-            self.get_commit_hash()
+            self.record_duration('prepare', time.time() - start)
             self.create_dir_structure()
         else:
             self.initialized = False
@@ -88,6 +129,56 @@ class BuildInstructionHandler:
 
         os.makedirs(self.tmp_bi_path, exist_ok=True)
 
+    def publish_paths(self, backup_path):
+        """
+        Paths (relative to backup_path) that are published for this
+        build instruction, see docset_paths().
+        """
+        if current_generation(backup_path, self.docset_relative_path) is None:
+            return None
+        return docset_paths(backup_path, self.docset_relative_path)
+
+    def transfer_command(self, source_dir, destination, step, move=False):
+        """
+        Step that puts the contents of source_dir into destination.
+        Local destinations get hard links (or the files themselves, with
+        move=True) instead of copies if possible, see transfer.py.
+        """
+        if not is_local(destination):
+            return {'cmd': "rsync -lr %s/ %s" % (source_dir, destination), 'step': step}
+        return {'action': 'transfer',
+                'args': [source_dir + '/', destination, self.transfer_stats, move],
+                'step': step}
+
+    def navigation_command(self, output_dir):
+        """
+        Command that (re-)generates the navigation pages of the docset
+        of this build instruction in output_dir.
+        """
+        return {'cmd': "docserv-build-navigation %s --product=\"%s\" --docset=\"%s\" --stitched-config=\"%s\" --ui-languages=\"%s\" %s --cache-dir=\"%s\" --template-dir=\"%s\" --output-dir=\"%s\" --base-path=\"%s\" --htaccess=\"%s\" --favicon=\"%s\"" % (
+                "--internal-mode" if self.config['targets'][self.build_instruction['target']
+                                                             ]['internal'] == "yes" else "",
+                self.build_instruction['product'],
+                self.build_instruction['docset'],
+                self.stitch_tmp_file,
+                self.config['targets'][self.build_instruction['target']]['languages'],
+                "--omit-lang-path=\"%s\"" % self.config['targets'][self.build_instruction['target']]['default_lang'] if
+                            self.config['targets'][self.build_instruction['target']]['omit_default_lang_path'] == "yes" else "",
+                os.path.join(self.deliverable_cache_base_dir, self.build_instruction['target']),
+                self.config['targets'][self.build_instruction['target']]['template_dir'],
+                output_dir,
+                self.config['targets'][self.build_instruction['target']]['server_base_path'],
+                self.config['targets'][self.build_instruction['target']]['htaccess'],
+                self.config['targets'][self.build_instruction['target']]['favicon'],
+            ), 'step': 'build_navigation', 'output_dir': output_dir,
+            'build_instruction_id': self.build_instruction['id'],
+            'post_cmd_hook': 'record_navigation'}
+
+    def record_duration(self, step, seconds):
+        if self.history is not None:
+            self.history.record_build_instruction(
+                self.product, self.docset, self.lang, step, seconds)
+
     def cleanup(self):
         """
         Copy built documentation to the right places.
@@ -96,36 +187,44 @@ class BuildInstructionHandler:
         """
         if not self.cleanup_lock.acquire(False):
             return False
+        start = time.time()
 
         logger.debug("Cleaning up %s", json.dumps(self.build_instruction['id']))
 
-        commands = {}
-        n = 0
-        if hasattr(self, 'tmp_bi_path') and os.listdir(self.tmp_bi_path):
+        commands = []
+        publish = False
+        if self.cancelled:
+            # Don't publish anything of a cancelled build instruction,
+            # only remove the temporary directories.
+            logger.info("Not publishing cancelled build instruction %s",
+                        self.build_instruction['id'])
+        elif hasattr(self, 'tmp_bi_path') and os.listdir(self.tmp_bi_path):
             backup_path = self.config['targets'][self.build_instruction['target']]['backup_path']
-            backup_docset_relative_path = os.path.join(backup_path, self.docset_relative_path)
-
-            # remove contents of backup path for current build instruction
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "rm -rf %s" % (backup_docset_relative_path)
-
-            # copy temp build instruction directory to backup path;
+            # The output goes into a new generation directory, the docset
+            # path in the backup path is a link to the live generation,
+            # see generations.py.
+            # The stages of the cleanup only wait for the stages they
+            # depend on: linking the output into the generation and
+            # creating the archive both only read the temp build
+            # instruction directory, so they run at the same time.
+            generation = new_generation(backup_path, self.docset_relative_path)
+            backup_docset_relative_path = generation_path(
+                backup_path, self.docset_relative_path, generation)
+
+            # link temp build instruction directory into the generation;
             # we only do that for products that are unpublished/beta/supported,
             # unsupported products only get an archive
-            n += 1
-            commands[n] = {}
             if self.lifecycle != 'unsupported':
-                commands[n]['cmd'] = "rsync -lr %s/ %s" % (self.tmp_dir_bi, backup_path)
-            else:
-                commands[n]['cmd'] = "mkdir -p %s" % os.path.join(backup_path, self.docset_relative_path)
+                command = self.transfer_command(self.tmp_bi_path, backup_docset_relative_path,
+                                                'rsync_backup')
+                command['after'] = []
+                commands.append(command)
 
-            # create zip archive
-            n += 1
-            commands[n] = {}
+            # create zip archive; if it is the same as the archive of the
+            # live generation, that one is linked instead
             zip_name = "{}-{}-{}.zip".format(self.product, self.docset, self.lang)
             zip_formats = self.config['targets'][self.build_instruction['target']]['zip_formats'].replace(" ",",")
-            create_archive_cmd = '%s --input-path %s --output-path %s --zip-formats %s --cache-path %s --relative-output-path %s --product %s --docset %s --language %s' % (
+            create_archive_cmd = '%s --input-path %s --output-path %s --zip-formats %s --cache-path %s --relative-output-path %s --product %s --docset %s --language %s --previous-archive %s' % (
                 os.path.join(BIN_DIR, 'docserv-create-archive'),
                 self.tmp_bi_path,
                 os.path.join(backup_docset_relative_path, zip_name),
@@ -134,82 +233,63 @@ class BuildInstructionHandler:
                 os.path.join(self.docset_relative_path, zip_name),
                 self.product,
                 self.docset,
-                self.lang)
-            commands[n]['cmd'] = create_archive_cmd
-
-            # (re-)generate navigation page
-            tmp_dir_nav = tempfile.mkdtemp(prefix="docserv_navigation_")
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "docserv-build-navigation %s --product=\"%s\" --docset=\"%s\" --stitched-config=\"%s\" --ui-languages=\"%s\" %s --cache-dir=\"%s\" --template-dir=\"%s\" --output-dir=\"%s\" --base-path=\"%s\" --htaccess=\"%s\" --favicon=\"%s\"" % (
-                "--internal-mode" if self.config['targets'][self.build_instruction['target']
-                                                             ]['internal'] == "yes" else "",
-                self.build_instruction['product'],
-                self.build_instruction['docset'],
-                self.stitch_tmp_file,
-                self.config['targets'][self.build_instruction['target']]['languages'],
-                "--omit-lang-path=\"%s\"" % self.config['targets'][self.build_instruction['target']]['default_lang'] if
-                            self.config['targets'][self.build_instruction['target']]['omit_default_lang_path'] == "yes" else "",
-                os.path.join(self.deliverable_cache_base_dir, self.build_instruction['target']),
-                self.config['targets'][self.build_instruction['target']]['template_dir'],
-                tmp_dir_nav,
-                self.config['targets'][self.build_instruction['target']]['server_base_path'],
-                self.config['targets'][self.build_instruction['target']]['htaccess'],
-                self.config['targets'][self.build_instruction['target']]['favicon'],
-            )
-            # rsync navigational pages dir to backup path
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "rsync -lr %s/ %s" % (
-                tmp_dir_nav, backup_path)
-
-            # rsync local backup path with web server target path
-            if self.config['targets'][self.build_instruction['target']]['enable_target_sync'] == 'yes':
-                target_path = self.config['targets'][self.build_instruction['target']]['target_path']
-                n += 1
-                commands[n] = {}
-                commands[n]['cmd'] = "rsync --exclude-from '%s' --delete-after -lr %s/ %s" % (
-                    os.path.join(SHARE_DIR, 'rsync', 'rsync_excludes.txt'),
-                    backup_path,
-                    target_path,
-                )
-
-            # remove temp directory for navigation page
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "rm -rf %s" % tmp_dir_nav
+                self.lang,
+                os.path.join(backup_path, self.docset_relative_path, zip_name))
+            commands.append({'cmd': create_archive_cmd, 'step': 'create_archive', 'after': []})
+
+            # make the new generation live, unless the build failed
+            # to fill it
+            commands.append({'action': 'activate_generation',
+                             'args': [backup_path, self.docset_relative_path, generation],
+                             'step': 'activate_generation',
+                             'after': ['rsync_backup', 'create_archive']
+                             if self.lifecycle != 'unsupported' else ['create_archive'],
+                             'after_success': True})
+
+            # navigation pages and the sync to the target path are done
+            # for several build instructions at once, see PublishQueue
+            publish = True
 
         if hasattr(self, 'tmp_bi_path'):
-            # remove temp build instruction directory
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "rm -rf %s" % self.tmp_dir_bi
+            # remove temp build instruction directory, after all stages
+            # that read it
+            commands.append({'action': 'remove', 'args': [self.tmp_dir_bi],
+                             'step': 'remove_tmp', 'cleanup': True,
+                             'after': [command['step'] for command in commands]})
 
         if hasattr(self, 'local_repo_build_dir'):
-            # build target directory
-            n += 1
-            commands[n] = {}
-            commands[n]['cmd'] = "rm -rf %s" % self.local_repo_build_dir
-
+            # give back the checkout, it is removed when no other build
+            # instruction uses it and the pool is full
+            self.repo_cache.release(self.remote_repo, self.checkout_commit)
+            del self.local_repo_build_dir
 
         if not commands:
             self.cleanup_done = True
             self.cleanup_lock.release()
             return
 
-        for i in range(1, n + 1):
-            cmd = shlex.split(commands[i]['cmd'])
-            logger.debug("Cleaning up %s, %s",
-                self.build_instruction['id'], commands[i]['cmd'])
-            s = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = s.communicate()
-            if int(s.returncode) != 0:
-                logger.warning("Clean up failed! Unexpected return value %i for '%s'",
-                    s.returncode, commands[i]['cmd'])
-                self.mail(commands[i]['cmd'], out, err)
+        logger.debug("Cleaning up %s, %s", self.build_instruction['id'],
+                     [describe(command) for command in commands])
+        # A failed step does not stop the cleanup.
+        Pipeline(self, timeout=self.config['server'].get('step_timeout') or None,
+                 stop_on_failure=False, cancellable=False).run(commands)
+        self.record_duration('cleanup', time.time() - start)
+        self.build_instruction['cleanup_step_durations'] = dict(self.step_durations)
         self.cleanup_done = True
         self.cleanup_lock.release()
+        if publish:
+            if current_generation(backup_path, self.docset_relative_path) != generation:
+                # The previous generation stays live.
+                logger.warning("Not publishing %s, its output is incomplete",
+                               self.build_instruction['id'])
+                remove(generation_path(backup_path, self.docset_relative_path, generation))
+                self.build_instruction['publish_status'] = 'not published'
+                return
+            self.build_instruction['generation'] = generation
+            collect_garbage(backup_path, self.docset_relative_path,
+                            self.config['server'].get('generations_kept', 3))
+            self.build_instruction['publish_status'] = 'awaiting publish'
+            self.publisher.enqueue(self)
 
     def __del__(self):
         if not self.cleanup_done:
@@ -226,11 +306,19 @@ class BuildInstructionHandler:
         retval['open'] = self.deliverables_open
         retval['building'] = self.deliverables_building
         retval['deliverables'] = self.deliverables
+        retval['transfer'] = self.transfer_stats.dict()
         return retval
 
     def __getitem__(self, arg):
         return self.build_instruction
 
+    def step_failed(self, command, result):
+        """
+        A command of the cleanup failed, send a mail.
+        """
+        logger.warning("Clean up of %s failed!", self.build_instruction['id'])
+        self.mail(describe(command), result['out'], result['err'])
+
     def mail(self, command, out, err):
         msg = """Cheerio!
 
@@ -306,11 +394,9 @@ These are the details:
             self.config['targets'][target]['config_dir'],
             self.stitch_tmp_file)
         logger.debug("Stitching command: %s", cmd)
-        cmd = shlex.split(cmd)
-        s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        self.out, self.err = s.communicate()
-        rc = int(s.returncode)
+        result = execute(cmd)
+        self.out, self.err = result['out'], result['err']
+        rc = int(result['returncode'])
         if rc == 0:
             logger.debug("Stitching of %s successful",
                          self.config['targets'][target]['config_dir'])
@@ -323,9 +409,6 @@ These are the details:
             self.initialized = False
             return False
 
-        self.local_repo_build_dir = os.path.join(self.config['server']['temp_repo_dir'], ''.join(
-            random.choices(string.ascii_uppercase + string.digits, k=12)))
-
         # then read all files into an xml tree
         self.tree = etree.parse(self.stitch_tmp_file)
         try:
@@ -354,12 +437,9 @@ These are the details:
         try:
             xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/language[@lang='%s']/subdir" % (
                 self.product, self.docset, self.lang)
-            self.build_source_dir = os.path.join(
-                self.local_repo_build_dir,
-                self.tree.find(xpath).text)
-
+            self.build_subdir = self.tree.find(xpath).text
         except AttributeError:
-            self.build_source_dir = self.local_repo_build_dir
+            self.build_subdir = None
 
         if self.lifecycle == 'unpublished' and self.config['targets'][target]['internal'] != 'yes':
             logger.warning("Intentionally not building 'unpublished' docset '%s' of product '%s' for public target server '%s'.",
@@ -376,75 +456,96 @@ These are the details:
         """
         Prepare the repository required for building the deliverables.
         This function updates the local clone of the repository, then
-        clones the required branch into another local and temporary
-        repository. With this, multiple builds of different branches
-        can run at the same time.
-        """
-        commands = {}
-        # Clone locally cached repository, does nothing if exists
-        n = 0
-        local_repo_cache_dir = os.path.join(
-            self.config['server']['repo_dir'], resource_to_filename(self.remote_repo))
-        commands[n] = {}
-        commands[n]['cmd'] = "git clone %s %s" % (
-            self.remote_repo, local_repo_cache_dir)
-        commands[n]['ret_val'] = None
-        commands[n]['repo_lock'] = local_repo_cache_dir
-
-        # update locally cached repo
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "git -C %s pull --all " % local_repo_cache_dir
-        commands[n]['ret_val'] = 0
-        commands[n]['repo_lock'] = local_repo_cache_dir
-
-        # update locally cached repo
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "git -C %s checkout %s " % (
-            local_repo_cache_dir, self.branch)
-        commands[n]['ret_val'] = 0
-        commands[n]['repo_lock'] = local_repo_cache_dir
-
-        # Create local copy in temp build dir
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "git clone --single-branch --branch %s %s %s" % (
-            self.branch, local_repo_cache_dir, self.local_repo_build_dir)
-        commands[n]['ret_val'] = 0
-        commands[n]['repo_lock'] = None
-
-        for i in range(0, n + 1):
-            cmd = shlex.split(commands[i]['cmd'])
-            if commands[i]['repo_lock'] is not None:
-                self.git_lock.acquire()
-            logger.debug("Thread %i: %s", thread_id, commands[i]['cmd'])
-            s = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = s.communicate()
-            self.git_lock.release()
-            if commands[i]['ret_val'] is not None and not commands[i]['ret_val'] == int(s.returncode):
-                logger.warning("Build failed! Unexpected return value %i for '%s'",
-                               s.returncode, commands[i]['cmd'])
-                self.mail(commands[i]['cmd'], out.decode(
-                    'utf-8'), err.decode('utf-8'))
-                self.initialized = False
-                return False
+        checks out the current commit of the required branch into another
+        local and temporary repository, without copying the history.
+        With this, multiple builds of different branches can run at the
+        same time.
+        """
+        # Clone or update the locally cached repository. If other
+        # build instructions for the same repository are being prepared
+        # right now, this waits for their fetch instead.
+        result, error = self.repo_cache.update(
+            self.remote_repo, self.build_instruction.get('queued', 0), thread_id)
+        if not result:
+            self.mail(*error)
+            self.initialized = False
+            return False
+
+        if not self.get_commit_hash():
+            self.mail("git rev-parse %s" % self.branch,
+                      "", "Branch %s does not exist in %s" % (self.branch, self.remote_repo))
+            self.initialized = False
+            return False
+
+        # Get a checkout of the commit in the temp repo dir. It is shared
+        # with other build instructions that build the same commit and
+        # must not be modified.
+        self.checkout_paths = self.sparse_paths()
+        path, error = self.repo_cache.checkout(
+            self.remote_repo, self.build_instruction['commit'], thread_id, self.checkout_paths)
+        if path is None:
+            self.mail(*error)
+            self.initialized = False
+            return False
+        self.local_repo_build_dir = path
+        self.checkout_commit = self.build_instruction['commit']
+        self.build_source_dir = self.local_repo_build_dir
+        if self.build_subdir:
+            self.build_source_dir = os.path.join(self.local_repo_build_dir, self.build_subdir)
 
         return True
 
+    def source_tree_hashes(self, source_dir):
+        """
+        Git tree hashes of a source directory and all directories it
+        refers to. Deliverables from the same source directory share the
+        result. Returns None if git failed.
+        """
+        path = os.path.relpath(source_dir, self.local_repo_build_dir)
+        with self.source_trees_lock:
+            if path not in self.source_trees:
+                if path == '.':
+                    # the whole repository
+                    paths = ['']
+                else:
+                    paths = referenced_paths(self.local_repo_build_dir, [path])
+                self.source_trees[path] = tree_hashes(
+                    self.local_repo_build_dir, self.checkout_commit, paths)
+            return self.source_trees[path]
+
+    def sparse_paths(self):
+        """
+        The directories of the repository that contain the DC files of
+        all deliverables, for a sparse checkout. Returns None if the
+        whole repository is needed or sparse checkouts are disabled.
+        """
+        if self.config['server'].get('sparse_checkout', 'yes') != 'yes':
+            return None
+        xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/language[@lang='%s']/deliverable" % (
+            self.product, self.docset, self.lang)
+        paths = set()
+        for xml_deliverable in self.tree.findall(xpath):
+            subdir = xml_deliverable.find(".//subdir")
+            path = os.path.normpath(os.path.join(
+                self.build_subdir or '',
+                subdir.text if subdir is not None else ''))
+            if path in ('', '.'):
+                return None
+            paths.add(path)
+        return sorted(paths) or None
+
     def get_commit_hash(self):
         """
-        Extract HEAD commit hash from branch.
+        Resolve the branch to a commit hash in the cached repository.
         """
-        cmd = shlex.split("git -C "+self.local_repo_build_dir +
-                          " log --format=\"%H\" -n 1")
-        s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        self.build_instruction['commit'] = s.communicate()[
-            0].decode('utf-8').rstrip()
+        commit = self.repo_cache.resolve(self.remote_repo, self.branch)
+        if commit is None:
+            logger.warning("Branch %s does not exist in %s", self.branch, self.remote_repo)
+            return False
+        self.build_instruction['commit'] = commit
         logger.debug("Current commit hash: %s",
                      self.build_instruction['commit'])
+        return True
 
     def validate(self, build_instruction, config):
         """
@@ -467,6 +568,13 @@ These are the details:
         if not isinstance(build_instruction['target'], str):
             logger.warning("Validation: target is not a string")
             return False
+        if 'priority' in build_instruction and not valid_priority(build_instruction['priority']):
+            logger.warning("Validation: priority is not an integer from %i to %i",
+                           MIN_PRIORITY, MAX_PRIORITY)
+            return False
+        if build_instruction.get('container_image') is not None and not isinstance(build_instruction['container_image'], str):
+            logger.warning("Validation: container_image is not a string")
+            return False
         logger.debug("Valid build instruction: %s", build_instruction['id'])
         return True
 
@@ -493,7 +601,9 @@ These are the details:
         logger.debug("Generating deliverables.")
         xpath = "//product[@productid='%s']/docset[@setid='%s']/builddocs/language[@lang='%s']/deliverable" % (
             self.product, self.docset, self.lang)
+        group_formats = self.config['server'].get('group_formats') == 'yes'
         for xml_deliverable in self.tree.findall(xpath):
+            groups = OrderedDict()
             dc = xml_deliverable.find(".//dc").text
             build_formats = xml_deliverable.find(".//format").attrib
             try:
@@ -524,28 +634,76 @@ These are the details:
                                           xslt_params,
                                           )
                 self.deliverables[deliverable.id] = deliverable.dict()
-                self.deliverable_objects[deliverable.id] = deliverable
-                self.deliverables_open.append(deliverable.id)
+                groups.setdefault((dc, source_dir, deliverable.xslt_param_text()),
+                                  []).append(deliverable)
+            # Formats of a DC file that need the same parameters are built
+            # by one container run. Only the first one of each group is
+            # queued, it builds the others as well.
+            for group in groups.values():
+                if not group_formats:
+                    group = [[deliverable] for deliverable in group]
+                else:
+                    group = [group]
+                for members in group:
+                    self.add_group(members)
         # after all deliverables are generated, we don't need the xml tree anymore
         self.tree = None
         return True
 
-    def get_deliverable(self):
+    def add_group(self, members):
+        """
+        Queue the first Deliverable of members, which builds all of them.
+        """
+        leader = members[0]
+        leader.group = members[1:]
+        for member in members:
+            member.leader = leader
+            self.deliverables[member.id]['group'] = (
+                [m.id for m in members] if len(members) > 1 else [])
+        self.deliverable_objects[leader.id] = leader
+        self.deliverables_open.append(leader.id)
+
+    def has_open_deliverables(self):
+        with self.deliverables_open_lock:
+            return len(self.deliverables_open) > 0
+
+    def is_done(self):
+        """
+        True if all deliverables have finished building.
+        """
+        with self.deliverables_open_lock:
+            if len(self.deliverables_open) > 0:
+                return False
+        with self.deliverables_building_lock:
+            return len(self.deliverables_building) == 0
+
+    def get_deliverable(self, select=None):
         """
         return deliverable object that can run to build the output
         return None if all deliverables are already building
         return 'done' if all deliverables have finished building
+
+        select -- function that chooses one of a list of open Deliverable
+                  objects, by default the first one is built
         """
         retval = None
         deliverable_id = None
         with self.deliverables_open_lock:
             if len(self.deliverables_open) > 0:
-                deliverable_id = self.deliverables_open.pop()
                 with self.deliverable_objects_lock:
+                    if select is None:
+                        deliverable_id = self.deliverables_open[0]
+                    else:
+                        deliverable_id = select([
+                            self.deliverable_objects[open_id]
+                            for open_id in self.deliverables_open]).id
+                    self.deliverables_open.remove(deliverable_id)
                     retval = self.deliverable_objects.pop(deliverable_id)
         if retval is not None:
             with self.deliverables_building_lock:
-                self.deliverables_building.append(deliverable_id)
+                for member in [retval] + retval.group:
+                    self.deliverables_building.append(member.id)
+                    self.deliverables_running[member.id] = member
             return retval
         with self.deliverables_building_lock:
             retval = len(self.deliverables_building)
@@ -553,3 +711,46 @@ These are the details:
             return 'done'
         else:
             return None
+
+    def cancel(self, deliverable_id=None):
+        """
+        Cancel a single deliverable or, if no deliverable_id is given,
+        the whole build instruction: deliverables that have not been
+        started yet are removed from deliverables_open, running ones are
+        killed. Once no deliverable is building anymore, the BIH is done
+        and cleanup() runs as usual.
+        Returns False if there is no such deliverable or it is finished
+        already.
+        """
+        if deliverable_id is None:
+            self.cancelled = True
+            self.build_instruction['status'] = 'cancelled'
+        cancelled = False
+        with self.deliverables_open_lock:
+            with self.deliverable_objects_lock:
+                for open_id in list(self.deliverables_open):
+                    leader = self.deliverable_objects[open_id]
+                    members = [leader] + leader.group
+                    remaining = [member for member in members
+                                 if deliverable_id is not None and member.id != deliverable_id]
+                    if len(remaining) == len(members):
+                        continue
+                    for member in members:
+                        if member not in remaining:
+                            self.deliverables[member.id]['status'] = 'cancelled'
+                    self.deliverables_open.remove(open_id)
+                    del self.deliverable_objects[open_id]
+                    if remaining:
+                        self.add_group(remaining)
+                    cancelled = True
+        with self.deliverables_building_lock:
+            running = [deliverable for running_id, deliverable in self.deliverables_running.items()
+                       if deliverable_id is None or running_id == deliverable_id]
+        for deliverable in running:
+            deliverable.cancel()
+            cancelled = True
+        if cancelled:
+            logger.info("Cancelled %s of build instruction %s",
+                        "deliverable %s" % deliverable_id if deliverable_id else "all deliverables",
+                        self.build_instruction['id'])
+        return cancelled or deliverable_id is None
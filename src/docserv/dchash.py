@@ -0,0 +1,182 @@
+"""
+Hash sum that identifies the unique features of a DC file, simplifying
+grouping in the overview page.
+
+This is a reimplementation of the former docserv-dchash shell script.
+The output is the same as the output of the script running with
+LC_ALL=C, including its quirks: the script passed the DC file through
+`echo -e` several times, so backslash escapes in the DC file are
+interpreted the same way here.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Number of hashes kept in the memo cache
+CACHE_SIZE = 4096
+
+cache = OrderedDict()
+cache_lock = threading.Lock()
+
+# Characters removed from every line: \r, \s of sed in the C locale and
+# quotes
+REMOVED = b'\r \t\n\v\f"\''
+RELEVANT_LINE = re.compile(rb'^(ROOTID|MAIN|PROF[A-Z]+)=')
+
+SIMPLE_ESCAPES = {
+    ord('a'): b'\a', ord('b'): b'\b', ord('e'): b'\x1b', ord('E'): b'\x1b',
+    ord('f'): b'\f', ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t',
+    ord('v'): b'\v', ord('\\'): b'\\',
+}
+OCTAL = b'01234567'
+HEX = b'0123456789abcdefABCDEF'
+
+
+def echo(text):
+    """
+    Output of bash's `echo -e "$text"`.
+    """
+    out = bytearray()
+    i = 0
+    while i < len(text):
+        c = text[i]
+        i += 1
+        if c != ord('\\') or i == len(text):
+            out.append(c)
+            continue
+        c = text[i]
+        i += 1
+        if c in SIMPLE_ESCAPES:
+            out += SIMPLE_ESCAPES[c]
+        elif c == ord('c'):
+            # Stop the output, without the final newline
+            return bytes(out)
+        elif c == ord('0'):
+            value = 0
+            for _ in range(3):
+                if i < len(text) and text[i] in OCTAL:
+                    value = value * 8 + text[i] - ord('0')
+                    i += 1
+            out.append(value & 0xFF)
+        elif c in (ord('x'), ord('u'), ord('U')):
+            digits = {ord('x'): 2, ord('u'): 4, ord('U'): 8}[c]
+            start = i
+            while i < len(text) and i - start < digits and text[i] in HEX:
+                i += 1
+            if i == start:
+                out += b'\\' + bytes([c])
+            elif c == ord('x'):
+                out.append(int(text[start:i], 16))
+            else:
+                # In the C locale, only ASCII characters are converted.
+                value = int(text[start:i], 16)
+                if value < 0x80:
+                    out.append(value)
+                elif value <= 0xFFFF:
+                    out += b'\\u%04X' % value
+                else:
+                    out += b'\\U%08X' % value
+        else:
+            out += b'\\' + bytes([c])
+    out += b'\n'
+    return bytes(out)
+
+
+def substitute(output):
+    """
+    Value of a $(...) command substitution.
+    """
+    return output.rstrip(b'\n')
+
+
+def lines(output):
+    """
+    The lines of a command output as sed, grep or sort read them.
+    """
+    result = output.split(b'\n')
+    if result[-1] == b'':
+        result.pop()
+    return result
+
+
+def grep_only(pattern, output):
+    """
+    Output of `grep -oP pattern`, pattern matches once per line at most.
+    """
+    matches = []
+    for line in lines(output):
+        match = re.search(pattern, line)
+        if match:
+            matches.append(match.group(0) + b'\n')
+    return b''.join(matches)
+
+
+def normalized_profiling(line):
+    """
+    PROFOS="osuse;sles" is logically the same as PROFOS = sles;osuse; ,
+    so make those differences disappear.
+    """
+    attribute = substitute(grep_only(rb'^[^=]+', echo(line)))
+    values = grep_only(rb'[^=]+$', echo(line)).replace(b';', b'\n')
+    values = sorted(set(value for value in lines(values) if value != b''))
+    return attribute + b'=' + b''.join(value + b';' for value in values)
+
+
+def minimal_dc(content, root_id=None):
+    """
+    The lines of a DC file that matter for the hash, normalized. content
+    and root_id are bytes.
+    """
+    # Unfortunately, including profiling data (PROF[A-Z]+) in the
+    # minimized DC files is both necessary and a source of errors. e.g.
+    # DC-SLES-admin has slightly different profiling than DC-SLES-all:
+    # DC-SLES-all includes a profiling attribute that is only relevant for
+    # virtualization documentation which is not included in DC-SLES-admin
+    # because it does not touch on virtualization.
+    # However, it is necessary e.g. for SLES for SAP where the same guide is
+    # shipped with either "quick start" or "full guide" profiling.
+    minimal = [line.translate(None, REMOVED) for line in content.split(b'\n')]
+    minimal = substitute(b'\n'.join(line for line in minimal if RELEVANT_LINE.match(line)))
+    if root_id:
+        minimal = substitute(b'\n'.join(line for line in lines(echo(minimal))
+                                        if not line.startswith(b'ROOTID=')))
+        minimal += b'\\nROOTID=' + root_id
+
+    output = echo(minimal)
+    normalized = b''
+    for line in output.split(b'\n')[:output.count(b'\n')]:
+        if any(part.startswith(b'PROF') for part in lines(echo(line))):
+            normalized += b'\\n' + normalized_profiling(line)
+        elif root_id and any(part.startswith(b'ROOTID') for part in lines(echo(line))):
+            normalized += b'\\nROOTID=' + root_id
+        else:
+            normalized += b'\\n' + line
+
+    return substitute(b''.join(line + b'\n' for line in sorted(set(lines(echo(normalized))))
+                               if line != b''))
+
+
+def dc_hash(dc_path, root_id=None):
+    """
+    Hash of a DC file, optionally with an alternate ROOTID. Hashes are
+    cached by the path, modification time and size of the file. Raises
+    OSError if the file cannot be read.
+    """
+    dc_path = os.path.realpath(dc_path)
+    stat = os.stat(dc_path)
+    key = (dc_path, stat.st_mtime_ns, stat.st_size, root_id)
+    with cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    with open(dc_path, 'rb') as f:
+        content = f.read()
+    encoded_root_id = os.fsencode(root_id) if root_id else None
+    value = hashlib.sha1(echo(minimal_dc(content, encoded_root_id))).hexdigest()
+    with cache_lock:
+        cache[key] = value
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    return value
@@ -1,15 +1,21 @@
 import hashlib
 import logging
 import os
-import shlex
-import subprocess
+import shutil
 import tempfile
+import threading
 import time
 # FIXME: switch to LXML
 from xml.etree import ElementTree, cElementTree
+from lxml import etree
 
+from docserv.dchash import dc_hash
+from docserv.fingerprint import file_hash, fingerprint
 from docserv.functions import feedback_message, resource_to_filename
+from docserv.pipeline import Pipeline, describe, kill
 from docserv.repolock import RepoLock
+from docserv.titles import extract_titles
+from docserv.transfer import TransferStats
 
 logger = logging.getLogger('docserv')
 
@@ -18,6 +24,10 @@ CONF_DIR = os.getenv('DOCSERV_CONFIG_DIR', "/etc/docserv/")
 SHARE_DIR = os.getenv('DOCSERV_SHARE_DIR', "/usr/share/docserv/")
 CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
 
+# Steps of Deliverable.build() that are shared by all formats of a group
+BUILD_STEPS = ('write_xslt_params', 'write_daps_params', 'd2d_runner',
+               'remove_daps_params', 'remove_xslt_params')
+
 
 class Deliverable:
     """
@@ -33,9 +43,38 @@ class Deliverable:
         self.status = "building"
         self.successful_build_commit = None
         self.last_build_attempt_commit = None
+        # Fingerprint of the inputs of the last successful build and of
+        # the current build, see fingerprint()
+        self.successful_build_fingerprint = None
+        self.input_fingerprint = None
+        # Path and title of the last build, to reuse it if unchanged
+        self.previous_path = None
+        self.previous_title = None
+        self.unchanged = False
         self.root_id = None  # False if no root id exists
         self.pdf_name = None # False if no PDFNAME value exists in DC file
         self.cleanup_done = False
+        # Durations of the build steps in seconds
+        self.step_durations = {}
+        # CPU time and memory used by the commands of the build steps
+        self.step_rusage = {}
+        # How the output got from the container to the build
+        # instruction directory, see transfer.py
+        self.transfer_stats = TransferStats()
+        # The commands that are currently running, so they can be killed
+        # when the deliverable is cancelled.
+        self.processes = set()
+        self.process_lock = threading.Lock()
+        self.cancelled = False
+        # Other formats of the same DC file that are built together with
+        # this one, see BuildInstructionHandler.generate_deliverables()
+        self.group = []
+        # Seconds spent in the container build of the group, see Slots
+        self.build_time = 0.0
+        # The deliverable that builds this one, itself if it is not
+        # part of a group
+        self.leader = self
+        self.tmp_dir_docker = None
 
         self.source_dir, self.tmp_dir_bi, self.docset_relative_path = dir_struct_paths
         self.parent = parent  # Reference to the parent BuildInstructionHandler
@@ -46,6 +85,10 @@ class Deliverable:
         self.id = self.generate_id()
         self.prev_state()
         self.target_config = self.parent.config['targets'][self.parent.build_instruction['target']]
+        self.expected_duration = None
+        if self.parent.history is not None:
+            self.expected_duration = self.parent.history.expected_deliverable(
+                *self.history_key())
         logger.debug("Queued deliverable %s -- %s of %s:%s/%s/%s/%s for BI %s",
                      self.id,
                      self.build_format,
@@ -66,6 +109,10 @@ class Deliverable:
                 self.id]['successful_build_commit']
             self.last_build_attempt_commit = self.parent.deliverables[
                 self.id]['last_build_attempt_commit']
+            self.successful_build_fingerprint = self.parent.deliverables[
+                self.id].get('successful_build_fingerprint')
+            self.previous_path = self.parent.deliverables[self.id].get('path')
+            self.previous_title = self.parent.deliverables[self.id].get('title')
 
     def dict(self):
         value = {
@@ -76,10 +123,31 @@ class Deliverable:
             'path': self.path,
             'successful_build_commit': self.successful_build_commit,
             'last_build_attempt_commit': self.last_build_attempt_commit,
+            'successful_build_fingerprint': self.successful_build_fingerprint,
             'subdeliverables': self.subdeliverables,
+            'group': [],
+            'expected_duration': self.expected_duration,
+            'build_start': None,
+            'build_finish': None,
+            'predicted_start': None,
+            'predicted_finish': None,
+            'step_durations': {},
+            'step_rusage': {},
+            'transfer': None,
+            'bytes_copied': 0,
         }
         return value
 
+    def history_key(self):
+        """
+        Key of this deliverable in the DurationHistory.
+        """
+        return (self.parent.build_instruction['product'],
+                self.parent.build_instruction['docset'],
+                self.parent.build_instruction['lang'],
+                self.dc_file,
+                self.build_format)
+
     def generate_id(self):
         """
         Generate an ID (hash) from a unique tuple of parameters.
@@ -94,10 +162,50 @@ class Deliverable:
 
     def run(self, thread_id):
         """
-        Create a dict of commands that build the document.
+        Build the deliverable together with the deliverables in its
+        group (the other formats of the same DC file, see
+        BuildInstructionHandler.generate_deliverables()). All formats
+        that need to be built are built with one run of d2d_runner, then
+        the output of every format is copied to the temp build instruction
+        directory separately.
         """
+        members = []
+        for member in [self] + self.group:
+            member.start(thread_id)
+            if not member.reuse_unchanged(thread_id):
+                members.append(member)
+
+        # The output of d2d_runner. If a deliverable with the same inputs
+        # was built before, it is taken from the artifact store instead.
+        to_build = []
+        for member in members:
+            member.tmp_dir_docker = tempfile.mkdtemp(prefix="docserv_out_")
+            if not member.cancelled and not member.lookup_artifact(thread_id):
+                to_build.append(member)
+        if to_build:
+            for member in to_build[1:]:
+                os.rmdir(member.tmp_dir_docker)
+                member.tmp_dir_docker = to_build[0].tmp_dir_docker
+            if not self.build(to_build, thread_id):
+                members = [member for member in members if member not in to_build]
+
+        #
+        # The following lines of code define all bash commands that
+        # are required to publish the deliverables.
+        #
+        for member in members:
+            member.finish(member.execute_commands(member.output_commands(), thread_id))
+
+        # remove docker output directories
+        for tmp_dir_docker in sorted(set(member.tmp_dir_docker for member in [self] + self.group
+                                         if member.tmp_dir_docker is not None)):
+            self.execute({'action': 'remove', 'args': [tmp_dir_docker],
+                          'step': 'remove_output', 'cleanup': True}, thread_id)
+
+    def start(self, thread_id):
         with self.parent.deliverables_open_lock:
             self.parent.deliverables[self.id]['last_build_attempt_commit'] = self.parent.build_instruction['commit']
+            self.parent.deliverables[self.id]['build_start'] = time.time()
         logger.info("Building deliverable %s (%s, %s) for BI %s. Commit: %s",
                     self.id,
                     self.dc_file,
@@ -105,19 +213,214 @@ class Deliverable:
                     self.parent.build_instruction['id'],
                     self.parent.deliverables[self.id]['last_build_attempt_commit'],
                     )
-        #
-        # The following lines of code define all bash commands that
-        # are required to build and publish the deliverable.
-        # This includes preparation of the target directories and
-        # clean up after the build is finished.
-        #
-        commands = {}
+        self.set_paths()
+        if (self.parent.config['server'].get('incremental_builds') == 'yes' or
+                self.parent.artifacts is not None):
+            start = time.time()
+            self.input_fingerprint = self.fingerprint()
+            self.step_durations['fingerprint'] = time.time() - start
+
+    def reuse_unchanged(self, thread_id):
+        """
+        For incremental builds: if the inputs did not change since the
+        last successful build, reuse it and finish. Returns True in that
+        case.
+        """
+        if self.parent.config['server'].get('incremental_builds') != 'yes':
+            return False
+        start = time.time()
+        if (self.input_fingerprint is None or
+                self.input_fingerprint != self.successful_build_fingerprint or
+                not self.reuse_previous_build(thread_id)):
+            return False
+        self.step_durations['reuse'] = time.time() - start
+        self.unchanged = True
+        self.finish(True)
+        return True
+
+    def lookup_artifact(self, thread_id):
+        """
+        Fill self.tmp_dir_docker from the artifact store. Returns True if
+        the deliverable does not need to be built.
+        """
+        if self.parent.artifacts is None or self.input_fingerprint is None:
+            return False
+        start = time.time()
+        cached = self.parent.artifacts.lookup(self.input_fingerprint, self.tmp_dir_docker)
+        self.step_durations['artifact_lookup'] = time.time() - start
+        if cached:
+            logger.info("Thread %i: Using stored build of deliverable %s",
+                        thread_id, self.id)
+        return cached
+
+    def build(self, members, thread_id):
+        """
+        Run daps in the docker container for all formats in members (a
+        list of Deliverables with the same DC file and parameters).
+        The output is written to their shared tmp_dir_docker. Returns
+        False and finishes all members if the build failed or was
+        cancelled.
+        """
+        commands = []
+        tmp_dir_docker = members[0].tmp_dir_docker
 
         # Write XSLT parameters to temp file
-        n = 0
         xslt_params_file = tempfile.mkstemp(prefix="docserv_xslt_", text=True)
         os.close(xslt_params_file[0])
-        default_xslt_params = self.parent.config['targets'][self.parent.build_instruction['target']]['default_xslt_params']
+        default_xslt_params = self.target_config['default_xslt_params']
+        commands.append({
+            'action': 'write_param_file',
+            'args': [xslt_params_file[1], self.xslt_param_text(), default_xslt_params],
+            'step': 'write_xslt_params'})
+
+        # Write daps parameters to temp file
+        daps_params_file = tempfile.mkstemp(prefix="docserv_daps_", text=True)
+        os.close(daps_params_file[0])
+        commands.append({
+            'action': 'write_param_file',
+            'args': [daps_params_file[1], self.daps_param_text()],
+            'step': 'write_daps_params'})
+
+        # Run daps in the docker container. The image is only updated
+        # by ContainerImage, the build instruction is built with the
+        # image it pinned.
+        container = ""
+        if self.parent.container_image is not None:
+            container = "--container-engine=%s --container=%s " % (
+                self.parent.config['server']['container_engine'],
+                self.parent.container_image)
+        commands.append({
+            'cmd': "%s --create-bigfile=1 --auto-validate=1 --container-update=0 %s--xslt-param-file=%s --daps-param-file=%s --out=%s --in=%s --formats=%s %s" % (
+                self.parent.config['server']['container_runner'],
+                container,
+                xslt_params_file[1],
+                daps_params_file[1],
+                tmp_dir_docker,
+                self.source_dir,
+                ','.join(member.build_format for member in members),
+                self.dc_file
+            ),
+            'step': 'd2d_runner'})
+
+        # remove daps parameter file
+        commands.append({'action': 'remove', 'args': [daps_params_file[1]],
+                         'step': 'remove_daps_params', 'cleanup': True})
+
+        # remove xslt parameter file
+        commands.append({'action': 'remove', 'args': [xslt_params_file[1]],
+                         'step': 'remove_xslt_params', 'cleanup': True})
+
+        # The build is shared by the group, it is only stopped when all
+        # of its formats are cancelled, see cancel().
+        result = self.execute_commands(commands, thread_id, cancellable=False)
+        self.build_time += sum(duration for step, duration in self.step_durations.items()
+                               if step in BUILD_STEPS)
+        # The duration of the shared build is split between the formats,
+        # so the expected durations of the group add up.
+        shared_steps = {step: duration / len(members)
+                        for step, duration in self.step_durations.items()
+                        if step in BUILD_STEPS}
+        for member in members:
+            member.step_durations.update(shared_steps)
+        if not result:
+            for member in members:
+                member.finish(False)
+            return False
+        if self.parent.artifacts is not None:
+            for member in members:
+                if member.input_fingerprint is None:
+                    continue
+                # Each format of a group is stored without the output
+                # of the others.
+                filelist = None
+                if len(members) > 1:
+                    filelist = member.own_filelist(tmp_dir_docker)
+                    if not filelist:
+                        continue
+                self.parent.artifacts.store(member.input_fingerprint, tmp_dir_docker, filelist)
+        return True
+
+    def own_filelist(self, tmp_dir_docker):
+        """
+        The lines of the d2d file list in tmp_dir_docker that belong to
+        the format of this deliverable, including the big files.
+        """
+        try:
+            with open(os.path.join(tmp_dir_docker, 'filelist'), 'r') as f:
+                lines = [line.strip() for line in f if line.strip() != ""]
+        except OSError:
+            return []
+        own = [line for line in lines if self.build_format in line.split('/')]
+        if not own:
+            return []
+        return [line for line in lines if '_bigfile.xml' in line or line in own]
+
+    def output_commands(self):
+        """
+        Commands that copy the output of this deliverable from
+        tmp_dir_docker to the temp build instruction directory and write
+        the Deliverable cache file.
+        """
+        commands = []
+
+        # Create correct directory structure
+        tmp_build_full_path = os.path.join(
+            self.tmp_dir_bi,
+            self.deliverable_relative_path
+        )
+        commands.append({'action': 'mkdir', 'args': [tmp_build_full_path],
+                         'step': 'mkdir_output'})
+
+        # Move wanted files to temp build instruction directory, without
+        # copying them if possible
+        commands.append({'action': 'transfer',
+                         'args': ['__FILELIST__', tmp_build_full_path, self.transfer_stats],
+                         'step': 'rsync',
+                         'pre_cmd_hook': 'parse_d2d_filelist',
+                         'tmp_dir_docker': self.tmp_dir_docker})
+
+        # create directory for Deliverable cache file
+        commands.append({'action': 'mkdir', 'args': [self.deliverable_cache_dir],
+                         'step': 'mkdir_cache',
+                         'tmp_dir_docker': self.tmp_dir_docker,
+                         # get root id from bigfile
+                         'pre_cmd_hook': 'extract_root_id',
+                         # write configuration for overview page
+                         'post_cmd_hook': 'write_deliverable_cache'})
+        return commands
+
+    def set_paths(self):
+        """
+        Paths of the output relative to the build instruction directory
+        and of the directory for the Deliverable cache file.
+        """
+        self.deliverable_relative_path = os.path.join(
+            self.docset_relative_path,
+            self.build_format
+        )
+        if self.build_format in ['html', 'single-html']:
+            self.deliverable_relative_path = os.path.join(
+                self.deliverable_relative_path,
+                self.dc_file.replace('DC-', '')
+            )
+        self.deliverable_cache_dir = os.path.join(
+            self.parent.deliverable_cache_base_dir,
+            self.parent.build_instruction['target'],
+            self.docset_relative_path,
+            self.build_format,
+        )
+        # Copy of the Deliverable cache file that survives the next build
+        # of the build instruction, for incremental builds
+        self.incremental_cache_file = os.path.join(
+            CACHE_DIR,
+            self.parent.config['server']['name'] + '-incremental',
+            self.parent.build_instruction['target'],
+            "%s.xml" % self.id)
+
+    def xslt_param_text(self):
+        """
+        The XSLT parameters for this deliverable, one per line.
+        """
         xslt_params = ""
         if len(self.xslt_params) > 0:
             xslt_params = "\n".join(self.xslt_params)
@@ -142,156 +445,188 @@ class Deliverable:
         # Special default value to prevent odd errors
         if xslt_params == "":
             xslt_params = "--"
-        commands[n] = {}
-        commands[n]['cmd'] = "docserv-write-param-file %s \"%s\" %s" % (xslt_params_file[1], xslt_params, default_xslt_params)
+        return xslt_params
 
-        # Write daps parameters to temp file
-        n += 1
-        daps_params_file = tempfile.mkstemp(prefix="docserv_daps_", text=True)
-        os.close(daps_params_file[0])
-        remarks = self.parent.config['targets'][self.parent.build_instruction['target']]['remarks']
-        draft = self.parent.config['targets'][self.parent.build_instruction['target']]['draft']
-        meta = self.parent.config['targets'][self.parent.build_instruction['target']]['meta']
-        daps_params = "\n".join([
+    def daps_param_text(self):
+        """
+        The DAPS parameters for this deliverable, one per line.
+        """
+        remarks = self.target_config['remarks']
+        draft = self.target_config['draft']
+        meta = self.target_config['meta']
+        return "\n".join([
             "--remarks" if remarks == "yes" else "",
             "--draft" if (draft == "yes" or
                           self.parent.lifecycle == "beta" or
                           self.parent.lifecycle == "unpublished") else "",
             "--meta" if meta == "yes" else ""
         ])
-        commands[n] = {}
-        commands[n]['cmd'] = "docserv-write-param-file %s \"%s\"" % (daps_params_file[1], daps_params)
-
-        # Run daps in the docker container, copy results to a
-        # build target directory
-        n += 1
-        tmp_dir_docker = tempfile.mkdtemp(prefix="docserv_out_")
-        commands[n] = {}
-        commands[n]['cmd'] = "d2d_runner --create-bigfile=1 --auto-validate=1 --container-update=1 --xslt-param-file=%s --daps-param-file=%s --out=%s --in=%s --formats=%s %s" % (
-            xslt_params_file[1],
-            daps_params_file[1],
-            tmp_dir_docker,
-            self.source_dir,
-            self.build_format,
-            self.dc_file
-        )
-
-        # Create correct directory structure
-        self.deliverable_relative_path = os.path.join(
-            self.docset_relative_path,
-            self.build_format
-        )
-        if self.build_format in ['html', 'single-html']:
-            self.deliverable_relative_path = os.path.join(
-                self.deliverable_relative_path,
-                self.dc_file.replace('DC-', '')
-            )
-        tmp_build_full_path = os.path.join(
-            self.tmp_dir_bi,
-            self.deliverable_relative_path
-        )
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "/usr/bin/mkdir -p %s" % (tmp_build_full_path)
-
-        # Copy wanted files to temp build instruction directory
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "rsync -lr __FILELIST__  %s" % (tmp_build_full_path)
-        commands[n]['pre_cmd_hook'] = 'parse_d2d_filelist'
-        commands[n]['tmp_dir_docker'] = tmp_dir_docker
-
-        # create directory for Deliverable cache file
-        self.deliverable_cache_dir = os.path.join(
-            self.parent.deliverable_cache_base_dir,
-            self.parent.build_instruction['target'],
-            self.docset_relative_path,
-            self.build_format,
-        )
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "mkdir -p %s" % self.deliverable_cache_dir
-        commands[n]['tmp_dir_docker'] = tmp_dir_docker
-        # get root id from bigfile
-        commands[n]['pre_cmd_hook'] = 'extract_root_id'
-        # write configuration for overview page
-        commands[n]['post_cmd_hook'] = 'write_deliverable_cache'
-
-        # remove daps parameter file
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "rm %s" % (daps_params_file[1])
-
-        # remove xslt parameter file
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "rm %s" % (xslt_params_file[1])
-
-        # remove docker output directory
-        n += 1
-        commands[n] = {}
-        commands[n]['cmd'] = "rm -rf %s" % (tmp_dir_docker)
 
-        #
-        # Now iterate through all commands and execute them
-        #
-        self.iterate_commands(commands, n, thread_id)
+    def fingerprint(self):
+        """
+        Fingerprint of everything the output of the build depends on:
+        the git trees of the source directory and the directories it
+        refers to, the name and content of the DC file (the names of the
+        output files are derived from the name), the format, the XSLT
+        and DAPS parameters (including the target's draft/remarks/meta
+        flags) and the ID of the container image the build instruction
+        pinned, which d2d_runner builds with. Returns None if it cannot
+        be computed, for example if no image is pinned.
+        """
+        image_id = self.parent.container_image
+        if image_id is None:
+            return None
+        trees = self.parent.source_tree_hashes(self.source_dir)
+        if trees is None:
+            return None
+        return fingerprint({
+            'trees': trees,
+            'dc_file': self.dc_file,
+            'dc': file_hash(os.path.join(self.source_dir, self.dc_file)),
+            'format': self.build_format,
+            'subdeliverables': self.subdeliverables,
+            'xslt_params': self.xslt_param_text(),
+            'default_xslt_params': file_hash(self.target_config['default_xslt_params']),
+            'daps_params': self.daps_param_text(),
+            'lifecycle': self.parent.lifecycle,
+            'container_image': image_id,
+        })
+
+    def reuse_previous_build(self, thread_id):
+        """
+        The inputs did not change since the last successful build: copy
+        its output from the backup path to the build instruction
+        directory and restore its Deliverable cache file. Returns False
+        if anything of the previous build is missing.
+        """
+        if not self.previous_path:
+            return False
+        source = os.path.join(self.target_config['backup_path'],
+                              self.previous_path).rstrip('/')
+        if not os.path.exists(source):
+            return False
+        if self.parent.lifecycle != "unsupported" and not os.path.isfile(self.incremental_cache_file):
+            return False
+        target_dir = os.path.dirname(os.path.join(self.tmp_dir_bi,
+                                                  self.previous_path.rstrip('/')))
+        os.makedirs(target_dir, exist_ok=True)
+        if not self.execute({'action': 'transfer',
+                             'args': [source, target_dir, self.transfer_stats],
+                             'step': 'reuse'}, thread_id):
+            return False
+        if self.parent.lifecycle != "unsupported":
+            os.makedirs(self.deliverable_cache_dir, exist_ok=True)
+            shutil.copy(self.incremental_cache_file,
+                        os.path.join(self.deliverable_cache_dir, "%s.xml" % self.dc_file))
+        self.path = self.previous_path
+        self.title = self.previous_title
+        logger.info("Thread %i: Deliverable %s is unchanged, reusing the previous build",
+                    thread_id, self.id)
+        return True
 
-    def iterate_commands(self, commands, n, thread_id):
+    def execute_commands(self, commands, thread_id, cancellable=True):
         """
-        Iterate through a dict containing commands. Also execute
-        post and pre execution hooks.
+        Execute a list of commands with the Pipeline, including their
+        pre and post execution hooks. The duration of each command and
+        hook is recorded in self.step_durations. Returns False if a
+        command failed or the deliverable was cancelled. After that, only
+        the commands that remove temporary files are run.
         """
-        for i in range(0, n + 1):
-            if 'pre_cmd_hook' in commands[i]:
-                commands[i] = getattr(self, commands[i]['pre_cmd_hook'])(
-                    commands[i], thread_id)
-                if commands[i] == False:
-                    return self.finish(False)
+        result = Pipeline(self, thread_id, self.parent.config['server'].get('step_timeout') or None,
+                          cancellable=cancellable).run(commands)
+        if self.cancelled:
+            logger.info("Thread %i: Cancelled deliverable %s of BI %s",
+                        thread_id, self.id, self.parent.build_instruction['id'])
+        return result
 
-            result = self.execute(commands[i], thread_id)
-            if not result:  # abort if one command failed
-                return self.finish(False)
+    def cancel(self):
+        """
+        Cancel the build of this deliverable. The worker then finishes
+        the deliverable with the status "cancelled" and drops its output.
+        The build is shared by all formats of the group, so only when
+        all of them are cancelled, the process groups of the commands
+        that are currently running are killed, which stops the container
+        runner and everything it started as well.
+        """
+        self.cancelled = True
+        leader = self.leader
+        if leader.group_cancelled():
+            with leader.process_lock:
+                for process in leader.processes:
+                    kill(process)
+
+    def group_cancelled(self):
+        """
+        True if this deliverable and all others of its group are
+        cancelled.
+        """
+        return all(member.cancelled for member in [self.leader] + self.leader.group)
 
-            if 'post_cmd_hook' in commands[i]:
-                if not getattr(self, commands[i]['post_cmd_hook'])(commands[i], thread_id):
-                    return self.finish(False)
+    def process_started(self, process):
+        with self.process_lock:
+            self.processes.add(process)
+            if self.group_cancelled():
+                kill(process)
 
-        return self.finish(result)
+    def process_finished(self, process):
+        with self.process_lock:
+            self.processes.discard(process)
 
     def execute(self, command, thread_id):
         """
         Execute single commands and check return value.
         """
-        cmd = shlex.split(command['cmd'])
-        logger.debug("Thread %i: %s" % (thread_id, command))
-        s = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        self.out, self.err = s.communicate()
-
-        if int(s.returncode) != 0:
-            self.failed_command = command['cmd']
-            logger.warning("Thread %i: Build failed! Unexpected return value %i for '%s'",
-                           thread_id, s.returncode, command['cmd'])
-            logger.warning("Thread %i STDOUT: %s", thread_id,
-                           self.out.decode('utf-8'))
-            logger.warning("Thread %i STDERR: %s", thread_id,
-                           self.err.decode('utf-8'))
-            self.mail()
-            return False
-        return True
+        return self.execute_commands([command], thread_id)
+
+    def step_failed(self, command, result):
+        """
+        A command of the build failed, send a mail.
+        """
+        if self.group_cancelled():
+            # killed by cancel()
+            return
+        self.failed_command = describe(command)
+        self.out = result['out']
+        self.err = result['err']
+        logger.warning("Build of deliverable %s failed!", self.id)
+        logger.warning("STDOUT: %s", self.out.decode('utf-8', errors='replace'))
+        logger.warning("STDERR: %s", self.err.decode('utf-8', errors='replace'))
+        self.mail()
 
     def finish(self, result):
         """
         Clean up when deliverable is finished, independent of success.
         """
         with self.parent.deliverables_open_lock:
-            if result:
+            if self.cancelled:
+                result = False
+                self.parent.deliverables[self.id]['status'] = "cancelled"
+            elif result and self.unchanged:
+                self.parent.deliverables[self.id]['status'] = "unchanged"
+            elif result:
                 self.parent.deliverables[self.id]['status'] = "success"
             else:
                 self.parent.deliverables[self.id]['status'] = "fail"
+            self.parent.deliverables[self.id]['build_finish'] = time.time()
+            self.parent.deliverables[self.id]['predicted_start'] = None
+            self.parent.deliverables[self.id]['predicted_finish'] = None
+            self.parent.deliverables[self.id]['step_durations'] = dict(self.step_durations)
+            self.parent.deliverables[self.id]['step_rusage'] = dict(self.step_rusage)
+            self.parent.deliverables[self.id]['transfer'] = self.transfer_stats.dict()
+            self.parent.deliverables[self.id]['bytes_copied'] = self.transfer_stats.bytes_copied()
+            # The output of a failed build is removed from the backup
+            # path, so it cannot be reused.
+            self.parent.deliverables[self.id]['successful_build_fingerprint'] = (
+                self.input_fingerprint if result else None)
+            if self.unchanged:
+                self.parent.deliverables[self.id]['title'] = self.title
+                self.parent.deliverables[self.id]['path'] = self.path
+        if result and not self.unchanged and self.parent.history is not None:
+            self.parent.history.record_deliverable(*self.history_key(),
+                                                   self.step_durations)
         with self.parent.deliverables_building_lock:
             self.parent.deliverables_building.remove(self.id)
+            self.parent.deliverables_running.pop(self.id, None)
         if result:
             with self.parent.deliverables_open_lock:
                 self.parent.deliverables[self.id]['successful_build_commit'] = self.parent.build_instruction['commit']
@@ -366,27 +701,30 @@ These are the details:
         """
         # currently only read from file logic
         try:
-            f = open(os.path.join(command['tmp_dir_docker'], 'filelist'), 'r')
-            for line in f:
-                line = line.strip()
-                if '_bigfile.xml' not in line and line != "":
-                    self.d2d_out_dir = line
-                    # If you build HTML, you get back a directory, d2d puts a /
-                    # at the end of the path in all cases (apparently)
-                    #   /path/to/directory/html/suse-openstack-cloud-all/
-                    # Running .split[-1] over that line gets you an empty string
-                    # and that is expected -- only for PDFs/EPUBs do we want to
-                    # keep the last part of the URL here.
-                    self.path = os.path.join(self.deliverable_relative_path,
-                                            line.split('/')[-1])
+            with open(os.path.join(command['tmp_dir_docker'], 'filelist'), 'r') as f:
+                lines = [line.strip() for line in f
+                         if '_bigfile.xml' not in line and line.strip() != ""]
+            # When several formats were built together, the file list
+            # contains the output of all of them.
+            own_lines = [line for line in lines if self.build_format in line.split('/')]
+            for line in (own_lines or lines):
+                self.d2d_out_dir = line
+                # If you build HTML, you get back a directory, d2d puts a /
+                # at the end of the path in all cases (apparently)
+                #   /path/to/directory/html/suse-openstack-cloud-all/
+                # Running .split[-1] over that line gets you an empty string
+                # and that is expected -- only for PDFs/EPUBs do we want to
+                # keep the last part of the URL here.
+                self.path = os.path.join(self.deliverable_relative_path,
+                                        line.split('/')[-1])
         except FileNotFoundError:
             return False
         # Under some circumstances, we get empty file lists. In which case it's
         # probably better to declare the build failed.
         try:
             logger.debug("Deliverable build results: %s", self.d2d_out_dir)
-            command['cmd'] = command['cmd'].replace(
-                '__FILELIST__', self.d2d_out_dir)
+            command['args'] = [self.d2d_out_dir if arg == '__FILELIST__' else arg
+                               for arg in command['args']]
             return command
         except AttributeError:
             return False
@@ -420,11 +758,6 @@ These are the details:
                 if m:
                     self.pdf_name = m.group(1)
                     break
-        xmlstarlet = {}
-        xmlstarlet['ret_val'] = 0
-        dchash = {}
-        dchash['ret_val'] = 0
-
         bigfile = self.dc_file.replace('DC-', '')
         if self.pdf_name:
             logger.debug("Found PDFNAME for %s", self.id)
@@ -436,50 +769,48 @@ These are the details:
 
         if self.root_id:
             logger.debug("Found ROOTID for %s: %s", self.id, self.root_id)
-            xpath = ("(//*[@*[local-name(.)='id']='{ID}']/*[contains(local-name(.),'info')]/*[local-name(.)='title']|"
-                     "//*[@*[local-name(.)='id']='{ID}']/*[local-name(.)='title'])[1]"
-                     ).format(ID=self.root_id)
-            xmlstarlet['cmd'] = "xmlstarlet sel -t -v \"%s\" %s" % (
-                xpath, bigfile_path)
         else:
             logger.debug(
                 "No ROOTID found for %s, using DC file name: %s", self.id, self.dc_file)
-            xpath = "(/*/*[contains(local-name(.),'info')]/*[local-name(.)='title']|/*/*[local-name(.)='title'])[1]"
-            xmlstarlet['cmd'] = "xmlstarlet sel -t -v \"%s\" %s" % (
-                xpath, bigfile_path)
-        result = self.execute(xmlstarlet, thread_id)
-        if not result:
-            return False
-        self.title = self.out.decode('utf-8').replace("&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
-        dchash['cmd'] = "%s %s" % (os.path.join(BIN_DIR, 'docserv-dchash'), dc_path)
-        result = self.execute(dchash, thread_id)
-        if not result:
+        # The titles of the document and of all subdeliverables are
+        # collected with one pass over the bigfile. The key None stands
+        # for the root element.
+        ids = [self.root_id or None] + list(self.subdeliverables)
+        try:
+            titles = extract_titles(bigfile_path, ids)
+        except (OSError, etree.XMLSyntaxError) as error:
+            return self.title_failed(bigfile_path, str(error), thread_id)
+        missing = [str(key) if key else '(document)' for key in ids if key not in titles]
+        if missing:
+            return self.title_failed(bigfile_path, "No title found for %s" % ', '.join(missing), thread_id)
+        self.title = titles[self.root_id or None]
+        try:
+            self.dc_hash = dc_hash(dc_path)
+            self.subdeliverable_titles = {}
+            self.subdeliverable_hashes = {}
+            for subdeliverable in self.subdeliverables:
+                self.subdeliverable_titles[subdeliverable] = titles[subdeliverable]
+                self.subdeliverable_hashes[subdeliverable] = dc_hash(dc_path, subdeliverable)
+        except OSError as error:
+            logger.warning("Thread %i: Could not hash %s: %s", thread_id, dc_path, error)
             return False
-        self.dc_hash = self.out.decode('utf-8')
-        self.subdeliverable_titles = {}
-        self.subdeliverable_hashes = {}
-        for subdeliverable in self.subdeliverables:
-            xpath = "(//*[@*[local-name(.)='id']='%s']/*[contains(local-name(.),'info')]/*[local-name(.)='title']|//*[@*[local-name(.)='id']='%s']/*[local-name(.)='title'])[1]" % (
-                subdeliverable, subdeliverable)
-            xmlstarlet['cmd'] = "xmlstarlet sel -t -v \"%s\" %s" % (
-                xpath, bigfile_path)
-            xmlstarlet['ret_val'] = 0
-            result = self.execute(xmlstarlet, thread_id)
-            if not result:
-                return False
-            self.subdeliverable_titles[subdeliverable] = self.out.decode(
-                'utf-8')
-            dchash['ret_val'] = 0
-            dchash['cmd'] = "%s %s %s" % (os.path.join(BIN_DIR, 'docserv-dchash'), dc_path, subdeliverable)
-            result = self.execute(dchash, thread_id)
-            if not result:
-                return False
-            self.subdeliverable_hashes[subdeliverable] = self.out.decode('utf-8')
         with self.parent.deliverables_open_lock:
             self.parent.deliverables[self.id]['title'] = self.title
             self.parent.deliverables[self.id]['path'] = self.path
         return command
 
+    def title_failed(self, bigfile_path, error, thread_id):
+        """
+        The titles could not be read from the bigfile, the build fails.
+        """
+        self.failed_command = "extract titles from %s" % bigfile_path
+        self.out = b''
+        self.err = error.encode('utf-8')
+        logger.warning("Thread %i: Build failed! Could not extract titles from %s: %s",
+                       thread_id, bigfile_path, error)
+        self.mail()
+        return False
+
     def write_deliverable_cache(self, command, thread_id):
         """
         Create an XML file that contains the deliverable information
@@ -521,4 +852,8 @@ These are the details:
         tree = cElementTree.ElementTree(root)
         tree.write(os.path.join(
             self.deliverable_cache_dir, "%s.xml" % self.dc_file))
+        if self.input_fingerprint is not None:
+            os.makedirs(os.path.dirname(self.incremental_cache_file), exist_ok=True)
+            shutil.copy(os.path.join(self.deliverable_cache_dir, "%s.xml" % self.dc_file),
+                        self.incremental_cache_file)
         return command
@@ -1,4 +1,5 @@
 import hashlib
+import itertools
 import json
 import logging
 import os
@@ -10,16 +11,58 @@ import threading
 import tempfile
 import time
 from configparser import ConfigParser as configparser
+from lxml import etree
 
+from docserv.artifacts import ArtifactStore
 from docserv.bih import BuildInstructionHandler
 from docserv.deliverable import Deliverable
+from docserv.durations import DurationHistory, predict_schedule
 from docserv.functions import print_help
+from docserv.generations import valid_name
+from docserv.journal import StateJournal
+from docserv.publisher import Publisher
+from docserv.repocache import RepoCache
 from docserv.rest import RESTServer, ThreadedRESTServer
+from docserv.retention import PastBuilds
+from docserv.runner import ContainerImage
+from docserv.scheduler import SCHEDULERS, create_scheduler
+from docserv.slots import Slots
 
 
 class DocservState:
     config = {}
 
+    # Decides the order in which build instructions and
+    # deliverables are picked up, see scheduler.py.
+    scheduler = None
+
+    # Records how long builds take, see durations.py.
+    history = None
+
+    # Number of deliverables that are built at the same time, used to
+    # predict when builds finish.
+    worker_count = 1
+
+    # Concurrency budgets for git, build and publish work, see slots.py.
+    # Protected by work_condition.
+    slots = None
+
+    # Persists the state of all build instructions, see journal.py.
+    journal = None
+
+    # Cached clones of the remote repositories, see repocache.py.
+    repo_cache = None
+
+    # Build results that can be reused, see artifacts.py. None if
+    # disabled.
+    artifacts = None
+
+    # The pinned container image, see runner.py.
+    image = None
+
+    # Publishes changed paths to the target paths, see publisher.py.
+    publisher = None
+
     ###################################################
     #   The following section contains all dicts and  #
     #   queues that keep track of stuff to be built   #
@@ -48,14 +91,34 @@ class DocservState:
     bih_dict_lock = threading.Lock()
 
     #
-    # 3.2 A queue that contains BUILD_INSTRUCTION_ID. With the ID
+    # 3.4 Build instructions that arrived again while they were already
+    #     being built. When the running build is finished, each of them
+    #     is queued once more, so the latest commit is built.
+    #     This also uses the bih_dict_lock.
+    #
+    pending_rebuilds = {}
+
+    #
+    # 3.2 A list that contains BUILD_INSTRUCTION_IDs. With the ID
     #     the workers will retrieve a Deliverable and build it.
+    #     The list is rotated so that BIHs are served round-robin.
+    #     It is protected by work_condition.
+    #
+    bih_queue = []
+
+    #
+    # 3.3 Idle workers wait on this condition until there is
+    #     something to do: a scheduled build instruction, an open
+    #     deliverable or a finished BIH that needs to be cleaned up.
+    #     Never acquire it while holding one of the other locks.
     #
-    bih_queue = queue.Queue()
+    work_condition = threading.Condition()
 
     #
     # 4. When a BuildInstructionHandler is finished, its
     #    status is dumped into a dict and kept for the future.
+    #    Docserv replaces it with a PastBuilds instance that moves
+    #    old build instructions to an archive, see retention.py.
     #
     past_builds = {}
     past_builds_lock = threading.Lock()
@@ -76,6 +139,7 @@ class DocservState:
         Create a list of all build instructions, queued, current and past.
         This is usually used to return the status on the REST API.
         """
+        self.update_predictions()
         retval = []
         with self.scheduled_build_instruction_lock:
             for key in self.scheduled_build_instruction:
@@ -89,10 +153,161 @@ class DocservState:
                     retval.append(self.bih_dict[key].dict())
                 except AttributeError:
                     pass
-        for key in self.past_builds:
-            retval.append(self.past_builds[key])
+        retval.extend(self.past_builds.values())
         return retval
 
+    def query_build_instructions(self, filters, offset=0, limit=50, archived=False):
+        """
+        Find build instructions that match all filters (a dict with
+        the keys product, docset, lang, target or status). Scheduled and
+        building build instructions come first, then finished ones, newest
+        first. Only one page of offset/limit results is returned,
+        finished build instructions are taken from the index of the
+        PastBuilds, so not all of them have to be looked at.
+        Returns a tuple (total number of matches, list of build instructions).
+        """
+        self.update_predictions()
+        active = []
+        with self.scheduled_build_instruction_lock:
+            for build_instruction in self.scheduled_build_instruction.values():
+                active.append(('scheduled', build_instruction))
+        with self.bih_dict_lock:
+            bihs = list(self.bih_dict.values())
+        for bih in bihs:
+            active.append(('building', bih.dict()))
+        active = [build_instruction for status, build_instruction in active
+                  if all((status if field == 'status' else build_instruction.get(field)) == value
+                         for field, value in filters.items())]
+        results = active[offset:offset + limit]
+        total, past = self.past_builds.query(filters,
+                                             max(0, offset - len(active)),
+                                             limit - len(results),
+                                             archived)
+        return (len(active) + total, results + past)
+
+    def update_predictions(self):
+        """
+        Predict when the queued and building deliverables and build
+        instructions will start and finish. This is based on the
+        DurationHistory and on the order the scheduler would choose.
+        The predictions are written into the dicts of the build
+        instructions and deliverables. Returns the predictions as a dict
+        that maps references to (predicted_start, predicted_finish).
+        """
+        now = time.time()
+        running = []
+        queued = []
+        with self.bih_dict_lock:
+            bihs = list(self.bih_dict.items())
+        with self.scheduled_build_instruction_lock:
+            scheduled = list(self.scheduled_build_instruction.values())
+
+        open_deliverables = []
+        for build_instruction_id, bih in bihs:
+            with bih.deliverables_building_lock:
+                building = list(bih.deliverables_building)
+            with bih.deliverables_open_lock:
+                for deliverable_id in building:
+                    deliverable = bih.deliverables[deliverable_id]
+                    group = deliverable.get('group') or [deliverable_id]
+                    if group[0] != deliverable_id:
+                        # Built by the first deliverable of its group
+                        continue
+                    expected = [bih.deliverables[member_id]['expected_duration'] for member_id in group
+                                if bih.deliverables[member_id]['expected_duration'] is not None]
+                    if deliverable['build_start'] is not None and expected:
+                        running.append(((build_instruction_id, deliverable_id),
+                                        deliverable['build_start'],
+                                        sum(expected)))
+                with bih.deliverable_objects_lock:
+                    deliverables = [bih.deliverable_objects[deliverable_id]
+                                    for deliverable_id in bih.deliverables_open]
+            open_deliverables.append((build_instruction_id, bih,
+                                      self.scheduler.order_deliverables(deliverables)))
+
+        # BIHs with a higher priority go first, BIHs with the same
+        # priority take turns.
+        open_deliverables.sort(
+            key=lambda item: -self.scheduler.priority(item[1].build_instruction))
+        for _, tier in itertools.groupby(
+                open_deliverables,
+                key=lambda item: self.scheduler.priority(item[1].build_instruction)):
+            tier = [(build_instruction_id, iter(deliverables))
+                    for build_instruction_id, _, deliverables in tier]
+            while tier:
+                for item in list(tier):
+                    deliverable = next(item[1], None)
+                    if deliverable is None:
+                        tier.remove(item)
+                    else:
+                        expected = [member.expected_duration for member in [deliverable] + deliverable.group
+                                    if member.expected_duration is not None]
+                        if expected:
+                            queued.append(((item[0], deliverable.id), sum(expected), None))
+
+        # Build instructions that were not parsed yet are estimated
+        # with the deliverables that were built for them before.
+        for build_instruction in self.scheduler.order_build_instructions(scheduled):
+            key = (build_instruction['product'], build_instruction['docset'],
+                   build_instruction['lang'])
+            prepare = ('prepare', build_instruction['id'])
+            queued.append((prepare, self.history.expected_build_instruction(*key, 'prepare'), None))
+            for n, expected in enumerate(self.history.known_deliverables(*key)):
+                queued.append(((build_instruction['id'], n), expected, prepare))
+
+        predictions = predict_schedule(self.worker_count, running, queued, now)
+
+        def predict_build_instruction(build_instruction, refs):
+            times = [predictions[ref] for ref in refs if ref in predictions]
+            if not times:
+                return (None, None)
+            return (min(start for start, _ in times),
+                    max(finish for _, finish in times) + self.history.expected_build_instruction(
+                        build_instruction['product'], build_instruction['docset'],
+                        build_instruction['lang'], 'cleanup'))
+
+        for build_instruction_id, bih in bihs:
+            with bih.deliverables_open_lock:
+                for deliverable_id, deliverable in bih.deliverables.items():
+                    if deliverable['status'] != 'building':
+                        continue
+                    # All formats of a group are built at the same time.
+                    leader_id = (deliverable.get('group') or [deliverable_id])[0]
+                    deliverable['predicted_start'], deliverable['predicted_finish'] = predictions.get(
+                        (build_instruction_id, leader_id), (None, None))
+                build_instruction = bih.build_instruction
+                build_instruction['predicted_start'], build_instruction['predicted_finish'] = predict_build_instruction(
+                    build_instruction,
+                    [(build_instruction_id, deliverable_id) for deliverable_id in bih.deliverables])
+        for build_instruction in scheduled:
+            build_instruction['predicted_start'], build_instruction['predicted_finish'] = predict_build_instruction(
+                build_instruction,
+                [('prepare', build_instruction['id'])] +
+                [ref for ref in predictions if ref[0] == build_instruction['id']])
+        return predictions
+
+    def statistics(self):
+        """
+        Numbers for capacity planning: the build duration history and
+        how much work is queued.
+        """
+        now = time.time()
+        predictions = self.update_predictions()
+        finish = max([now] + [finish for _, finish in predictions.values()])
+        with self.work_condition:
+            slots = self.slots.dict() if self.slots else {}
+        return {
+            'workers': self.worker_count,
+            'slots': slots,
+            'durations': self.history.statistics(),
+            'backlog': sum(finish - max(now, start) for start, finish in predictions.values()),
+            'predicted_idle': finish,
+            'repositories': self.repo_cache.pool_statistics() if self.repo_cache else {},
+            'artifacts': self.artifacts.dict() if self.artifacts else {},
+            'publishing': self.publisher.dict() if self.publisher else {},
+            'container_image': self.image.dict() if self.image else {},
+        }
+
     def generate_id(self, build_instruction):
         """
         Generate a unique ID for a build instruction by hashing
@@ -107,34 +322,176 @@ class DocservState:
     def queue_build_instruction(self, build_instruction):
         """
         Puts newly arrived build instructions in a dict that queues
-        build instructions.
+        build instructions. If the build instruction is already queued,
+        nothing needs to be done, because the latest commit will be
+        built anyway. If it is already being built, it is marked for
+        a rebuild that starts as soon as the current build is finished.
+        Any number of repeated build instructions results in at most one
+        rebuild.
         """
         retval = False
+        pending = False
+        preempt = None
         build_instruction['id'] = self.generate_id(build_instruction)
+        # Repositories fetched after this time contain all changes that
+        # this build instruction was sent for.
+        build_instruction['queued'] = time.time()
         if build_instruction['id'] in self.past_builds.keys():
             with self.past_builds_lock:
-                build_instruction = self.past_builds.pop(
+                previous_build_instruction = self.past_builds.pop(
                     build_instruction['id'])
+            # Keep the results of the previous build but use the
+            # priority that was sent with the new build instruction.
+            previous_build_instruction.pop('priority', None)
+            previous_build_instruction.pop('finished', None)
+            previous_build_instruction.pop('rebuild_pending', None)
+            previous_build_instruction.pop('status', None)
+            previous_build_instruction.pop('container_image', None)
+            previous_build_instruction.pop('publish_status', None)
+            previous_build_instruction.update(build_instruction)
+            build_instruction = previous_build_instruction
         with self.bih_dict_lock:
-            if build_instruction['id'] not in self.bih_dict:
+            if build_instruction['id'] in self.bih_dict:
+                bih = self.bih_dict[build_instruction['id']]
+                bih.build_instruction['rebuild_pending'] = True
+                pending = True
+                if self.is_obsolete(bih, build_instruction):
+                    preempt = bih
+            else:
                 with self.scheduled_build_instruction_lock:
-                    if build_instruction['id'] not in self.scheduled_build_instruction:
+                    if build_instruction['id'] in self.updating_build_instruction:
+                        # The repository may already have been updated
+                        self.scheduled_build_instruction[build_instruction['id']]['rebuild_pending'] = True
+                        pending = True
+                    elif build_instruction['id'] not in self.scheduled_build_instruction:
                         self.scheduled_build_instruction[build_instruction['id']
                                                          ] = build_instruction
                         retval = True
+            if pending:
+                self.pending_rebuilds[build_instruction['id']] = build_instruction
+        if preempt is not None:
+            logger.info("Preempting obsolete build of build instruction %s",
+                        build_instruction['id'])
+            preempt.cancel()
+            self.notify_workers()
+        if pending:
+            logger.info("Build instruction %s is already building, rebuilding it afterwards",
+                        build_instruction['id'])
+            self.record_state(build_instruction['id'])
+            retval = True
+        if retval and not pending:
+            self.notify_workers(everyone=False)
+            self.record_state(build_instruction['id'])
         return retval
 
+    def is_obsolete(self, bih, build_instruction):
+        """
+        With the preempt_obsolete_builds policy, a running build is
+        obsolete when the same build instruction arrives again, unless
+        it names the commit that is being built already.
+        """
+        if self.config['server'].get('preempt_obsolete_builds') != 'yes':
+            return False
+        commit = build_instruction.get('commit')
+        return commit is None or commit != bih.build_instruction.get('commit')
+
+    def cancel_build_instruction(self, build_instruction_id):
+        """
+        Cancel a build instruction. A scheduled build instruction is
+        moved to the past builds right away. Of a build instruction that
+        is building, the open deliverables are dropped and the running
+        ones are killed, it is finished by a worker as usual. A pending
+        rebuild is dropped as well.
+        Returns False if the build instruction is not queued or building.
+        """
+        bih = None
+        scheduled = None
+        found = True
+        with self.bih_dict_lock:
+            self.pending_rebuilds.pop(build_instruction_id, None)
+            if build_instruction_id in self.bih_dict:
+                bih = self.bih_dict[build_instruction_id]
+                bih.build_instruction.pop('rebuild_pending', None)
+            else:
+                with self.scheduled_build_instruction_lock:
+                    if build_instruction_id in self.updating_build_instruction:
+                        # The BIH is being created right now,
+                        # parse_build_instruction cancels it.
+                        self.scheduled_build_instruction[build_instruction_id]['cancel_requested'] = True
+                        self.scheduled_build_instruction[build_instruction_id].pop('rebuild_pending', None)
+                    elif build_instruction_id in self.scheduled_build_instruction:
+                        scheduled = self.scheduled_build_instruction.pop(
+                            build_instruction_id)
+                    else:
+                        found = False
+        if not found:
+            return False
+        if bih is not None:
+            bih.cancel()
+            self.notify_workers()
+        elif scheduled is not None:
+            logger.info("Cancelled scheduled build instruction %s", build_instruction_id)
+            scheduled['status'] = 'cancelled'
+            scheduled['finished'] = time.time()
+            with self.past_builds_lock:
+                archived = self.past_builds.add(scheduled)
+            for archived_id in archived:
+                self.record_state(archived_id)
+        self.record_state(build_instruction_id)
+        return True
+
+    def cancel_deliverable(self, build_instruction_id, deliverable_id):
+        """
+        Cancel a single deliverable of a build instruction that is
+        building. Returns False if there is no such deliverable or it is
+        finished already.
+        """
+        with self.bih_dict_lock:
+            bih = self.bih_dict.get(build_instruction_id)
+        if bih is None or not bih.cancel(deliverable_id):
+            return False
+        self.notify_workers()
+        self.record_state(build_instruction_id)
+        return True
+
+    def queue_pending_rebuild(self, build_instruction_id):
+        """
+        After a build instruction is finished or aborted, queue it again
+        if it was requested again in the meantime.
+        """
+        with self.bih_dict_lock:
+            build_instruction = self.pending_rebuilds.pop(build_instruction_id, None)
+        if build_instruction is not None:
+            logger.info("Queueing pending rebuild of build instruction %s",
+                        build_instruction_id)
+            self.queue_build_instruction(build_instruction)
+
+    def notify_workers(self, everyone=True):
+        """
+        Wake up idle workers after new work has become available.
+        """
+        with self.work_condition:
+            if everyone:
+                self.work_condition.notify_all()
+            else:
+                self.work_condition.notify()
+
     def get_scheduled_build_instruction(self):
         """
         Get a build instruction that has been queued after input on
-        the REST API.
+        the REST API. The scheduler decides which one comes first.
         """
         with self.scheduled_build_instruction_lock:
-            for key in self.scheduled_build_instruction:
-                if key not in self.updating_build_instruction:
-                    self.updating_build_instruction.append(key)
-                    return self.scheduled_build_instruction[key]
-        return None
+            build_instructions = [
+                self.scheduled_build_instruction[key]
+                for key in self.scheduled_build_instruction
+                if key not in self.updating_build_instruction]
+            if not build_instructions:
+                return None
+            build_instruction = self.scheduler.select_build_instruction(
+                build_instructions)
+            self.updating_build_instruction.append(build_instruction['id'])
+            return build_instruction
 
     def remove_scheduled_build_instruction(self, build_instruction_id):
         """
@@ -153,6 +510,8 @@ class DocservState:
         it from the queued build instructions.
         """
         logger.info("Aborting build instruction %s", build_instruction_id)
+        with self.work_condition:
+            self.scheduler.build_instruction_finished(build_instruction_id)
         with self.scheduled_build_instruction_lock:
             self.updating_build_instruction.remove(build_instruction_id)
             build_instruction = self.scheduled_build_instruction.pop(
@@ -162,8 +521,14 @@ class DocservState:
                 build_instruction = self.bih_dict.pop(
                     build_instruction_id).dict()
         if build_instruction is not None:
+            if build_instruction.pop('cancel_requested', False):
+                build_instruction['status'] = 'cancelled'
+            build_instruction['finished'] = time.time()
             with self.past_builds_lock:
-                self.past_builds[build_instruction_id] = build_instruction
+                archived = self.past_builds.add(build_instruction)
+            for archived_id in archived:
+                self.record_state(archived_id)
+        self.queue_pending_rebuild(build_instruction_id)
 
     def finish_build_instruction(self, build_instruction_id):
         """
@@ -171,75 +536,198 @@ class DocservState:
         BuildInstructionHandler into the past_builds dict.
         """
         logger.info("Finished build instruction %s", build_instruction_id)
+        with self.work_condition:
+            self.scheduler.build_instruction_finished(build_instruction_id)
         self.bih_dict[build_instruction_id].cleanup()
         with self.bih_dict_lock:
             build_instruction = self.bih_dict.pop(build_instruction_id)
+        build_instruction = build_instruction.dict()
+        build_instruction['finished'] = time.time()
         with self.past_builds_lock:
-            self.past_builds[build_instruction_id] = build_instruction.dict()
+            archived = self.past_builds.add(build_instruction)
+        for archived_id in archived:
+            self.record_state(archived_id)
+        self.queue_pending_rebuild(build_instruction_id)
+
+    def get_deliverable(self, build=True, publish=True):
+        """
+        Get a deliverable from one of the BIHs in the bih_queue (currently
+        building BIHs). The scheduler decides which BIH and which of its
+        deliverables come next. If a BIH has no more deliverables and none
+        are building, it is removed from the queue and 'done' is returned
+        together with its ID, so it can be finished.
+        build and publish tell if there is a free slot for building a
+        deliverable and for finishing a BIH.
+        Must be called with work_condition held.
+        """
+        bihs = []
+        for build_instruction_id in self.bih_queue:
+            with self.bih_dict_lock:
+                bih = self.bih_dict[build_instruction_id]
+            if bih.is_done():
+                if publish:
+                    self.bih_queue.remove(build_instruction_id)
+                    return ('done', build_instruction_id)
+            elif build and bih.has_open_deliverables():
+                bihs.append((build_instruction_id, bih))
+        if not bihs:
+            return None
+        build_instruction_id = self.scheduler.select_bih(bihs)
+        bih = dict(bihs)[build_instruction_id]
+        deliverable = bih.get_deliverable(self.scheduler.select_deliverable)
+        self.scheduler.deliverable_started(build_instruction_id, bih, deliverable)
+        return ('deliverable', deliverable)
+
+    def next_task(self):
+        """
+        Return the next task for a worker and the slot it takes, or None
+        if there is nothing to do or no free slot for it. New build
+        instructions have precedence over deliverables.
+        Must be called with work_condition held.
+        """
+        task = None
+        if self.slots.available('git'):
+            build_instruction = self.get_scheduled_build_instruction()
+            if build_instruction is not None:
+                task = ('build_instruction', build_instruction)
+        if task is None:
+            task = self.get_deliverable(self.slots.available('build'),
+                                        self.slots.available('publish'))
+        if task is None:
+            return None
+        kind = {'build_instruction': 'git', 'deliverable': 'build', 'done': 'publish'}[task[0]]
+        return task + ((kind, self.slots.acquire(kind)),)
 
-    def get_deliverable(self, thread_id):
+    def update_container_image(self):
         """
-        Get an ID from the bih_queue (currently building BIHs). With that
-        get a deliverable from the BIH itself. If no more deliverables are
-        available, the BIH is finished.
+        Pull the container image. Build instructions that are building
+        keep the image they started with.
+        """
+        return self.image.update_image()
+
+    def docset_relative_path(self, target, product, docset, lang):
         """
+        Path of a docset relative to the backup path of its target, None
+        if the target, language, product or docset is not configured.
+        The values come from REST requests, so they must not lead
+        outside of the backup path.
+        """
+        if target not in self.config['targets']:
+            return None
+        if lang not in self.config['server']['valid_languages'].split():
+            return None
+        if not valid_name(product) or not valid_name(docset):
+            return None
+        stitch_tmp_file = os.path.join(self.stitch_tmp_dir,
+                                       'productconfig_simplified_%s.xml' % target)
         try:
-            build_instruction_id = self.bih_queue.get(False)
-        except queue.Empty:
+            tree = etree.parse(stitch_tmp_file)
+        except (OSError, etree.XMLSyntaxError):
             return None
-        else:
-            deliverable = self.bih_dict[build_instruction_id].get_deliverable()
-            if deliverable == 'done':
-                self.finish_build_instruction(build_instruction_id)
-                deliverable = None
-            else:  # build instruction is not yet finished, put its ID back on the queue
-                self.bih_queue.put(build_instruction_id)
-        return deliverable
+        if not tree.xpath("//product[@productid=$product]/docset[@setid=$docset]",
+                          product=product, docset=docset):
+            return None
+        return os.path.join(lang, product, docset)
+
+    def docset_generations(self, target, product, docset, lang):
+        """
+        The generations of a docset in the backup path and the live one,
+        None if the docset does not exist.
+        """
+        docset_relative_path = self.docset_relative_path(target, product, docset, lang)
+        if docset_relative_path is None:
+            return None
+        return self.publisher.generations(self.config['targets'][target]['backup_path'],
+                                          docset_relative_path)
+
+    def rollback(self, target, product, docset, lang, generation=None):
+        """
+        Make an older generation of a docset live and publish it. Returns
+        its name, or None if there is no such generation.
+        """
+        docset_relative_path = self.docset_relative_path(target, product, docset, lang)
+        if docset_relative_path is None:
+            return None
+        if generation is not None and not valid_name(generation):
+            return None
+        return self.publisher.rollback(target, self.config['targets'][target],
+                                       docset_relative_path, generation)
+
+    def get_build_instruction_state(self, build_instruction_id):
+        """
+        Return the dict of a build instruction, no matter if it is
+        scheduled, building or finished, or None if it does not exist.
+        """
+        with self.scheduled_build_instruction_lock:
+            if build_instruction_id in self.scheduled_build_instruction:
+                return self.scheduled_build_instruction[build_instruction_id]
+        with self.bih_dict_lock:
+            bih = self.bih_dict.get(build_instruction_id)
+        if bih is not None:
+            return bih.dict()
+        with self.past_builds_lock:
+            return self.past_builds.get(build_instruction_id)
+
+    def record_state(self, build_instruction_id):
+        """
+        Append the current state of a build instruction to the state
+        journal. This must be called after every change of a build
+        instruction and must not be called while holding one of the
+        other locks.
+        """
+        if self.journal.record(build_instruction_id, self.get_build_instruction_state):
+            self.save_state()
 
     def save_state(self):
         """
-        Save status to JSON file.
-        The JSON file usually resides in /var/cache/docserv/[SERVER_NAME].json
+        Save status to a JSON snapshot and start a new state journal.
+        The files usually reside in /var/cache/docserv/[SERVER_NAME].json
+        and /var/cache/docserv/[SERVER_NAME].journal
         """
-        f = open(os.path.join(CACHE_DIR, self.config['server']['name'] + '.json'), "w")
-        f.write(json.dumps(self.dict()))
+        self.journal.compact(self.dict)
 
     def load_state(self):
         """
-        Load status from JSON file.
-        The JSON file usually resides in /var/cache/docserv/[SERVER_NAME].json
+        Load status from the JSON snapshot and replay the state journal.
+        The files usually reside in /var/cache/docserv/[SERVER_NAME].json
+        and /var/cache/docserv/[SERVER_NAME].journal
         """
         logger.info("Reading previous state.")
-        filepath = os.path.join(CACHE_DIR, self.config['server']['name'] + '.json')
-        if os.path.isfile(filepath):
-            file = open(filepath, "r")
-            try:
-                state = json.loads(file.read())
-            except json.decoder.JSONDecodeError:
-                return False
-            for build_instruction in state:
-                if ('building' in build_instruction and len(build_instruction['building']) > 0) or ('open' in build_instruction and len(build_instruction['open']) > 0):
-                    self.queue_build_instruction(build_instruction)
-                else:
-                    self.past_builds[build_instruction['id']
-                                     ] = build_instruction
-            return True
-        return False
+        state = self.journal.load()
+        past_builds = []
+        for build_instruction in state.values():
+            if ('building' in build_instruction and len(build_instruction['building']) > 0) or ('open' in build_instruction and len(build_instruction['open']) > 0):
+                self.queue_build_instruction(build_instruction)
+            else:
+                past_builds.append(build_instruction)
+        # Past builds that exceed the retention limits are archived
+        # and left out of the new snapshot.
+        self.past_builds.load(past_builds)
+        # Start with a compact snapshot and an empty journal
+        self.save_state()
+        return len(state) > 0
 
-    def parse_build_instruction(self, thread_id):
-        build_instruction = self.get_scheduled_build_instruction()
-        if build_instruction is not None:
-            myBIH = BuildInstructionHandler(
-                build_instruction, self.config, self.stitch_tmp_dir, self.gitLocks, self.gitLocksLock, thread_id)
-            # If the initialization failed, immediately delete the BuildInstructionHandler
-            if myBIH.initialized == False:
-                self.abort_build_instruction(build_instruction['id'])
-                return
-            myBIH.generate_deliverables()
-            self.remove_scheduled_build_instruction(build_instruction['id'])
-            with self.bih_dict_lock:
-                self.bih_dict[build_instruction['id']] = myBIH
-            self.bih_queue.put(build_instruction['id'])
+    def parse_build_instruction(self, build_instruction, thread_id):
+        myBIH = BuildInstructionHandler(
+            build_instruction, self.config, self.stitch_tmp_dir, self.gitLocks, self.gitLocksLock, thread_id,
+            self.history, self.repo_cache, self.artifacts, self.image, self.publisher)
+        # If the initialization failed, immediately delete the BuildInstructionHandler
+        if myBIH.initialized == False:
+            self.abort_build_instruction(build_instruction['id'])
+            return
+        myBIH.generate_deliverables()
+        # Add the BIH before removing the scheduled build instruction,
+        # so a build instruction that arrives in between is recognized
+        # as already building.
+        with self.bih_dict_lock:
+            self.bih_dict[build_instruction['id']] = myBIH
+            cancel = build_instruction.pop('cancel_requested', False)
+        self.remove_scheduled_build_instruction(build_instruction['id'])
+        if cancel:
+            myBIH.cancel()
+        with self.work_condition:
+            self.bih_queue.append(build_instruction['id'])
+            self.work_condition.notify_all()
 
 
 class DocservConfig:
@@ -270,6 +758,59 @@ class DocservConfig:
             self.config['server']['valid_languages'] = config['server']['valid_languages']
             self.config['server']['max_threads'] = int(
                 config['server']['max_threads'])
+            self.config['server']['scheduler'] = config['server'].get(
+                'scheduler', 'roundrobin')
+            if self.config['server']['scheduler'] not in SCHEDULERS:
+                logger.warning("Invalid configuration file, unknown scheduler '%s'. Exiting.",
+                               self.config['server']['scheduler'])
+                sys.exit(1)
+            self.config['server']['target_priorities'] = config['server'].get(
+                'target_priorities', '')
+            self.config['server']['product_priorities'] = config['server'].get(
+                'product_priorities', '')
+            self.config['server']['language_priorities'] = config['server'].get(
+                'language_priorities', '')
+            self.config['server']['journal_max_records'] = int(config['server'].get(
+                'journal_max_records', 1000))
+            self.config['server']['past_builds_max_count'] = int(config['server'].get(
+                'past_builds_max_count', 1000))
+            self.config['server']['past_builds_max_age'] = int(config['server'].get(
+                'past_builds_max_age', 90))
+            self.config['server']['preempt_obsolete_builds'] = config['server'].get(
+                'preempt_obsolete_builds', 'no')
+            self.config['server']['repo_fetch_freshness'] = int(config['server'].get(
+                'repo_fetch_freshness', 0))
+            self.config['server']['checkout_pool_size'] = int(config['server'].get(
+                'checkout_pool_size', 0))
+            self.config['server']['sparse_checkout'] = config['server'].get(
+                'sparse_checkout', 'yes')
+            self.config['server']['incremental_builds'] = config['server'].get(
+                'incremental_builds', 'no')
+            self.config['server']['group_formats'] = config['server'].get(
+                'group_formats', 'yes')
+            self.config['server']['artifact_cache_size'] = int(config['server'].get(
+                'artifact_cache_size', 0))
+            self.config['server']['container_engine'] = config['server'].get(
+                'container_engine', 'docker')
+            self.config['server']['container_image'] = config['server'].get(
+                'container_image',
+                'registry.opensuse.org/documentation/containers/containers/opensuse-daps-toolchain:latest')
+            for key in ('build_slots', 'git_slots', 'publish_slots', 'cpu_budget', 'build_cpus'):
+                self.config['server'][key] = int(config['server'].get(key, 0))
+            self.config['server']['step_timeout'] = int(config['server'].get(
+                'step_timeout', 0))
+            self.config['server']['container_runner'] = config['server'].get(
+                'container_runner', 'd2d_runner')
+            self.config['server']['container_update_interval'] = float(config['server'].get(
+                'container_update_interval', 24))
+            self.config['server']['full_sync_interval'] = float(config['server'].get(
+                'full_sync_interval', 24))
+            self.config['server']['publish_batch_window'] = float(config['server'].get(
+                'publish_batch_window', 0))
+            self.config['server']['publish_batch_size'] = int(config['server'].get(
+                'publish_batch_size', 10))
+            self.config['server']['generations_kept'] = int(config['server'].get(
+                'generations_kept', 3))
             self.config['targets'] = {}
             for section in config.sections():
                 if not str(section).startswith("target_"):
@@ -315,6 +856,27 @@ class Docserv(DocservState, DocservConfig):
                      2: logging.DEBUG,
                      }
         logger.setLevel(LOGLEVELS[self.config['server']['loglevel']])
+        self.history = DurationHistory(self.config['server']['name'])
+        self.scheduler = create_scheduler(self.config, self.history)
+        self.slots = Slots(self.config)
+        self.repo_cache = RepoCache(self.config, self.gitLocks, self.gitLocksLock)
+        if self.config['server']['artifact_cache_size'] > 0:
+            self.artifacts = ArtifactStore(self.config['server']['name'],
+                                           self.config['server']['artifact_cache_size'] * 1024 * 1024)
+        self.image = ContainerImage(self.config['server']['container_engine'],
+                                    self.config['server']['container_image'])
+        self.publisher = Publisher(self.config['server']['name'],
+                                   self.config['server']['full_sync_interval'] * 3600,
+                                   self.config['server']['publish_batch_window'],
+                                   self.config['server']['publish_batch_size'],
+                                   self.config['server']['step_timeout'] or None)
+        self.publisher.on_published = self.record_state
+        self.journal = StateJournal(self.config['server']['name'],
+                                    self.config['server']['journal_max_records'])
+        self.past_builds = PastBuilds(
+            self.config['server']['name'],
+            self.config['server']['past_builds_max_count'],
+            self.config['server']['past_builds_max_age'] * 86400 or None)
         self.load_state()
 
     def start(self):
@@ -361,7 +923,13 @@ class Docserv(DocservState, DocservConfig):
             thread_receive = threading.Thread(target=self.listen)
             thread_receive.start()
             workers = []
-            for i in range(0, min([os.cpu_count(), self.config['server']['max_threads']])):
+            # Workers mostly wait for containers, git and rsync, so
+            # there is a worker for every slot, see slots.py.
+            self.worker_count = self.slots.builds()
+            if self.config['server']['container_update_interval'] > 0:
+                self.image.schedule_updates(
+                    self.config['server']['container_update_interval'] * 3600)
+            for i in range(0, self.slots.workers()):
                 logger.info("Starting build thread %i", i)
                 worker = threading.Thread(target=self.worker, args=(i,))
                 worker.start()
@@ -372,36 +940,65 @@ class Docserv(DocservState, DocservConfig):
             self.exit()
         for worker in workers:
             worker.join()
+        # don't leave finished build instructions unpublished
+        self.publisher.flush()
         self.rest.shutdown()
+        self.image.shutdown()
         self.save_state()
 
     def exit(self):
         logger.warning(
             "Received SIGINT. Telling all threads to end. Please wait.")
         self.end_all.put("now")
+        self.notify_workers()
 
     def worker(self, thread_id):
         while(True):
-            # 1. parse input from rest api and put the instance of the doc class on the currently building queue
-            self.parse_build_instruction(thread_id)
-
-            # 2. get doc from currently_building queue and then a deliverable from doc.
-            #    after that, put doc back on the currently building queue. unless it was
-            #    the last deliverable.
-            deliverable = self.get_deliverable(thread_id)
-            if deliverable is not None:
-                deliverable.run(thread_id)
-
-            # 3. end thread if sigint
-            if not self.end_all.empty():
-                return True
+            # 1. sleep until there is something to do or until we are
+            #    told to end (sigint)
+            with self.work_condition:
+                while True:
+                    if not self.end_all.empty():
+                        return True
+                    task = self.next_task()
+                    if task is not None:
+                        break
+                    self.work_condition.wait()
+            kind, payload, slot = task
 
-            # 4. wait for a short while, then repeat
-            time.sleep(0.1)
+            # 2. parse input from rest api and put the instance of the doc class
+            #    on the currently building queue, or build a deliverable, or
+            #    clean up after the last deliverable of a BIH has finished.
+            build_instruction_id = None
+            try:
+                if kind == 'build_instruction':
+                    build_instruction_id = payload['id']
+                    self.parse_build_instruction(payload, thread_id)
+                elif kind == 'deliverable':
+                    build_instruction_id = payload.parent.build_instruction['id']
+                    self.record_state(build_instruction_id)
+                    payload.run(thread_id)
+                else:
+                    build_instruction_id = payload
+                    self.finish_build_instruction(payload)
+            except Exception:
+                # The worker keeps running, an error must not take the
+                # slot and the thread with it.
+                logger.exception("Thread %i: %s failed", thread_id, kind)
+            finally:
+                # 3. give back the slot, another worker can use it now
+                with self.work_condition:
+                    self.slots.release(*slot, build_time=(
+                        payload.build_time if kind == 'deliverable' else 0.0))
+                    self.work_condition.notify_all()
 
-            # Thread 0 is frequently saving the state
-            if thread_id == 0:
-                self.save_state()
+            # 4. the state has changed, journal it
+            if build_instruction_id is not None:
+                try:
+                    self.record_state(build_instruction_id)
+                except Exception:
+                    logger.exception("Thread %i: Could not record the state of %s",
+                                     thread_id, build_instruction_id)
 
     def listen(self):
         server_address = (self.config['server']['host'], int(
@@ -435,4 +1032,5 @@ def main():
         sys.exit(0)
 
 
-main()
+if __name__ == "__main__":
+    main()
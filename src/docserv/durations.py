@@ -0,0 +1,212 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+from docserv.functions import write_atomically
+
+logger = logging.getLogger('docserv')
+
+CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
+
+# Weight of the newest measurement in the moving averages.
+SMOOTHING = 0.3
+
+
+def moving_average(average, value):
+    if average is None:
+        return value
+    return (1 - SMOOTHING) * average + SMOOTHING * value
+
+
+class DurationHistory:
+    """
+    Persistent history of build durations. For deliverables, it is
+    keyed by (product, docset, lang, dc, format) and keeps a moving
+    average of the total duration and of each build step (d2d_runner,
+    rsync, extract_root_id, ...). For build instructions, it is keyed
+    by (product, docset, lang) and keeps the duration of preparing the
+    repository and of the clean up.
+
+    The history is used to predict when queued work will be finished
+    and by schedulers to order deliverables by expected cost.
+    The JSON file usually resides in
+    /var/cache/docserv/[SERVER_NAME]-durations.json
+    """
+
+    def __init__(self, server_name):
+        self.path = os.path.join(CACHE_DIR, server_name + '-durations.json')
+        self.lock = threading.Lock()
+        self.deliverables = {}
+        self.build_instructions = {}
+        # Sums and counts of averages for estimating deliverables
+        # that have never been built: per (product, docset, dc, format),
+        # i.e. the same document in another language, and per format.
+        self.by_document = {}
+        self.by_format = {}
+        self.load()
+
+    @staticmethod
+    def key(*parts):
+        return '/'.join(parts)
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            logger.warning("Could not read build duration history %s", self.path)
+            return
+        self.deliverables = history.get('deliverables', {})
+        self.build_instructions = history.get('build_instructions', {})
+        for key, entry in self.deliverables.items():
+            self.update_index(key, entry['mean'], 1)
+
+    def save(self):
+        """
+        Write the history to disk. Must be called with self.lock held.
+        """
+        write_atomically(self.path, json.dumps({
+            'deliverables': self.deliverables,
+            'build_instructions': self.build_instructions}))
+
+    def update_index(self, key, duration, count):
+        """
+        Add a duration (or remove one, with negative values) to the
+        averages per document and per format.
+        """
+        product, docset, _, dc, build_format = key.split('/')
+        for index, index_key in ((self.by_document, (product, docset, dc, build_format)),
+                                 (self.by_format, build_format)):
+            total, n = index.get(index_key, (0.0, 0))
+            index[index_key] = (total + duration, n + count)
+
+    def record_deliverable(self, product, docset, lang, dc, build_format, steps):
+        """
+        Record the durations (in seconds) of the steps of a successful
+        deliverable build.
+        """
+        key = self.key(product, docset, lang, dc, build_format)
+        total = sum(steps.values())
+        with self.lock:
+            entry = self.deliverables.get(key)
+            if entry is None:
+                entry = {'count': 0, 'mean': None, 'steps': {}}
+            else:
+                self.update_index(key, -entry['mean'], -1)
+            entry['count'] += 1
+            entry['mean'] = moving_average(entry['mean'], total)
+            entry['last'] = total
+            entry['updated'] = time.time()
+            for step, seconds in steps.items():
+                entry['steps'][step] = moving_average(entry['steps'].get(step), seconds)
+            self.deliverables[key] = entry
+            self.update_index(key, entry['mean'], 1)
+            self.save()
+
+    def record_build_instruction(self, product, docset, lang, step, seconds):
+        """
+        Record how long a stage ('prepare' or 'cleanup') of a build
+        instruction took.
+        """
+        key = self.key(product, docset, lang)
+        with self.lock:
+            entry = self.build_instructions.setdefault(key, {})
+            entry[step] = moving_average(entry.get(step), seconds)
+            self.save()
+
+    def expected_deliverable(self, product, docset, lang, dc, build_format):
+        """
+        Expected duration of a deliverable build in seconds. Falls back
+        to the same document in other languages, then to the average of
+        the format and then to the average of all deliverables.
+        Returns None if nothing was ever built.
+        """
+        with self.lock:
+            entry = self.deliverables.get(self.key(product, docset, lang, dc, build_format))
+            if entry is not None:
+                return entry['mean']
+            for index, index_key in ((self.by_document, (product, docset, dc, build_format)),
+                                     (self.by_format, build_format)):
+                total, n = index.get(index_key, (0.0, 0))
+                if n > 0:
+                    return total / n
+            total = sum(total for total, _ in self.by_format.values())
+            n = sum(n for _, n in self.by_format.values())
+            if n > 0:
+                return total / n
+        return None
+
+    def expected_build_instruction(self, product, docset, lang, step):
+        """
+        Expected duration of a build instruction stage in seconds, 0 if
+        unknown.
+        """
+        with self.lock:
+            return self.build_instructions.get(
+                self.key(product, docset, lang), {}).get(step, 0.0)
+
+    def known_deliverables(self, product, docset, lang):
+        """
+        Expected durations of all deliverables that were built for a
+        build instruction before. Used to estimate build instructions
+        that have not been parsed yet.
+        """
+        prefix = self.key(product, docset, lang) + '/'
+        with self.lock:
+            return [entry['mean'] for key, entry in self.deliverables.items()
+                    if key.startswith(prefix)]
+
+    def statistics(self):
+        """
+        Summary of the history for capacity planning.
+        """
+        with self.lock:
+            by_format = {}
+            for build_format, (total, n) in self.by_format.items():
+                by_format[build_format] = {'deliverables': n,
+                                           'average_duration': total / n if n else None,
+                                           'total_duration': total}
+            return {
+                'deliverables': len(self.deliverables),
+                'total_duration': sum(entry['mean'] for entry in self.deliverables.values()),
+                'by_format': by_format,
+            }
+
+
+def predict_schedule(workers, running, queued, now):
+    """
+    Predict start and finish times of jobs by simulating how the
+    workers take them up one after another.
+
+    workers -- number of worker threads
+    running -- list of (ref, start_time, expected_duration) of jobs
+               that are being built right now
+    queued  -- list of (ref, expected_duration, after) of jobs in the
+               order they will probably be taken up; after is the ref of
+               an earlier job that must be finished before this job can
+               start, or None
+    Returns a dict that maps each ref to (predicted_start, predicted_finish).
+    """
+    predictions = {}
+    workers = max(1, workers)
+    free_at = []
+    for ref, start, expected in running:
+        finish = max(now, start + expected)
+        predictions[ref] = (start, finish)
+        free_at.append(finish)
+    free_at.sort()
+    free_at = free_at[:workers] + [now] * max(0, workers - len(free_at))
+    heapq.heapify(free_at)
+    for ref, expected, after in queued:
+        start = heapq.heappop(free_at)
+        if after in predictions:
+            start = max(start, predictions[after][1])
+        finish = start + expected
+        predictions[ref] = (start, finish)
+        heapq.heappush(free_at, finish)
+    return predictions
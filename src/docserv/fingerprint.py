@@ -0,0 +1,44 @@
+import hashlib
+import json
+import logging
+import subprocess
+
+logger = logging.getLogger('docserv')
+
+
+def fingerprint(inputs):
+    """
+    Hash a dict of build inputs. Two builds with the same fingerprint
+    produce the same output.
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_hash(path):
+    """
+    SHA-256 of the contents of a file, '' if it cannot be read.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return ''
+
+
+def tree_hashes(repo_dir, commit, paths):
+    """
+    Git tree hashes of directories (relative to the repository root) in
+    a commit. Returns a dict that maps each path to its hash, or None if
+    git failed.
+    """
+    if not paths:
+        return {}
+    paths = sorted(paths)
+    cmd = ["git", "-C", repo_dir, "rev-parse"] + ["%s:%s" % (commit, path) for path in paths]
+    s = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = s.communicate()
+    if s.returncode != 0:
+        logger.warning("Could not get tree hashes for %s: %s", commit, err.decode('utf-8'))
+        return None
+    return dict(zip(paths, out.decode('utf-8').split()))
+
@@ -49,6 +49,41 @@ def feedback_message(text, subject, to, send_mail = False):
         msg.write('To:      %s\nSubject: %s\n\n%s' % (to, subject, text))
         msg.close()
 
+def fsync_dir(path):
+    """
+    Make sure a rename in a directory is on disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomically(path, text):
+    """
+    Write text to a temporary file in the same directory, sync it and
+    move it over path. Readers and crashes either see the old or the
+    new file, never a half-written one.
+    """
+    directory = os.path.dirname(path)
+    handle, tmp_path = tempfile.mkstemp(dir=directory,
+                                        prefix='.%s_' % os.path.basename(path))
+    try:
+        # mkstemp creates files that only the owner can read
+        os.chmod(tmp_path, 0o644)
+        with open(handle, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(directory)
+
+
 def print_help():
     print("""This is a daemon. Invoke it with either of the following commands:
 
@@ -0,0 +1,181 @@
+"""
+Versioned publication of docsets in the backup path. The output of each
+build instruction is written into a new generation directory
+
+  [BACKUP_PATH]/.docserv-generations/[LANG]/[PRODUCT]/[DOCSET]/[GENERATION]/
+
+and [BACKUP_PATH]/[LANG]/[PRODUCT]/[DOCSET] is a relative symbolic link
+to the live generation. Replacing the link makes a generation live at
+once, so readers never see a half-written docset, and switching back to
+an older generation is a rollback.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('docserv')
+
+GENERATIONS_DIR = '.docserv-generations'
+
+# Name of the generation a docset directory of an older version of
+# Docserv² is moved to. It sorts before all other generations.
+LEGACY_GENERATION = '00000000T000000-legacy'
+
+
+def valid_name(name):
+    """
+    True if name can be used as a single component of a path below the
+    backup path: a product, docset, language or generation.
+    """
+    return (isinstance(name, str) and name not in ('', '.', '..')
+            and '/' not in name and '\0' not in name)
+
+
+def generations_dir(backup_path, docset_relative_path):
+    return os.path.join(backup_path, GENERATIONS_DIR, docset_relative_path)
+
+
+def new_generation(backup_path, docset_relative_path):
+    """
+    Create an empty generation directory, returns its name. Names sort
+    in the order the generations were created.
+    """
+    parent = generations_dir(backup_path, docset_relative_path)
+    os.makedirs(parent, exist_ok=True)
+    now = time.time()
+    prefix = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)) + '.%06i-' % (now % 1 * 1000000)
+    path = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    os.chmod(path, 0o755)
+    return os.path.basename(path)
+
+
+def generation_path(backup_path, docset_relative_path, generation):
+    return os.path.join(generations_dir(backup_path, docset_relative_path), generation)
+
+
+def list_generations(backup_path, docset_relative_path):
+    """
+    Names of the generations of a docset, oldest first.
+    """
+    try:
+        return sorted(name for name in os.listdir(generations_dir(backup_path, docset_relative_path))
+                      if not name.startswith('.'))
+    except FileNotFoundError:
+        return []
+
+
+def inherited_file(backup_path, docset_relative_path, generation):
+    """
+    Path of the record of the files a generation got from the previous
+    one, next to the generation directory.
+    """
+    return os.path.join(generations_dir(backup_path, docset_relative_path),
+                        '.%s.inherited' % generation)
+
+
+def current_generation(backup_path, docset_relative_path):
+    """
+    Name of the live generation of a docset, None if there is none.
+    """
+    link = os.path.join(backup_path, docset_relative_path)
+    if not os.path.islink(link):
+        return None
+    return os.path.basename(os.readlink(link).rstrip('/'))
+
+
+def activate(backup_path, docset_relative_path, generation):
+    """
+    Make a generation live by replacing the symbolic link of the docset.
+    Files at the top of the previous generation that are missing in the
+    new one (the navigation page of the docset) are linked into it
+    first, they are only regenerated when the build instruction is
+    published. They are recorded, so prune_inherited() can remove the
+    ones that were not regenerated.
+    """
+    link = os.path.join(backup_path, docset_relative_path)
+    path = generation_path(backup_path, docset_relative_path, generation)
+    if not os.path.isdir(path):
+        raise FileNotFoundError("No generation %s of %s" % (generation, docset_relative_path))
+    if os.path.isdir(link) and not os.path.islink(link):
+        # docset directory of an older version, keep it as the first
+        # generation
+        os.rename(link, generation_path(backup_path, docset_relative_path, LEGACY_GENERATION))
+        os.symlink(os.path.relpath(generation_path(backup_path, docset_relative_path,
+                                                   LEGACY_GENERATION), os.path.dirname(link)), link)
+    previous = current_generation(backup_path, docset_relative_path)
+    if previous is not None and previous != generation:
+        previous_path = generation_path(backup_path, docset_relative_path, previous)
+        inherited = {}
+        for name in (os.listdir(previous_path) if os.path.isdir(previous_path) else []):
+            source = os.path.join(previous_path, name)
+            if os.path.isfile(source) and not os.path.lexists(os.path.join(path, name)):
+                os.link(source, os.path.join(path, name))
+                inherited[name] = os.stat(source).st_ino
+        if inherited:
+            with open(inherited_file(backup_path, docset_relative_path, generation), 'w') as f:
+                json.dump(inherited, f)
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(link), '.docserv-%s' % os.path.basename(link))
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.relpath(path, os.path.dirname(link)), tmp)
+    os.replace(tmp, link)
+
+
+def prune_inherited(backup_path, docset_relative_path, generation):
+    """
+    Remove the files a generation got from the previous one (see
+    activate()) that were not replaced since, because the navigation
+    pages of the docset were regenerated without them. Returns their
+    names.
+    """
+    record = inherited_file(backup_path, docset_relative_path, generation)
+    try:
+        with open(record, 'r') as f:
+            inherited = json.load(f)
+    except (OSError, ValueError):
+        return []
+    path = generation_path(backup_path, docset_relative_path, generation)
+    removed = []
+    for name, inode in sorted(inherited.items()):
+        file_path = os.path.join(path, name)
+        try:
+            if os.lstat(file_path).st_ino == inode:
+                os.remove(file_path)
+                removed.append(name)
+        except FileNotFoundError:
+            pass
+    os.remove(record)
+    if removed:
+        logger.debug("Removed %s from generation %s of %s, they were not regenerated",
+                     ', '.join(removed), generation, docset_relative_path)
+    return removed
+
+
+def collect_garbage(backup_path, docset_relative_path, keep):
+    """
+    Remove all but the keep newest generations of a docset in a thread
+    of its own. The live generation is never removed. Returns the
+    thread.
+    """
+    current = current_generation(backup_path, docset_relative_path)
+    generations = list_generations(backup_path, docset_relative_path)
+    old = [generation for generation in generations[:max(len(generations) - keep, 0)]
+           if generation != current]
+
+    def remove():
+        for generation in old:
+            logger.debug("Removing generation %s of %s", generation, docset_relative_path)
+            shutil.rmtree(generation_path(backup_path, docset_relative_path, generation),
+                          ignore_errors=True)
+            try:
+                os.remove(inherited_file(backup_path, docset_relative_path, generation))
+            except FileNotFoundError:
+                pass
+    thread = threading.Thread(target=remove, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import threading
+
+from docserv.functions import write_atomically
+
+logger = logging.getLogger('docserv')
+
+CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
+
+
+def update_record(old, new):
+    """
+    Journal record with the changes from old to new (both build
+    instruction dicts), None if nothing changed. Deliverables that
+    changed are written in full.
+    """
+    old_deliverables = old.get('deliverables') or {}
+    new_deliverables = new.get('deliverables') or {}
+    record = {
+        'op': 'update',
+        'id': new['id'],
+        'fields': dict((key, value) for key, value in new.items()
+                       if key != 'deliverables' and (key not in old or old[key] != value)),
+        'removed': [key for key in old if key not in new],
+        'deliverables': dict((deliverable_id, deliverable) for deliverable_id, deliverable
+                             in new_deliverables.items()
+                             if old_deliverables.get(deliverable_id) != deliverable),
+        'removed_deliverables': [deliverable_id for deliverable_id in old_deliverables
+                                 if deliverable_id not in new_deliverables],
+    }
+    if not any(record[key] for key in ('fields', 'removed', 'deliverables',
+                                       'removed_deliverables')):
+        return None
+    return record
+
+
+def apply_update(build_instruction, record):
+    """
+    Apply an update record (see update_record()) to a build instruction.
+    """
+    build_instruction.update(record['fields'])
+    for key in record['removed']:
+        build_instruction.pop(key, None)
+    if record['deliverables'] or record['removed_deliverables']:
+        deliverables = build_instruction.setdefault('deliverables', {})
+        deliverables.update(record['deliverables'])
+        for deliverable_id in record['removed_deliverables']:
+            deliverables.pop(deliverable_id, None)
+
+
+class StateJournal:
+    """
+    Persistent state of all build instructions. It consists of a
+    snapshot (/var/cache/docserv/[SERVER_NAME].json) and an append-only
+    journal (/var/cache/docserv/[SERVER_NAME].journal) that contains
+    one JSON record per line for every change since the snapshot was
+    written:
+
+    {"op": "put", "build_instruction": {...}} -- new state of a BI
+    {"op": "update", "id": "...",             -- changes of a BI since
+     "fields": {...}, "removed": [...],          it was last journaled
+     "deliverables": {...}, "removed_deliverables": [...]}
+    {"op": "remove", "id": "..."}             -- BI is gone
+
+    A BI is written in full only the first time it changes after the
+    snapshot, after that only the fields and deliverables that changed
+    are journaled, so a build with many deliverables does not write all
+    of them again whenever one of them finishes.
+
+    When the journal has grown too long, it is compacted into a new
+    snapshot. Snapshot and journal carry a generation number, so a
+    journal that belongs to an older snapshot is never replayed.
+    """
+
+    def __init__(self, server_name, max_records=1000):
+        self.snapshot_path = os.path.join(CACHE_DIR, server_name + '.json')
+        self.journal_path = os.path.join(CACHE_DIR, server_name + '.journal')
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.records = 0
+        self.journal = None
+        # BUILD_INSTRUCTION_ID -> the BI as it was last journaled, since
+        # the snapshot
+        self.journaled = {}
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal. Returns a dict that maps
+        BUILD_INSTRUCTION_IDs to build instruction dicts.
+        """
+        state = {}
+        if os.path.isfile(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    snapshot = json.load(f)
+            except ValueError:
+                logger.warning("Could not read state snapshot %s", self.snapshot_path)
+                snapshot = {}
+            # Before journaling existed, the snapshot was a plain list.
+            if isinstance(snapshot, list):
+                snapshot = {'generation': 0, 'build_instructions': snapshot}
+            self.generation = snapshot.get('generation', 0)
+            for build_instruction in snapshot.get('build_instructions', []):
+                state[build_instruction['id']] = build_instruction
+
+        if not os.path.isfile(self.journal_path):
+            return state
+        replayed = 0
+        with open(self.journal_path, 'r') as f:
+            for n, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash while appending leaves a truncated last line.
+                    logger.warning("Ignoring broken record %i in state journal %s",
+                                   n, self.journal_path)
+                    break
+                if n == 0:
+                    if record.get('generation') != self.generation:
+                        logger.info("State journal %s is older than the snapshot, not replaying it.",
+                                    self.journal_path)
+                        break
+                elif record['op'] == 'put':
+                    state[record['build_instruction']['id']] = record['build_instruction']
+                    replayed += 1
+                elif record['op'] == 'update':
+                    if record['id'] in state:
+                        apply_update(state[record['id']], record)
+                    replayed += 1
+                elif record['op'] == 'remove':
+                    state.pop(record['id'], None)
+                    replayed += 1
+        logger.info("Replayed %i records from state journal %s", replayed, self.journal_path)
+        return state
+
+    def append(self, record):
+        """
+        Append a record to the journal and make sure it is on disk.
+        Must be called with self.lock held. Returns True if the journal
+        should be compacted.
+        """
+        if self.journal is None:
+            if not os.path.isfile(self.journal_path):
+                write_atomically(self.journal_path,
+                                 json.dumps({'generation': self.generation}) + '\n')
+            self.journal = open(self.journal_path, 'a')
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.records += 1
+        return self.records >= self.max_records
+
+    def record(self, build_instruction_id, lookup):
+        """
+        Journal the current state of a build instruction. lookup is
+        called with the journal lock held and must return the current
+        dict of the build instruction or None if it does not exist
+        anymore. Taking the state under the lock guarantees that the
+        journal is written in the order the changes happened.
+        Returns True if the journal should be compacted.
+        """
+        with self.lock:
+            build_instruction = lookup(build_instruction_id)
+            if build_instruction is None:
+                self.journaled.pop(build_instruction_id, None)
+                return self.append({'op': 'remove', 'id': build_instruction_id})
+            # a copy that does not change with the BI
+            build_instruction = json.loads(json.dumps(build_instruction))
+            previous = self.journaled.get(build_instruction_id)
+            self.journaled[build_instruction_id] = build_instruction
+            if previous is None:
+                return self.append({'op': 'put', 'build_instruction': build_instruction})
+            record = update_record(previous, build_instruction)
+            if record is None:
+                return False
+            return self.append(record)
+
+    def compact(self, collect):
+        """
+        Write a new snapshot and start a new, empty journal. collect is
+        called with the journal lock held and must return a list of
+        all build instruction dicts.
+        """
+        with self.lock:
+            build_instructions = collect()
+            self.generation += 1
+            write_atomically(self.snapshot_path, json.dumps({
+                'generation': self.generation,
+                'build_instructions': build_instructions}))
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            write_atomically(self.journal_path,
+                             json.dumps({'generation': self.generation}) + '\n')
+            self.records = 0
+            # The changes are folded into the snapshot, the next change
+            # of every BI writes it in full again.
+            self.journaled = {}
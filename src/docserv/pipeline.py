@@ -0,0 +1,347 @@
+import asyncio
+import logging
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from docserv.generations import activate, prune_inherited
+from docserv.transfer import transfer
+
+logger = logging.getLogger('docserv')
+
+# Of long outputs of commands, only the last bytes are kept.
+MAX_OUTPUT = 1024 * 1024
+
+
+def mkdir(path):
+    os.makedirs(path, exist_ok=True)
+
+
+def remove(path):
+    """
+    Remove a file or a directory tree, like rm -rf.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def write_param_file(path, content, default_file=None):
+    """
+    Write a DAPS or XSLT parameter file. The parameters of the
+    deliverable (content, one per line, '--' for none) come after the
+    ones in default_file, so they take precedence.
+    """
+    text = ''
+    if default_file and os.path.isfile(default_file):
+        with open(default_file, 'r') as f:
+            text = f.read()
+    if content and content != '--':
+        text += "\n%s\n" % content
+    with open(path, 'w') as f:
+        f.write(text or "\n")
+
+
+# Steps that run in-process instead of starting a command
+ACTIONS = {
+    'activate_generation': activate,
+    'mkdir': mkdir,
+    'prune_inherited': prune_inherited,
+    'remove': remove,
+    'transfer': transfer,
+    'write_param_file': write_param_file,
+}
+
+
+def describe(command):
+    """
+    The command line of a step, for log messages and mails.
+    """
+    if 'action' in command:
+        return "%s %s" % (command['action'], ' '.join(str(arg) for arg in command.get('args', [])))
+    return command['cmd']
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def kill(process, sig=signal.SIGTERM):
+    """
+    Kill a process started by run_process() together with everything it
+    started.
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def read_stream(pipe, buffer):
+    """
+    Read an output pipe of a process until it is closed.
+    """
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
+            buffer += chunk
+            if len(buffer) > MAX_OUTPUT:
+                del buffer[:len(buffer) - MAX_OUTPUT]
+    finally:
+        transport.close()
+
+
+def wait_for_exit(pid):
+    """
+    Future for the result of os.wait4(). The waiting is done in a thread
+    of its own, so the resource usage of the process is available.
+    """
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def wait():
+        result = os.wait4(pid, 0)
+        loop.call_soon_threadsafe(future.set_result, result)
+    threading.Thread(target=wait, daemon=True).start()
+    return future
+
+
+async def run_process(cmd, timeout=None, env=None, on_start=None, on_exit=None):
+    """
+    Run an external command. Its output is read while it runs. If it
+    takes longer than timeout seconds, it is killed together with all
+    processes it started. on_start and on_exit are called with the
+    subprocess.Popen object, for example to be able to cancel it.
+    Returns a dict with the return code, output, duration and resource
+    usage.
+    """
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    if env:
+        env = dict(os.environ, **env)
+    result = {'returncode': None, 'out': b'', 'err': b'', 'timed_out': False,
+              'duration': 0, 'rusage': None}
+    start = time.time()
+    try:
+        # Every command runs in its own session (and process group),
+        # so it can be killed together with its children.
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   start_new_session=True, env=env)
+    except OSError as error:
+        result['returncode'] = 127
+        result['err'] = str(error).encode('utf-8')
+        return result
+    if on_start is not None:
+        on_start(process)
+    out = bytearray()
+    err = bytearray()
+    exited = wait_for_exit(process.pid)
+    finished = asyncio.gather(exited,
+                              read_stream(process.stdout, out),
+                              read_stream(process.stderr, err))
+    try:
+        await asyncio.wait_for(asyncio.shield(finished), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Killing '%s' after %s seconds", ' '.join(cmd), timeout)
+        result['timed_out'] = True
+        kill(process, signal.SIGKILL)
+        await finished
+    finally:
+        if on_exit is not None:
+            on_exit(process)
+    _, status, rusage = exited.result()
+    # The process was reaped by wait4(), Popen must not wait for it.
+    process.returncode = exit_code(status)
+    result['returncode'] = process.returncode
+    result['out'] = bytes(out)
+    result['err'] = bytes(err)
+    result['duration'] = time.time() - start
+    result['rusage'] = {'utime': rusage.ru_utime, 'stime': rusage.ru_stime,
+                        'maxrss': rusage.ru_maxrss}
+    return result
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine in an event loop of its own. Each worker thread
+    uses this to run its steps.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def execute(cmd, timeout=None, env=None):
+    """
+    Run a single external command, see run_process().
+    """
+    return run_sync(run_process(cmd, timeout, env))
+
+
+class Pipeline:
+    """
+    Runs the steps of a build, for Deliverables and
+    BuildInstructionHandlers. A step is a dict with these keys:
+
+    cmd:           an external command line, or
+    action, args:  a function of ACTIONS that is called in-process
+    step:          the name of the step, for durations and dependencies
+    after:         names of the steps that must be finished before this one
+                   starts, by default the step before it. Steps with
+                   after=[] start right away, so independent steps can run
+                   at the same time.
+    after_success: the step only runs if the steps of after (True) or the
+                   listed steps succeeded, even with stop_on_failure=False
+    cleanup:       the step runs even if a step before it failed or the
+                   owner was cancelled
+    pre_cmd_hook:  name of a method of the owner that is called with the
+                   step and the thread ID before it runs. It returns the
+                   (modified) step, or False if the step failed.
+    post_cmd_hook: name of a method of the owner that is called after the
+                   step succeeded, it returns False if the step failed.
+    timeout:       seconds after which the command is killed
+    env:           additional environment variables for the command
+
+    The owner can have these attributes, all of them are optional:
+    cancelled, step_durations, step_rusage (dicts that are filled per
+    step), process_started(process), process_finished(process) and
+    step_failed(step, result).
+    """
+
+    def __init__(self, owner=None, thread_id=0, timeout=None, stop_on_failure=True,
+                 cancellable=True):
+        self.owner = owner
+        self.thread_id = thread_id
+        self.timeout = timeout
+        self.stop_on_failure = stop_on_failure
+        self.cancellable = cancellable
+        self.failed = False
+
+    def run(self, commands):
+        """
+        Run the steps. Returns False if a step failed or the owner was
+        cancelled.
+        """
+        return run_sync(self.run_steps(commands))
+
+    def cancelled(self):
+        return self.cancellable and getattr(self.owner, 'cancelled', False)
+
+    def record(self, attribute, step, value):
+        values = getattr(self.owner, attribute, None)
+        if values is not None:
+            values[step] = value
+
+    def call_owner(self, method, *args):
+        if hasattr(self.owner, method):
+            getattr(self.owner, method)(*args)
+
+    async def run_steps(self, commands):
+        self.failed = False
+        tasks = []
+        names = {}
+        for i, command in enumerate(commands):
+            if 'after' in command:
+                after = [names[name] for name in command['after'] if name in names]
+            else:
+                after = tasks[-1:]
+            required = command.get('after_success', [])
+            if required is True:
+                required = after
+            else:
+                required = [names[name] for name in required if name in names]
+            task = asyncio.ensure_future(self.run_step(command, str(i), after, required))
+            tasks.append(task)
+            names[command.get('step', str(i))] = task
+        results = await asyncio.gather(*tasks)
+        return all(results) and not self.cancelled()
+
+    async def run_hook(self, name, command, step):
+        """
+        Run a hook of the owner. An exception fails the step instead of
+        ending the worker thread. The duration is recorded as
+        [STEP]:[HOOK], steps that run at the same time can have the same
+        hook.
+        """
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        try:
+            result = await loop.run_in_executor(None, getattr(self.owner, name),
+                                                command, self.thread_id)
+        except Exception:
+            logger.exception("Thread %i: Hook %s failed for '%s'",
+                             self.thread_id, name, describe(command))
+            result = False
+        self.record('step_durations', '%s:%s' % (step, name), time.time() - start)
+        return result
+
+    async def run_step(self, command, default_name, after, required=()):
+        loop = asyncio.get_event_loop()
+        if after or required:
+            await asyncio.wait(list(after) + list(required))
+        name = command.get('step', default_name)
+        cleanup = command.get('cleanup', False)
+        if not all(task.result() for task in required):
+            logger.debug("Thread %i: Skipping %s, a step before it failed", self.thread_id, name)
+            return False
+        if not cleanup and ((self.failed and self.stop_on_failure) or self.cancelled()):
+            logger.debug("Thread %i: Skipping %s", self.thread_id, name)
+            return False
+
+        if 'pre_cmd_hook' in command:
+            command = await self.run_hook(command['pre_cmd_hook'], command, name)
+            if command == False:
+                self.failed = True
+                return False
+
+        logger.debug("Thread %i: %s", self.thread_id, command)
+        start = time.time()
+        if 'action' in command:
+            result = {'returncode': 0, 'out': b'', 'err': b''}
+            try:
+                await loop.run_in_executor(None, lambda: ACTIONS[command['action']](*command.get('args', [])))
+            except OSError as error:
+                result['returncode'] = 1
+                result['err'] = str(error).encode('utf-8')
+            except Exception as error:
+                logger.exception("Thread %i: Action %s failed", self.thread_id, command['action'])
+                result['returncode'] = 1
+                result['err'] = ("%s: %s" % (type(error).__name__, error)).encode('utf-8')
+        else:
+            result = await run_process(
+                command['cmd'], command.get('timeout', self.timeout), command.get('env'),
+                on_start=lambda process: self.call_owner('process_started', process),
+                on_exit=lambda process: self.call_owner('process_finished', process))
+            self.record('step_rusage', name, result['rusage'])
+        self.record('step_durations', name, time.time() - start)
+
+        if self.cancelled() and not cleanup:
+            return False
+        if result['returncode'] != 0:
+            self.failed = True
+            logger.warning("Thread %i: Unexpected return value %i for '%s'",
+                           self.thread_id, result['returncode'], describe(command))
+            self.call_owner('step_failed', command, result)
+            return False
+
+        if 'post_cmd_hook' in command:
+            if not await self.run_hook(command['post_cmd_hook'], command, name):
+                self.failed = True
+                return False
+        return True
@@ -0,0 +1,578 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from docserv.functions import resource_to_filename
+from docserv.generations import GENERATIONS_DIR, activate, current_generation, list_generations
+from docserv.pipeline import Pipeline, describe
+
+logger = logging.getLogger('docserv')
+
+SHARE_DIR = os.getenv('DOCSERV_SHARE_DIR', "/usr/share/docserv/")
+CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
+
+# Name of the file in the manifest directory of a target that records
+# when the last full reconciliation was done
+FULL_SYNC_FILE = 'full-sync.json'
+
+
+def excludes_file():
+    return os.path.join(SHARE_DIR, 'rsync', 'rsync_excludes.txt')
+
+
+def read_excludes(path):
+    """
+    Patterns of an rsync --exclude-from file, an empty list if it does
+    not exist.
+    """
+    try:
+        with open(path, 'r') as f:
+            return [line.strip() for line in f
+                    if line.strip() and not line.startswith(('#', ';'))]
+    except OSError:
+        return []
+
+
+def excluded(path, patterns):
+    """
+    True if rsync skips path (relative to the root of the transfer)
+    because of one of the exclude patterns: patterns ending with a slash
+    match directories on the way to path, patterns without a slash match
+    the name of path or of one of its directories, other patterns match
+    the whole path.
+    """
+    parts = path.split('/')
+    for pattern in patterns:
+        if pattern.endswith('/'):
+            if any(fnmatch.fnmatchcase(part, pattern.rstrip('/')) for part in parts[:-1]):
+                return True
+        elif '/' not in pattern:
+            if any(fnmatch.fnmatchcase(part, pattern) for part in parts):
+                return True
+        elif fnmatch.fnmatchcase(path, pattern.lstrip('/')):
+            return True
+    return False
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_tree(root, subtree=''):
+    """
+    Paths of all files and symbolic links below root/subtree, relative
+    to root.
+    """
+    paths = []
+    top = os.path.join(root, subtree)
+    if os.path.islink(top) or os.path.isfile(top):
+        return [subtree]
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in list(dirnames):
+            if os.path.islink(os.path.join(dirpath, name)):
+                dirnames.remove(name)
+                filenames.append(name)
+        for name in filenames:
+            paths.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return paths
+
+
+def docset_paths(backup_path, docset_relative_path):
+    """
+    Paths (relative to backup_path) that are published for a docset: the
+    link to its live generation and the files of all its generations,
+    so generations removed by collect_garbage() are deleted in the
+    target path as well. The records of inherited files are left out.
+    """
+    generations = os.path.join(GENERATIONS_DIR, docset_relative_path)
+    return [docset_relative_path] + [
+        path for path in list_tree(backup_path, generations)
+        if os.path.dirname(path) != generations or not path.endswith('.inherited')]
+
+
+def canonical_path(root, path):
+    """
+    path (relative to root) with the links to directories in it resolved,
+    for example the links to the live generations of docsets.
+    """
+    real_root = os.path.realpath(root)
+    directory = os.path.realpath(os.path.join(root, os.path.dirname(path)))
+    if directory != real_root and not directory.startswith(real_root + os.sep):
+        return path
+    return os.path.relpath(os.path.join(directory, os.path.basename(path)), real_root)
+
+
+def scan(root, paths, previous=None):
+    """
+    Manifest of the files at paths (relative to root): maps each path to
+    [size, mtime_ns, sha1], or to ['link', target] for symbolic links.
+    Hashes of files whose size and modification time did not change
+    since the previous manifest are taken from it. Missing files are
+    left out.
+    """
+    previous = previous or {}
+    manifest = {}
+    for path in paths:
+        full_path = os.path.join(root, path)
+        try:
+            stat = os.lstat(full_path)
+            if os.path.islink(full_path):
+                manifest[path] = ['link', os.readlink(full_path)]
+                continue
+            old = previous.get(path)
+            if old and old[0] != 'link' and old[:2] == [stat.st_size, stat.st_mtime_ns]:
+                manifest[path] = old
+            else:
+                manifest[path] = [stat.st_size, stat.st_mtime_ns, file_sha1(full_path)]
+        except FileNotFoundError:
+            continue
+    return manifest
+
+
+def same_content(old, new):
+    if old is None or new is None:
+        return old is new
+    if old[0] == 'link' or new[0] == 'link':
+        return old == new
+    return old[0] == new[0] and old[2] == new[2]
+
+
+class Publisher:
+    """
+    Publishes the backup path of a target to its target path. Instead of
+    running rsync over the whole backup tree for every build
+    instruction, a manifest (path, size, hash) is kept per scope, for
+    example the docset subtree en-us/sles/15 or the navigation pages of a
+    target. Only the paths of a scope that changed since it was last
+    published are transferred or deleted.
+
+    As a safety net, for example for changes of the target path that
+    were made by hand, the whole tree is synchronized with rsync
+    --delete-after if the last full synchronization of a target is older
+    than full_sync_interval seconds (0: every time).
+
+    The manifests are stored in /var/cache/docserv/[SERVER_NAME]-manifests/.
+
+    Finished build instructions are published in batches, see
+    PublishQueue. on_published is called with the ID of each build
+    instruction after its publish_status changed.
+    """
+
+    def __init__(self, server_name, full_sync_interval, batch_window=0, batch_size=1,
+                 step_timeout=None):
+        self.path = os.path.join(CACHE_DIR, server_name + '-manifests')
+        self.full_sync_interval = full_sync_interval
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.step_timeout = step_timeout
+        self.on_published = None
+        # Paths rsync does not transfer, they are left out of the
+        # manifests and the lists of changed paths
+        self.excludes = read_excludes(excludes_file())
+        self.lock = threading.Lock()
+        # target -> PublishQueue
+        self.queues = {}
+        self.statistics = {'scoped_syncs': 0, 'full_syncs': 0,
+                           'files_transferred': 0, 'files_deleted': 0,
+                           'batches': 0, 'build_instructions': 0}
+
+    def queue(self, target):
+        with self.lock:
+            if target not in self.queues:
+                self.queues[target] = PublishQueue(self, target)
+            return self.queues[target]
+
+    def enqueue(self, bih):
+        """
+        Publish a build instruction whose output is in the backup path.
+        """
+        self.queue(bih.build_instruction['target']).add(bih)
+
+    def generations(self, backup_path, docset_relative_path):
+        return {
+            'current': current_generation(backup_path, docset_relative_path),
+            'generations': list_generations(backup_path, docset_relative_path),
+        }
+
+    def rollback(self, target, target_config, docset_relative_path, generation=None):
+        """
+        Make an older generation of a docset live again and publish it,
+        by default the one before the live generation. Returns the name
+        of the generation, or None if there is no such generation.
+        """
+        backup_path = target_config['backup_path']
+        generations = list_generations(backup_path, docset_relative_path)
+        current = current_generation(backup_path, docset_relative_path)
+        if generation is None:
+            older = [name for name in generations if current is not None and name < current]
+            if not older:
+                return None
+            generation = older[-1]
+        elif generation not in generations:
+            return None
+        activate(backup_path, docset_relative_path, generation)
+        logger.info("Rolled back %s of target %s to generation %s",
+                    docset_relative_path, target, generation)
+        self.queue(target).sync(target_config, {
+            docset_relative_path: docset_paths(backup_path, docset_relative_path)})
+        return generation
+
+    def flush(self):
+        """
+        Publish all waiting build instructions right away, for example
+        before shutting down.
+        """
+        with self.lock:
+            queues = list(self.queues.values())
+        for queue in queues:
+            queue.flush()
+
+    def published(self, build_instruction_ids):
+        if self.on_published is not None:
+            for build_instruction_id in build_instruction_ids:
+                self.on_published(build_instruction_id)
+
+    def manifest_file(self, target, scope):
+        return os.path.join(self.path, resource_to_filename(target),
+                            resource_to_filename(scope) + '.json')
+
+    def read_json(self, path, default):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def write_json(self, path, value):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+
+    def manifest(self, target, scope):
+        with self.lock:
+            return self.read_json(self.manifest_file(target, scope), {})
+
+    def full_sync_due(self, target):
+        if self.full_sync_interval <= 0:
+            return True
+        with self.lock:
+            last = self.read_json(os.path.join(self.path, resource_to_filename(target),
+                                               FULL_SYNC_FILE), {}).get('finished', 0)
+        return time.time() - last > self.full_sync_interval
+
+    def changes(self, target, backup_path, scopes):
+        """
+        Find what changed in the backup path of target. scopes maps the
+        name of each scope to the paths it contains (relative to
+        backup_path), None stands for the subtree with the name of the
+        scope. Returns the new manifests of the scopes, the paths that
+        need to be transferred and the ones that need to be deleted.
+        """
+        manifests = {}
+        transfer = set()
+        delete = set()
+        for scope, paths in scopes.items():
+            previous = self.manifest(target, scope)
+            if paths is None:
+                paths = list_tree(backup_path, scope) if os.path.lexists(
+                    os.path.join(backup_path, scope)) else []
+            else:
+                paths = [canonical_path(backup_path, path) for path in paths]
+            paths = [path for path in paths if not excluded(path, self.excludes)]
+            manifest = scan(backup_path, paths, previous)
+            manifests[scope] = manifest
+            for path, entry in manifest.items():
+                if not same_content(previous.get(path), entry):
+                    transfer.add(path)
+            for path in previous:
+                if path in manifest or excluded(path, self.excludes):
+                    continue
+                if os.path.lexists(os.path.join(backup_path, path)):
+                    # The path moved to another scope. The manifest of
+                    # that scope may already list it, or that scope is
+                    # not published now, so it is transferred here.
+                    transfer.add(path)
+                else:
+                    delete.add(path)
+        # Sorted, the generations of docsets (in .docserv-generations/)
+        # come before the links to them.
+        return manifests, sorted(transfer), sorted(delete)
+
+    def commit(self, target, manifests, transferred=0, deleted=0, full=False):
+        """
+        Store the manifests of the scopes after they were published.
+        """
+        with self.lock:
+            for scope, manifest in manifests.items():
+                self.write_json(self.manifest_file(target, scope), manifest)
+            if full:
+                self.write_json(os.path.join(self.path, resource_to_filename(target),
+                                             FULL_SYNC_FILE), {'finished': time.time()})
+                self.statistics['full_syncs'] += 1
+            else:
+                self.statistics['scoped_syncs'] += 1
+                self.statistics['files_transferred'] += transferred
+                self.statistics['files_deleted'] += deleted
+
+    def dict(self):
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics['awaiting_publish'] = sum(len(queue.pending) for queue
+                                                 in self.queues.values())
+        return statistics
+
+
+class PublishQueue:
+    """
+    Finished build instructions of one target that wait to be published.
+    When a release starts many build instructions at once, most of them
+    finish within a short time. Instead of generating the navigation
+    pages and syncing the target path for each of them, they are
+    collected for batch_window seconds after the first one arrived, or
+    until there are batch_size of them. Then the navigation pages are
+    generated once per docset and the target path is synced once.
+
+    The publish_status of the build instructions is 'awaiting publish'
+    until their batch is published, then 'published' or 'publish failed'.
+    """
+
+    def __init__(self, publisher, target):
+        self.publisher = publisher
+        self.target = target
+        # BuildInstructionHandlers, in the order they finished
+        self.pending = []
+        self.timer = None
+        self.lock = threading.Lock()
+        # Only one batch of a target is published at a time.
+        self.publish_lock = threading.Lock()
+        # Set while a batch is published
+        self.batch = {}
+        self.navigation_paths = None
+        # Duration of each stage of the batch, filled by the Pipeline
+        self.step_durations = {}
+
+    def add(self, bih):
+        batch = None
+        with self.lock:
+            self.pending.append(bih)
+            if (self.publisher.batch_window <= 0 or
+                    len(self.pending) >= self.publisher.batch_size):
+                batch = self.take()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.publisher.batch_window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if batch:
+            self.publish(batch)
+
+    def take(self):
+        """
+        Remove the waiting build instructions from the queue. Must be
+        called with self.lock held.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending
+        self.pending = []
+        return batch
+
+    def flush(self):
+        with self.lock:
+            batch = self.take()
+        if batch:
+            self.publish(batch)
+
+    def publish(self, bihs):
+        with self.publish_lock:
+            self.batch = dict((bih.build_instruction['id'], bih) for bih in bihs)
+            self.navigation_paths = None
+            self.step_durations = {}
+            logger.info("Publishing %i build instructions of target %s",
+                        len(bihs), self.target)
+            result = Pipeline(self, timeout=self.publisher.step_timeout,
+                              stop_on_failure=False, cancellable=False).run(self.commands(bihs))
+            for bih in bihs:
+                bih.build_instruction['publish_step_durations'] = dict(self.step_durations)
+                # The build instruction may have been queued again since.
+                if bih.build_instruction.get('publish_status') == 'awaiting publish':
+                    bih.build_instruction['publish_status'] = 'published' if result else 'publish failed'
+            self.batch = {}
+        with self.publisher.lock:
+            self.publisher.statistics['batches'] += 1
+            self.publisher.statistics['build_instructions'] += len(bihs)
+        self.publisher.published([bih.build_instruction['id'] for bih in bihs])
+
+    def commands(self, bihs):
+        """
+        Navigation pages for each docset of the batch, moved into the
+        backup path, then one sync of all changed paths to the target
+        path.
+        """
+        target_config = bihs[-1].config['targets'][self.target]
+        backup_path = target_config['backup_path']
+        commands = []
+        # The languages of a docset share their navigation pages.
+        docsets = OrderedDict()
+        languages = {}
+        for bih in bihs:
+            docsets[(bih.product, bih.docset)] = bih
+            languages.setdefault((bih.product, bih.docset), []).append(bih)
+        # The navigation pages of all docsets are generated at the same
+        # time. They are moved into the backup path one after the other,
+        # in the order of the batch, so shared pages are the same as if
+        # the build instructions were published one by one.
+        nav_dirs = []
+        moves = []
+        prunes = []
+        for i, (docset, bih) in enumerate(docsets.items()):
+            tmp_dir_nav = tempfile.mkdtemp(prefix="docserv_navigation_")
+            nav_dirs.append(tmp_dir_nav)
+            command = bih.navigation_command(tmp_dir_nav)
+            command['step'] = 'build_navigation_%i' % i
+            command['after'] = []
+            commands.append(command)
+            # move navigational pages dir to backup path
+            move = bih.transfer_command(tmp_dir_nav, backup_path,
+                                        'rsync_navigation_%i' % i, move=True)
+            move['after'] = [command['step']] + moves[-1:]
+            move['after_success'] = [command['step']]
+            commands.append(move)
+            moves.append(move['step'])
+            # top-level files the new generations kept from the previous
+            # ones and that were not regenerated are gone
+            for j, language_bih in enumerate(languages[docset]):
+                generation = language_bih.build_instruction.get('generation')
+                if generation is None:
+                    continue
+                commands.append({'action': 'prune_inherited',
+                                 'args': [backup_path, language_bih.docset_relative_path,
+                                          generation],
+                                 'step': 'prune_inherited_%i_%i' % (i, j),
+                                 'after': [move['step']], 'after_success': True})
+                prunes.append(commands[-1]['step'])
+
+        for command in self.sync_commands(target_config):
+            command.setdefault('after', moves + prunes)
+            commands.append(command)
+
+        # remove temp directories for navigation pages
+        for i, tmp_dir_nav in enumerate(nav_dirs):
+            commands.append({'action': 'remove', 'args': [tmp_dir_nav],
+                             'step': 'remove_navigation_%i' % i, 'cleanup': True,
+                             'after': [moves[i]]})
+        return commands
+
+    def sync_commands(self, target_config, scopes=None):
+        """
+        rsync local backup path with web server target path. scopes are
+        the scopes that changed (see Publisher.changes()), by default the
+        docsets of the batch.
+        """
+        if target_config['enable_target_sync'] != 'yes':
+            return []
+        # only the paths that changed, see prepare_publish()
+        publish_list = tempfile.mkstemp(prefix="docserv_publish_", text=True)
+        os.close(publish_list[0])
+        return [{'cmd': "rsync --exclude-from '%s' --delete-after -lr %s/ %s" % (
+            excludes_file(),
+            target_config['backup_path'],
+            target_config['target_path'],
+        ), 'step': 'rsync_target',
+            'backup_path': target_config['backup_path'],
+            'target_path': target_config['target_path'],
+            'publish_list': publish_list[1],
+            'scopes': scopes,
+            'pre_cmd_hook': 'prepare_publish',
+            'post_cmd_hook': 'commit_publish'},
+            {'action': 'remove', 'args': [publish_list[1]],
+             'step': 'remove_publish_list', 'cleanup': True, 'after': ['rsync_target']}]
+
+    def sync(self, target_config, scopes):
+        """
+        Sync the paths of scopes to the target path, without a batch.
+        Returns False if that failed.
+        """
+        with self.publish_lock:
+            self.batch = {}
+            self.navigation_paths = None
+            return Pipeline(self, timeout=self.publisher.step_timeout,
+                            stop_on_failure=False, cancellable=False).run(
+                                self.sync_commands(target_config, scopes))
+
+    def record_navigation(self, command, thread_id):
+        """
+        Remember which navigation pages were generated, they are
+        published together with the docsets.
+        """
+        paths = list_tree(command['output_dir'])
+        # The navigation builds of a batch run at the same time.
+        with self.lock:
+            self.navigation_paths = sorted(set(self.navigation_paths or []) | set(paths))
+        return True
+
+    def prepare_publish(self, command, thread_id):
+        """
+        Replace the rsync of the whole backup path with one that only
+        transfers and deletes the paths of the docsets and of the
+        navigation pages that changed since they were last published.
+        If a full synchronization is due, the command is kept.
+        """
+        scopes = command['scopes']
+        if scopes is None:
+            scopes = dict((bih.docset_relative_path, bih.publish_paths(command['backup_path']))
+                          for bih in self.batch.values())
+        if self.navigation_paths is not None:
+            scopes['navigation'] = self.navigation_paths
+        manifests, transfer, delete = self.publisher.changes(
+            self.target, command['backup_path'], scopes)
+        command['manifests'] = manifests
+        command['transferred'] = len(transfer)
+        command['deleted'] = len(delete)
+        if self.publisher.full_sync_due(self.target):
+            command['full'] = True
+            return command
+        with open(command['publish_list'], 'w') as f:
+            f.write(''.join("%s\n" % path for path in transfer + delete))
+        logger.debug("Publishing %i changed and %i deleted paths of target %s",
+                     len(transfer), len(delete), self.target)
+        # Paths in the list that do not exist in the backup path any
+        # more are deleted in the target path.
+        command['cmd'] = "rsync --exclude-from '%s' -l --files-from='%s' --delete-missing-args %s/ %s" % (
+            excludes_file(),
+            command['publish_list'],
+            command['backup_path'],
+            command['target_path'])
+        return command
+
+    def commit_publish(self, command, thread_id):
+        self.publisher.commit(self.target, command['manifests'], command['transferred'],
+                              command['deleted'], command.get('full', False))
+        return True
+
+    def step_failed(self, command, result):
+        """
+        A command failed, send a mail for a build instruction of the
+        batch it belongs to.
+        """
+        bih = self.batch.get(command.get('build_instruction_id'))
+        if bih is None and self.batch:
+            bih = list(self.batch.values())[-1]
+        if bih is None:
+            logger.warning("Publishing to target %s failed: %s", self.target,
+                           result['err'].decode('utf-8', 'replace'))
+            return
+        logger.warning("Publishing %s failed!", bih.build_instruction['id'])
+        bih.mail(describe(command), result['out'], result['err'])
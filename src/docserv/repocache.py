@@ -0,0 +1,450 @@
+import logging
+import os
+import re
+import shlex
+import shutil
+import threading
+import time
+
+from docserv.functions import resource_to_filename
+from docserv.pipeline import execute
+from docserv.repolock import RepoLock
+
+logger = logging.getLogger('docserv')
+
+
+def run(command):
+    """
+    Run a git command, return its return code, stdout and stderr.
+    """
+    result = execute(command)
+    return (result['returncode'], result['out'].decode('utf-8'), result['err'].decode('utf-8'))
+
+
+# References to other files: entities and XIncludes in XML files, and
+# VARIABLE="value" lines in DC files
+REFERENCE_PATTERNS = {
+    'xml': re.compile(r'''(?:SYSTEM|href)\s*=?\s*["']([^"']+)["']'''),
+    'dc': re.compile(r'''^\s*[A-Z_]+\s*=\s*["']?([^"'\s]+/[^"'\s]*)["']?''', re.MULTILINE),
+}
+
+
+def find_references(build_dir, path):
+    """
+    Find directories outside of path (relative to build_dir) that files
+    in path refer to. Returns a set of paths relative to build_dir.
+    """
+    found = set()
+    for root, dirs, files in os.walk(os.path.join(build_dir, path)):
+        dirs[:] = [name for name in dirs if name != '.git']
+        for name in files:
+            if name.startswith('DC-'):
+                pattern = REFERENCE_PATTERNS['dc']
+            elif name.endswith(('.xml', '.ent')):
+                pattern = REFERENCE_PATTERNS['xml']
+            else:
+                continue
+            try:
+                with open(os.path.join(root, name), 'r', errors='replace') as f:
+                    content = f.read()
+            except OSError:
+                continue
+            for reference in pattern.findall(content):
+                if '://' in reference or reference.startswith(('/', '#')):
+                    continue
+                target = os.path.relpath(os.path.normpath(os.path.join(root, reference)), build_dir)
+                directory = os.path.dirname(target)
+                # Files in the top level directory are always checked out.
+                if directory and not directory.startswith('..'):
+                    found.add(directory)
+    return found
+
+
+def covered(path, paths):
+    """
+    True if path is one of paths or inside one of them.
+    """
+    return any(path == done or path.startswith(done + '/') for done in paths)
+
+
+def referenced_paths(build_dir, paths):
+    """
+    paths plus all directories that files in them refer to, directly or
+    through other referenced files.
+    """
+    found = set(paths)
+    scan = list(paths)
+    while scan:
+        missing = set()
+        for path in scan:
+            missing |= find_references(build_dir, path)
+        missing = set(path for path in missing if not covered(path, found))
+        found |= missing
+        scan = sorted(missing)
+    return found
+
+
+def directory_size(path):
+    """
+    Disk usage of all files below path in bytes.
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class RepoCache:
+    """
+    The locally cached clones of the remote repositories in repo_dir.
+
+    Fetching is single-flight per remote: when several build
+    instructions need the same remote at the same time (for example all
+    languages of a docset), only one of them fetches, the others wait
+    for that fetch and use its result. A fetch can be reused by every
+    build instruction that was queued before the fetch started, because
+    it contains everything that was pushed before the build instruction
+    arrived. Additionally, a fetch that finished less than
+    repo_fetch_freshness seconds ago is always reused.
+
+    The fetch updates all local branches of the cache to the state of
+    the remote, so build trees can be created from the cache without
+    touching its working tree: a branch is resolved to a commit and only
+    the tree of that commit is checked out into a clone that borrows the
+    objects of the cache (git clone --shared). Neither needs the
+    repository lock. If the directories that are needed are known, the
+    checkout is sparse: only these directories and the directories that
+    their DC, XML and entity files refer to are checked out.
+
+    Checkouts in temp_repo_dir are shared: all build instructions whose
+    branch resolves to the same commit of the same remote (usually the
+    languages of a docset) build from one read-only tree. A checkout is
+    reference-counted and is kept after its last user released it, until
+    the checkouts that are not in use exceed checkout_pool_size MB. Then
+    the least recently used ones are removed.
+    """
+
+    def __init__(self, config, gitLocks, gitLocksLock):
+        self.repo_dir = config['server']['repo_dir']
+        self.temp_repo_dir = config['server']['temp_repo_dir']
+        self.freshness = config['server'].get('repo_fetch_freshness', 0)
+        self.pool_size = config['server'].get('checkout_pool_size', 0) * 1024 * 1024
+        self.gitLocks = gitLocks
+        self.gitLocksLock = gitLocksLock
+        # remote -> {'fetching': bool, 'started': time, 'finished': time,
+        #            'result': bool}
+        self.fetches = {}
+        self.condition = threading.Condition()
+        # (remote, commit) -> {'path': str, 'state': 'creating'/'ready',
+        #                      'paths': set of checked out directories or
+        #                      None for a full checkout,
+        #                      'users': int, 'size': bytes, 'last_used': time}
+        self.checkouts = {}
+        self.statistics = {'fetches': 0, 'reused': 0,
+                           'checkouts': 0, 'checkouts_reused': 0}
+
+    def path(self, remote):
+        """
+        Path of the cached clone of a remote repository.
+        """
+        return os.path.join(self.repo_dir, resource_to_filename(remote))
+
+    def reusable(self, fetch, not_before):
+        if fetch['result'] is not True:
+            return False
+        if fetch['started'] >= not_before:
+            return True
+        return time.time() - fetch['finished'] <= self.freshness
+
+    def update(self, remote, not_before, thread_id):
+        """
+        Make sure the cached clone of remote contains everything that was
+        pushed before not_before (a timestamp, usually the time the build
+        instruction was queued). Returns a tuple (success, error), error
+        is (command, stdout, stderr) of the git command that failed.
+        """
+        with self.condition:
+            while True:
+                fetch = self.fetches.get(remote)
+                if fetch is None:
+                    break
+                if fetch['fetching'] and fetch['started'] >= not_before:
+                    # Share the fetch that is in flight.
+                    logger.debug("Thread %i: Waiting for running fetch of %s",
+                                 thread_id, remote)
+                    self.condition.wait_for(lambda: not fetch['fetching'])
+                    if fetch['result'] is True:
+                        self.statistics['reused'] += 1
+                        return (True, None)
+                    # It failed, try again ourselves.
+                    continue
+                if fetch['fetching']:
+                    # The running fetch may be older than the push that
+                    # triggered this build instruction.
+                    self.condition.wait_for(lambda: not fetch['fetching'])
+                    continue
+                if self.reusable(fetch, not_before):
+                    logger.debug("Thread %i: Reusing fetch of %s", thread_id, remote)
+                    self.statistics['reused'] += 1
+                    return (True, None)
+                break
+            fetch = {'fetching': True, 'started': time.time(),
+                     'finished': None, 'result': None}
+            self.fetches[remote] = fetch
+            self.statistics['fetches'] += 1
+
+        result, error = self.fetch(remote, thread_id)
+        with self.condition:
+            fetch['fetching'] = False
+            fetch['finished'] = time.time()
+            fetch['result'] = result
+            self.condition.notify_all()
+        return (result, error)
+
+    def resolve(self, remote, branch):
+        """
+        Return the commit hash a branch points to in the cached clone,
+        or None if the branch does not exist.
+        """
+        returncode, out, _ = run("git -C %s rev-parse --verify --quiet refs/heads/%s^{commit}" %
+                                 (self.path(remote), branch))
+        if returncode != 0:
+            return None
+        return out.strip()
+
+    def export(self, remote, commit, build_dir, thread_id, paths=None):
+        """
+        Check out a commit into build_dir. The objects are not copied,
+        the clone refers to the object store of the cache. If paths (a
+        list of directories) is given, only these directories and the
+        files they refer to are checked out. Returns a tuple
+        (success, error) like update().
+        """
+        commands = ["git clone --quiet --shared --no-checkout %s %s" %
+                    (self.path(remote), build_dir)]
+        if paths:
+            commands.append("git -C %s sparse-checkout set --cone -- %s" %
+                            (build_dir, ' '.join(shlex.quote(path) for path in paths)))
+        commands.append("git -C %s checkout --quiet --detach %s" % (build_dir, commit))
+        for command in commands:
+            logger.debug("Thread %i: %s", thread_id, command)
+            returncode, out, err = run(command)
+            if returncode != 0:
+                if paths:
+                    # Fall back to a full checkout.
+                    logger.warning("Sparse checkout of %s failed, checking out everything: %s",
+                                   commit, err)
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                    return self.export(remote, commit, build_dir, thread_id)
+                logger.warning("Checkout of %s failed! Unexpected return value %i for '%s'",
+                               commit, returncode, command)
+                return (False, (command, out, err))
+        if paths:
+            return self.add_references(build_dir, paths, thread_id)
+        return (True, None)
+
+    def add_references(self, build_dir, paths, thread_id):
+        """
+        Add the directories that files in a sparse checkout refer to
+        (entities, XIncludes, files named in DC files) to the checkout,
+        until nothing is missing anymore. If that fails, the sparse
+        checkout is turned into a full one.
+        """
+        checked_out = set(paths)
+        scan = list(paths)
+        while scan:
+            missing = set()
+            for path in scan:
+                missing |= find_references(build_dir, path)
+            missing = set(path for path in missing if not covered(path, checked_out))
+            if not missing:
+                break
+            command = "git -C %s sparse-checkout add -- %s" % (
+                build_dir, ' '.join(shlex.quote(path) for path in sorted(missing)))
+            logger.debug("Thread %i: %s", thread_id, command)
+            returncode, out, err = run(command)
+            if returncode != 0:
+                logger.warning("Sparse checkout of %s failed, checking out everything: %s",
+                               build_dir, err)
+                command = "git -C %s sparse-checkout disable" % build_dir
+                returncode, out, err = run(command)
+                if returncode != 0:
+                    return (False, (command, out, err))
+                return (True, None)
+            checked_out |= missing
+            scan = sorted(missing)
+        return (True, None)
+
+    def checkout(self, remote, commit, thread_id, paths=None):
+        """
+        Get a checkout of a commit from the pool, create it if necessary.
+        paths is a list of the directories that are needed, None for a
+        full checkout. There is one checkout per commit, shared by all
+        build instructions: a sparse checkout that lacks some of the
+        paths is widened to include them. Every successful call must be
+        followed by release(). Returns a tuple (path, error), path is
+        None if the checkout failed.
+        """
+        key = self.key(remote, commit)
+        wanted = set(paths) if paths else None
+        with self.condition:
+            while True:
+                entry = self.checkouts.get(key)
+                if entry is None:
+                    break
+                if entry['state'] == 'creating':
+                    self.condition.wait_for(lambda: entry['state'] != 'creating')
+                    continue
+                entry['users'] += 1
+                entry['last_used'] = time.time()
+                self.statistics['checkouts_reused'] += 1
+                if entry['paths'] is None or (wanted is not None and all(
+                        covered(path, entry['paths']) for path in wanted)):
+                    logger.debug("Thread %i: Reusing checkout %s", thread_id, entry['path'])
+                    return (entry['path'], None)
+                # Other users may still read the checkout while it is
+                # widened, files are only added.
+                entry['state'] = 'creating'
+                break
+            if entry is None:
+                name = "docserv_checkout_%s_%s" % (resource_to_filename(remote), commit[:12])
+                entry = {'path': os.path.join(self.temp_repo_dir, name), 'paths': wanted,
+                         'state': 'creating', 'users': 1, 'size': 0, 'last_used': time.time()}
+                self.checkouts[key] = entry
+                self.statistics['checkouts'] += 1
+                widen = False
+            else:
+                widen = True
+
+        if widen:
+            result, error = self.widen(entry['path'], entry['paths'], wanted, thread_id)
+        else:
+            # Left over from an earlier run of docserv
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            result, error = self.export(remote, commit, entry['path'], thread_id, paths)
+        if result:
+            size = directory_size(entry['path'])
+        elif not widen:
+            shutil.rmtree(entry['path'], ignore_errors=True)
+        with self.condition:
+            if result:
+                entry['state'] = 'ready'
+                entry['size'] = size
+                if widen:
+                    entry['paths'] = None if wanted is None else entry['paths'] | wanted
+            elif widen:
+                # The checkout is still good for its other users.
+                entry['state'] = 'ready'
+                entry['users'] -= 1
+            else:
+                entry['state'] = 'failed'
+                del self.checkouts[key]
+            self.condition.notify_all()
+            evicted = self.evict()
+        self.remove(evicted)
+        if not result:
+            return (None, error)
+        return (entry['path'], None)
+
+    def widen(self, build_dir, checked_out, paths, thread_id):
+        """
+        Add paths (None for everything) to the sparse checkout in
+        build_dir that contains the directories checked_out. Returns a
+        tuple (success, error) like export().
+        """
+        if paths is None:
+            command = "git -C %s sparse-checkout disable" % build_dir
+        else:
+            paths = sorted(path for path in paths if not covered(path, checked_out))
+            command = "git -C %s sparse-checkout add -- %s" % (
+                build_dir, ' '.join(shlex.quote(path) for path in paths))
+        logger.debug("Thread %i: %s", thread_id, command)
+        returncode, out, err = run(command)
+        if returncode != 0:
+            logger.warning("Widening the checkout %s failed! Unexpected return value %i for '%s'",
+                           build_dir, returncode, command)
+            return (False, (command, out, err))
+        if paths:
+            return self.add_references(build_dir, paths, thread_id)
+        return (True, None)
+
+    def release(self, remote, commit):
+        """
+        Give back a checkout obtained with checkout().
+        """
+        with self.condition:
+            entry = self.checkouts[self.key(remote, commit)]
+            entry['users'] -= 1
+            entry['last_used'] = time.time()
+            evicted = self.evict()
+        self.remove(evicted)
+
+    @staticmethod
+    def key(remote, commit):
+        return (remote, commit)
+
+    def evict(self):
+        """
+        Drop the least recently used checkouts that are not in use until
+        the pool fits into checkout_pool_size. Must be called with
+        self.condition held. Returns the paths to remove.
+        """
+        total = sum(entry['size'] for entry in self.checkouts.values()
+                    if entry['users'] == 0)
+        unused = sorted(((key, entry) for key, entry in self.checkouts.items()
+                         if entry['users'] == 0 and entry['state'] == 'ready'),
+                        key=lambda item: item[1]['last_used'])
+        evicted = []
+        for key, entry in unused:
+            if total <= self.pool_size:
+                break
+            del self.checkouts[key]
+            total -= entry['size']
+            evicted.append(entry['path'])
+        return evicted
+
+    def remove(self, paths):
+        for path in paths:
+            logger.debug("Removing checkout %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def pool_statistics(self):
+        with self.condition:
+            statistics = dict(self.statistics)
+            statistics['checkouts_cached'] = len(self.checkouts)
+            statistics['checkouts_in_use'] = sum(1 for entry in self.checkouts.values()
+                                                 if entry['users'] > 0)
+            statistics['checkouts_size'] = sum(entry['size'] for entry in self.checkouts.values())
+        return statistics
+
+    def fetch(self, remote, thread_id):
+        """
+        Clone the remote repository if there is no cached clone yet, then
+        update all local branches from the remote.
+        """
+        local_repo_cache_dir = self.path(remote)
+        commands = []
+        if not os.path.isdir(local_repo_cache_dir):
+            commands.append("git clone %s %s" % (remote, local_repo_cache_dir))
+        # The working tree of the cache is never used, so local branches,
+        # including the one that is checked out, can be updated directly.
+        commands.append("git -C %s fetch --prune --update-head-ok origin +refs/heads/*:refs/heads/*" %
+                        local_repo_cache_dir)
+        git_lock = RepoLock(local_repo_cache_dir, thread_id,
+                            self.gitLocks, self.gitLocksLock)
+        git_lock.acquire()
+        try:
+            for command in commands:
+                logger.debug("Thread %i: %s", thread_id, command)
+                returncode, out, err = run(command)
+                if returncode != 0:
+                    logger.warning("Fetching %s failed! Unexpected return value %i for '%s'",
+                                   remote, returncode, command)
+                    return (False, (command, out, err))
+        finally:
+            git_lock.release()
+        return (True, None)
@@ -2,37 +2,171 @@ import json
 import logging
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+from docserv.retention import INDEXED_FIELDS
+from docserv.scheduler import valid_priority
 
 logger = logging.getLogger('docserv')
 
 
 class RESTServer(BaseHTTPRequestHandler):
-    def _set_headers(self):
-        self.send_response(200)
+    def _set_headers(self, code=200):
+        self.send_response(code)
         self.send_header('Content-type', 'application/json')
         self.end_headers()
 
     def do_GET(self):
-        if self.path == '/' or self.path == '/build_instructions/':
+        url = urlsplit(self.path)
+        if url.path == '/' or url.path == '/build_instructions/':
+            if url.query:
+                self.query_build_instructions(parse_qs(url.query))
+                return
             self._set_headers()
             self.wfile.write(
                 bytes(json.dumps(self.server.docserv.dict()), "utf-8"))
-        elif self.path == '/deliverables/':
+        elif url.path == '/statistics/':
+            self._set_headers()
+            self.wfile.write(
+                bytes(json.dumps(self.server.docserv.statistics()), "utf-8"))
+        elif url.path == '/deliverables/':
             self._set_headers()
             self.wfile.write(
                 bytes(json.dumps(self.server.docserv.deliverables), "utf-8"))
+        elif url.path == '/generations/':
+            self.list_generations(parse_qs(url.query))
+
+    def docset_params(self, params):
+        """
+        target, product, docset and lang of a request, None if one of
+        them is missing.
+        """
+        try:
+            return [params[field][0] for field in ('target', 'product', 'docset', 'lang')]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def list_generations(self, params):
+        """
+        Return the generations of a docset in the backup path:
+        /generations/?target=internal&product=sles&docset=15&lang=en-us
+        """
+        docset = self.docset_params(params)
+        if docset is None:
+            self._set_headers(400)
+            return
+        generations = self.server.docserv.docset_generations(*docset)
+        if generations is None:
+            self._set_headers(404)
+            return
+        self._set_headers()
+        self.wfile.write(bytes(json.dumps(generations), "utf-8"))
+
+    def query_build_instructions(self, params):
+        """
+        Return one page of build instructions that match the filters.
+        Example: /build_instructions/?product=sles&lang=en-us&status=fail&offset=0&limit=50
+        Add archived=yes to also search archived build instructions.
+        """
+        filters = {}
+        for field in INDEXED_FIELDS:
+            if field in params:
+                filters[field] = params[field][0]
+        try:
+            offset = int(params.get('offset', ['0'])[0])
+            limit = int(params.get('limit', ['50'])[0])
+            if offset < 0 or limit < 0:
+                raise ValueError
+        except ValueError:
+            self._set_headers(400)
+            return
+        archived = params.get('archived', ['no'])[0] == 'yes'
+        total, build_instructions = self.server.docserv.query_build_instructions(
+            filters, offset, limit, archived)
+        self._set_headers()
+        self.wfile.write(bytes(json.dumps({
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'build_instructions': build_instructions,
+        }), "utf-8"))
+
+    def do_DELETE(self):
+        """
+        Cancel a build instruction or a single deliverable:
+        DELETE /build_instructions/<BUILD_INSTRUCTION_ID>
+        DELETE /build_instructions/<BUILD_INSTRUCTION_ID>/deliverables/<DELIVERABLE_ID>
+        """
+        path = [part for part in urlsplit(self.path).path.split('/') if part]
+        if len(path) == 2 and path[0] == 'build_instructions':
+            cancelled = self.server.docserv.cancel_build_instruction(path[1])
+        elif len(path) == 4 and path[0] == 'build_instructions' and path[2] == 'deliverables':
+            cancelled = self.server.docserv.cancel_deliverable(path[1], path[3])
+        else:
+            self._set_headers(400)
+            return
+        if not cancelled:
+            self._set_headers(404)
+            return
+        logger.info("Cancelled %s", '/'.join(path[1:]))
+        self._set_headers()
+        self.wfile.write(bytes(json.dumps({'cancelled': '/'.join(path[1:])}), "utf-8"))
 
     def do_POST(self):
+        if urlsplit(self.path).path == '/container_image/':
+            self.update_container_image()
+            return
+        if urlsplit(self.path).path == '/rollback/':
+            self.rollback()
+            return
         content_length = int(self.headers['Content-Length'])
         # [{"docset": "15ga", "lang": "en-us", "product": "sles", "target": "external"}. ]
         post_data = self.rfile.read(content_length)
         build_jobs = json.loads(post_data)
+        if any('priority' in job and not valid_priority(job['priority']) for job in build_jobs):
+            self._set_headers(400)
+            return
         for job in build_jobs:
             if self.server.docserv.queue_build_instruction(job):
                 logger.info("Queueing %s", json.dumps(job))
             else:
-                logger.info("Not queueing %s", json.dumps(job))
+                logger.info("Not queueing %s, it is already queued", json.dumps(job))
+        self._set_headers()
+
+    def update_container_image(self):
+        """
+        Pull the container image that deliverables are built with:
+        POST /container_image/
+        """
+        result = self.server.docserv.update_container_image()
+        if result['image'] is None:
+            self._set_headers(502)
+            return
+        self._set_headers()
+        self.wfile.write(bytes(json.dumps(result), "utf-8"))
+
+    def rollback(self):
+        """
+        Make an older generation of a docset live again:
+        POST /rollback/ {"target": "internal", "product": "sles", "docset": "15",
+                         "lang": "en-us", "generation": "..."}
+        Without generation, the one before the live generation is used.
+        """
+        content_length = int(self.headers['Content-Length'])
+        try:
+            params = json.loads(self.rfile.read(content_length))
+            docset = self.docset_params(dict((key, [value]) for key, value in params.items()))
+        except (ValueError, AttributeError):
+            docset = None
+        if docset is None:
+            self._set_headers(400)
+            return
+        generation = self.server.docserv.rollback(*docset, params.get('generation'))
+        if generation is None:
+            self._set_headers(404)
+            return
         self._set_headers()
+        self.wfile.write(bytes(json.dumps({'generation': generation}), "utf-8"))
 
 
 class ThreadedRESTServer(ThreadingMixIn, HTTPServer):
@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('docserv')
+
+CACHE_DIR = os.getenv('DOCSERV_CACHE_DIR', "/var/cache/docserv/")
+
+# Fields of a build instruction that can be used to filter queries
+INDEXED_FIELDS = ('product', 'docset', 'lang', 'target', 'status')
+
+
+def build_status(build_instruction):
+    """
+    Overall status of a finished build instruction: 'fail' if any
+    deliverable failed, 'success' if all deliverables were built (or were
+    unchanged), and
+    'aborted' if there are no deliverables at all. A status that was
+    set explicitly takes precedence.
+    """
+    if build_instruction.get('status'):
+        return build_instruction['status']
+    statuses = [deliverable['status'] for deliverable in
+                build_instruction.get('deliverables', {}).values()]
+    if not statuses:
+        return 'aborted'
+    if 'fail' in statuses:
+        return 'fail'
+    if all(status in ('success', 'unchanged') for status in statuses):
+        return 'success'
+    return statuses[0]
+
+
+def summarize(build_instruction):
+    summary = {field: build_instruction.get(field) for field in INDEXED_FIELDS}
+    summary['status'] = build_status(build_instruction)
+    summary['id'] = build_instruction['id']
+    summary['finished'] = build_instruction.get('finished', 0)
+    return summary
+
+
+def matches(summary, filters):
+    for field, value in filters.items():
+        if summary.get(field) != value:
+            return False
+    return True
+
+
+class PastBuilds:
+    """
+    Finished build instructions. Only the most recent ones are kept in
+    memory: when there are more than max_count of them, or when they
+    are older than max_age seconds, the oldest ones are moved to an
+    on-disk archive in /var/cache/docserv/[SERVER_NAME]-archive/.
+
+    The archive consists of one JSON lines file per month with the full
+    build instructions and an index file that has one small summary
+    (ID, product, docset, language, target, status, time, position in
+    the archive file) per archived build instruction. Neither is held
+    in memory, the index and the archived build instructions are read
+    from disk when a query asks for them.
+
+    Can be used like the dict it replaces: past_builds[ID] = build
+    instruction, past_builds.pop(ID), ID in past_builds, ...
+    """
+
+    def __init__(self, server_name, max_count=1000, max_age=None):
+        self.archive_dir = os.path.join(CACHE_DIR, server_name + '-archive')
+        self.index_path = os.path.join(self.archive_dir, 'index.jsonl')
+        self.max_count = max_count
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        # BUILD_INSTRUCTION_ID -> build instruction, oldest first
+        self.builds = OrderedDict()
+        # field -> value -> set of BUILD_INSTRUCTION_IDs, for self.builds
+        self.index = {field: {} for field in INDEXED_FIELDS}
+        self.summaries = {}
+
+    def archived_summaries(self):
+        """
+        Summaries of the archived build instructions from the archive
+        index, oldest first.
+        """
+        try:
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        logger.warning("Ignoring broken line in archive index %s",
+                                       self.index_path)
+        except FileNotFoundError:
+            return
+
+    def add_to_index(self, build_instruction_id, summary):
+        self.summaries[build_instruction_id] = summary
+        for field in INDEXED_FIELDS:
+            self.index[field].setdefault(summary[field], set()).add(build_instruction_id)
+
+    def remove_from_index(self, build_instruction_id):
+        summary = self.summaries.pop(build_instruction_id)
+        for field in INDEXED_FIELDS:
+            ids = self.index[field][summary[field]]
+            ids.discard(build_instruction_id)
+            if not ids:
+                del self.index[field][summary[field]]
+
+    def __setitem__(self, build_instruction_id, build_instruction):
+        self.add(build_instruction)
+
+    def __getitem__(self, build_instruction_id):
+        with self.lock:
+            return self.builds[build_instruction_id]
+
+    def __contains__(self, build_instruction_id):
+        with self.lock:
+            return build_instruction_id in self.builds
+
+    def __len__(self):
+        with self.lock:
+            return len(self.builds)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return list(self.builds.keys())
+
+    def values(self):
+        with self.lock:
+            return list(self.builds.values())
+
+    def get(self, build_instruction_id, default=None):
+        with self.lock:
+            return self.builds.get(build_instruction_id, default)
+
+    def pop(self, build_instruction_id, *default):
+        with self.lock:
+            if build_instruction_id not in self.builds:
+                if default:
+                    return default[0]
+                raise KeyError(build_instruction_id)
+            self.remove_from_index(build_instruction_id)
+            return self.builds.pop(build_instruction_id)
+
+    def add(self, build_instruction):
+        """
+        Add a finished build instruction. Returns a list of the
+        BUILD_INSTRUCTION_IDs that were moved to the archive to make
+        room for it.
+        """
+        build_instruction.setdefault('finished', time.time())
+        with self.lock:
+            if build_instruction['id'] in self.builds:
+                self.pop(build_instruction['id'])
+            self.builds[build_instruction['id']] = build_instruction
+            self.add_to_index(build_instruction['id'], summarize(build_instruction))
+            return self.evict()
+
+    def load(self, build_instructions):
+        """
+        Add build instructions from a previous state, oldest first.
+        Returns the list of BUILD_INSTRUCTION_IDs that were archived.
+        """
+        evicted = []
+        for build_instruction in sorted(build_instructions,
+                                        key=lambda bi: bi.get('finished', 0)):
+            evicted += self.add(build_instruction)
+        return evicted
+
+    def evict(self):
+        """
+        Move build instructions to the archive until the limits are met.
+        Must be called with self.lock held.
+        """
+        evicted = []
+        while self.builds:
+            build_instruction_id, build_instruction = next(iter(self.builds.items()))
+            too_old = (self.max_age is not None and
+                       build_instruction['finished'] < time.time() - self.max_age)
+            if len(self.builds) <= self.max_count and not too_old:
+                break
+            self.archive(self.pop(build_instruction_id))
+            evicted.append(build_instruction_id)
+        if evicted:
+            logger.debug("Archived %i past builds", len(evicted))
+        return evicted
+
+    def archive(self, build_instruction):
+        """
+        Append a build instruction to the archive file of the month it
+        finished in and its summary to the archive index.
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_file = time.strftime('%Y-%m.jsonl', time.gmtime(build_instruction['finished']))
+        with open(os.path.join(self.archive_dir, archive_file), 'a') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(json.dumps(build_instruction) + '\n')
+        summary = summarize(build_instruction)
+        summary['file'] = archive_file
+        summary['offset'] = offset
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+
+    def read_archived(self, summary):
+        with open(os.path.join(self.archive_dir, summary['file']), 'r') as f:
+            f.seek(summary['offset'])
+            return json.loads(f.readline())
+
+    def query(self, filters=None, offset=0, limit=50, archived=False):
+        """
+        Return finished build instructions that match all filters (a
+        dict of INDEXED_FIELDS and values), newest first, paginated with
+        offset and limit. If archived is True, the archive is searched
+        too. Returns a tuple (total number of matches, list of
+        build instructions).
+        """
+        filters = {field: value for field, value in (filters or {}).items()
+                   if field in INDEXED_FIELDS}
+        with self.lock:
+            ids = None
+            for field, value in filters.items():
+                found = self.index[field].get(value, set())
+                ids = found if ids is None else ids & found
+            if ids is None:
+                ids = self.builds.keys()
+            current = sorted(ids, key=lambda build_instruction_id:
+                             -self.summaries[build_instruction_id]['finished'])
+            total = len(current)
+            results = [self.builds[build_instruction_id]
+                       for build_instruction_id in current[offset:offset + limit]]
+            if not archived:
+                return (total, results)
+        # The archive is only read for the part of the page that is not
+        # filled by build instructions in memory.
+        archived_matches = [summary for summary in self.archived_summaries()
+                            if matches(summary, filters)]
+        archived_matches.reverse()
+        archived_offset = max(0, offset - total)
+        archived_limit = limit - len(results)
+        for summary in archived_matches[archived_offset:archived_offset + archived_limit]:
+            results.append(self.read_archived(summary))
+        return (total + len(archived_matches), results)
@@ -0,0 +1,114 @@
+import logging
+import shlex
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('docserv')
+
+
+def run(command):
+    """
+    Run a container engine command, return its return code, stdout and
+    stderr.
+    """
+    try:
+        s = subprocess.Popen(shlex.split(command),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as error:
+        return (127, '', str(error))
+    out, err = s.communicate()
+    return (s.returncode, out.decode('utf-8'), err.decode('utf-8'))
+
+
+class ContainerImage:
+    """
+    The container image d2d_runner builds with, pinned by its ID. It is
+    only pulled again on a schedule (see schedule_updates()) or through
+    the REST API, not for every build. Build instructions keep the image
+    ID they started with and pass it to d2d_runner, see
+    BuildInstructionHandler.
+
+    The container engine is an ordinary command, so a stand-in script can
+    replace it for tests.
+    """
+
+    def __init__(self, engine, image):
+        self.engine = engine
+        self.image = image
+        self.lock = threading.Lock()
+        # Only one image update at a time
+        self.update_lock = threading.Lock()
+        # ID of the pinned image, None if it could not be determined
+        self.image_id = None
+        self.updated = None
+        self.stopped = threading.Event()
+        self.statistics = {'updates': 0}
+
+    def resolve(self):
+        """
+        ID of the local copy of the image, None if there is none.
+        """
+        returncode, out, err = run("%s image inspect --format '{{.Id}}' %s" % (self.engine, self.image))
+        if returncode != 0:
+            logger.warning("Could not get the ID of container image %s: %s",
+                           self.image, err)
+            return None
+        return out.strip()
+
+    def pinned_image(self):
+        """
+        ID of the image that new build instructions are built with. If
+        there is no local copy of the image yet, it is pulled.
+        """
+        with self.lock:
+            image_id = self.image_id
+        if image_id is None:
+            image_id = self.resolve()
+            if image_id is None:
+                image_id = self.update_image()['image']
+            else:
+                with self.lock:
+                    self.image_id = image_id
+        return image_id
+
+    def update_image(self):
+        """
+        Pull the image. Returns a dict with the previous and the current
+        image ID.
+        """
+        with self.update_lock:
+            logger.info("Updating container image %s", self.image)
+            returncode, _, err = run("%s pull %s" % (self.engine, self.image))
+            if returncode != 0:
+                logger.warning("Could not pull container image %s: %s", self.image, err)
+            image_id = self.resolve()
+            with self.lock:
+                previous = self.image_id
+                if image_id is not None:
+                    self.image_id = image_id
+                    self.updated = time.time()
+                    self.statistics['updates'] += 1
+        return {'image': image_id if image_id is not None else previous,
+                'previous': previous,
+                'changed': image_id is not None and image_id != previous}
+
+    def schedule_updates(self, interval):
+        """
+        Pull the image every interval seconds until shutdown().
+        """
+        def update():
+            while not self.stopped.wait(interval):
+                self.update_image()
+        threading.Thread(target=update, daemon=True).start()
+
+    def shutdown(self):
+        self.stopped.set()
+
+    def dict(self):
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics['image'] = self.image
+            statistics['image_id'] = self.image_id
+            statistics['updated'] = self.updated
+        return statistics
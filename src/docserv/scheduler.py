@@ -0,0 +1,221 @@
+import logging
+
+logger = logging.getLogger('docserv')
+
+# Range of the priority that can be sent with a build instruction
+MIN_PRIORITY = -20
+MAX_PRIORITY = 20
+# Bound of the exponent of the weights of the FairScheduler, effective
+# priorities can be larger with the configured priorities added
+MAX_WEIGHT_EXPONENT = 64
+
+
+def valid_priority(priority):
+    """
+    True if priority can be sent with a build instruction.
+    """
+    return (isinstance(priority, int) and not isinstance(priority, bool)
+            and MIN_PRIORITY <= priority <= MAX_PRIORITY)
+
+
+def parse_priorities(value):
+    """
+    Parse a list of priorities from the .ini file into a dict.
+    Example: "en-us=10 de-de=5" -> {'en-us': 10, 'de-de': 5}
+    """
+    priorities = {}
+    for item in value.split():
+        name, _, priority = item.partition('=')
+        priorities[name] = int(priority)
+    return priorities
+
+
+class Scheduler:
+    """
+    A Scheduler decides in which order workers pick up work. It is asked
+    which scheduled build instruction to parse next, which
+    BuildInstructionHandler to take a deliverable from and which of
+    the open deliverables of that BIH to build.
+
+    All methods are called by DocservState while it holds its
+    work_condition, so the scheduler does not need locks of its own.
+
+    This base class is the round-robin policy: build instructions are
+    parsed in the order they arrived, BIHs take turns and deliverables
+    are built in the order of the configuration.
+    """
+    name = 'roundrobin'
+
+    def __init__(self, config, history=None):
+        self.config = config
+        # DurationHistory used to estimate the cost of deliverables.
+        self.history = history
+        self.target_priorities = parse_priorities(
+            config['server'].get('target_priorities', ''))
+        self.product_priorities = parse_priorities(
+            config['server'].get('product_priorities', ''))
+        self.language_priorities = parse_priorities(
+            config['server'].get('language_priorities', ''))
+        # Increases with every deliverable that is handed out. Used to
+        # find the BIH that was served least recently.
+        self.tick = 0
+        self.last_served = {}
+
+    def priority(self, build_instruction):
+        """
+        Effective priority of a build instruction: the priority that
+        was sent with the build instruction plus the configured
+        priorities of its target, product and language. Higher values
+        are built first.
+        """
+        try:
+            priority = int(build_instruction.get('priority', 0))
+        except (TypeError, ValueError):
+            priority = 0
+        priority += self.target_priorities.get(build_instruction['target'], 0)
+        priority += self.product_priorities.get(build_instruction['product'], 0)
+        priority += self.language_priorities.get(build_instruction['lang'], 0)
+        return priority
+
+    def expected_cost(self, deliverable):
+        """
+        Estimate how expensive it is to build a deliverable and the
+        other formats of its group: the expected duration from the build
+        history. Without any history, a set with subdeliverables is
+        assumed to take longer than a single book.
+        """
+        cost = 0
+        for member in [deliverable] + deliverable.group:
+            expected = None
+            if self.history is not None:
+                expected = self.history.expected_deliverable(*member.history_key())
+            if expected is None:
+                expected = 1.0 + len(member.subdeliverables)
+            cost += expected
+        return cost
+
+    def order_build_instructions(self, build_instructions):
+        """
+        Sort scheduled build instructions (a list of dicts in the order
+        they arrived) in the order they should be parsed.
+        """
+        return list(build_instructions)
+
+    def select_build_instruction(self, build_instructions):
+        """
+        Select one of the scheduled build instructions.
+        """
+        return self.order_build_instructions(build_instructions)[0]
+
+    def select_bih(self, bihs):
+        """
+        Select the BIH to take the next deliverable from. bihs is a list
+        of (BUILD_INSTRUCTION_ID, BuildInstructionHandler) tuples of BIHs
+        that have open deliverables. Returns a BUILD_INSTRUCTION_ID.
+        """
+        return min(bihs, key=lambda bih: self.last_served.get(bih[0], 0))[0]
+
+    def order_deliverables(self, deliverables):
+        """
+        Sort the open deliverables (a list of Deliverable objects in
+        configuration order) of a BIH in the order they should be built.
+        """
+        return list(deliverables)
+
+    def select_deliverable(self, deliverables):
+        """
+        Select one of the open deliverables of a BIH.
+        """
+        return self.order_deliverables(deliverables)[0]
+
+    def deliverable_started(self, build_instruction_id, bih, deliverable):
+        """
+        Book keeping after a deliverable was handed out to a worker.
+        """
+        self.tick += 1
+        self.last_served[build_instruction_id] = self.tick
+
+    def build_instruction_finished(self, build_instruction_id):
+        """
+        Forget about a BIH that is finished or was aborted.
+        """
+        self.last_served.pop(build_instruction_id, None)
+
+
+class PriorityScheduler(Scheduler):
+    """
+    Strict priorities: build instructions and BIHs with a higher
+    priority always go first, BIHs of the same priority take turns.
+    Within a BIH, the deliverable that is expected to finish first is
+    built first (shortest expected job first).
+    """
+    name = 'priority'
+
+    def order_build_instructions(self, build_instructions):
+        # sorted() is stable, so build instructions with the same
+        # priority stay in arrival order.
+        return sorted(build_instructions, key=lambda bi: -self.priority(bi))
+
+    def select_bih(self, bihs):
+        return min(bihs, key=lambda bih: (-self.priority(bih[1].build_instruction),
+                                          self.last_served.get(bih[0], 0)))[0]
+
+    def order_deliverables(self, deliverables):
+        return sorted(deliverables, key=self.expected_cost)
+
+
+class FairScheduler(PriorityScheduler):
+    """
+    Weighted fair sharing between BIHs: every BIH is charged the expected
+    cost of the deliverables it was given, divided by its weight, and
+    the BIH with the lowest charge is served next. The weight doubles
+    with every priority step (weight = 2 ** priority), so an urgent
+    build instruction gets a bigger share of the workers without
+    starving all others. A new BIH starts with the lowest charge of all
+    active BIHs, so it cannot monopolize the workers either.
+    """
+    name = 'fair'
+
+    def __init__(self, config, history=None):
+        super().__init__(config, history)
+        self.virtual_time = {}
+
+    def weight(self, build_instruction):
+        exponent = self.priority(build_instruction)
+        return 2.0 ** max(-MAX_WEIGHT_EXPONENT, min(exponent, MAX_WEIGHT_EXPONENT))
+
+    def select_bih(self, bihs):
+        for build_instruction_id, bih in bihs:
+            if build_instruction_id not in self.virtual_time:
+                self.virtual_time[build_instruction_id] = min(
+                    self.virtual_time.values(), default=0.0)
+        return min(bihs, key=lambda bih: (self.virtual_time[bih[0]],
+                                          -self.priority(bih[1].build_instruction),
+                                          self.last_served.get(bih[0], 0)))[0]
+
+    def deliverable_started(self, build_instruction_id, bih, deliverable):
+        super().deliverable_started(build_instruction_id, bih, deliverable)
+        self.virtual_time[build_instruction_id] = self.virtual_time.get(
+            build_instruction_id, 0.0) + (self.expected_cost(deliverable) /
+                                          self.weight(bih.build_instruction))
+
+    def build_instruction_finished(self, build_instruction_id):
+        super().build_instruction_finished(build_instruction_id)
+        self.virtual_time.pop(build_instruction_id, None)
+
+
+SCHEDULERS = {
+    Scheduler.name: Scheduler,
+    PriorityScheduler.name: PriorityScheduler,
+    FairScheduler.name: FairScheduler,
+}
+
+
+def create_scheduler(config, history=None):
+    """
+    Create the scheduler selected with the 'scheduler' key in the
+    [server] section of the .ini file.
+    """
+    scheduler = SCHEDULERS[config['server']['scheduler']](config, history)
+    logger.info("Using %s scheduler", scheduler.name)
+    return scheduler
@@ -0,0 +1,118 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger('docserv')
+
+# Kinds of work and the task of the worker they are used for
+SLOT_KINDS = ('git', 'build', 'publish')
+
+
+class Slots:
+    """
+    Concurrency budgets of the workers. Every kind of work has its own
+    number of slots, so cheap I/O-bound stages don't wait for container
+    builds and the other way around:
+
+    git:     preparing build instructions (fetch and checkout)
+    build:   building deliverables in containers
+    publish: cleaning up finished build instructions (archives,
+             navigation pages, rsync to the backup and target paths)
+
+    Container builds are also limited by a CPU budget, each of them
+    takes build_cpus of it.
+
+    Like the Scheduler, all methods are called while the work_condition
+    of DocservState is held, so no locks are needed here.
+    """
+
+    def __init__(self, config):
+        server = config['server']
+        cpus = os.cpu_count() or 1
+        self.cpu_budget = server.get('cpu_budget') or cpus
+        self.build_cpus = server.get('build_cpus') or 1
+        self.size = {
+            'git': server.get('git_slots') or 2,
+            # Without build_slots, builds are limited like all work
+            # was before, to the number of CPUs and max_threads.
+            'build': server.get('build_slots') or min(cpus, server['max_threads']),
+            'publish': server.get('publish_slots') or 2,
+        }
+        if self.size['build'] * self.build_cpus > self.cpu_budget:
+            logger.info("Only %i builds can run at the same time with a CPU budget of %i",
+                        self.cpu_budget // self.build_cpus, self.cpu_budget)
+        # kind -> set of the slot numbers in use
+        self.used = dict((kind, set()) for kind in SLOT_KINDS)
+        self.cpus_used = 0
+        # Seconds the slots of each kind were in use, and since when
+        self.busy = dict((kind, 0.0) for kind in SLOT_KINDS)
+        self.started = {}
+        self.since = time.time()
+        # Seconds the build slots spent in container builds, without
+        # the other stages of the deliverables
+        self.build_time = 0.0
+
+    def workers(self):
+        """
+        Number of worker threads needed to fill all slots.
+        """
+        return sum(self.size.values())
+
+    def builds(self):
+        """
+        Number of container builds that can run at the same time.
+        """
+        return max(1, min(self.size['build'], self.cpu_budget // self.build_cpus))
+
+    def available(self, kind):
+        if len(self.used[kind]) >= self.size[kind]:
+            return False
+        if kind == 'build' and self.cpus_used + self.build_cpus > self.cpu_budget:
+            # A single build may take more than the budget.
+            return self.cpus_used == 0
+        return True
+
+    def acquire(self, kind):
+        """
+        Take a free slot, returns its number.
+        """
+        slot = min(set(range(self.size[kind])) - self.used[kind])
+        self.used[kind].add(slot)
+        self.started[(kind, slot)] = time.time()
+        if kind == 'build':
+            self.cpus_used += self.build_cpus
+        return slot
+
+    def release(self, kind, slot, build_time=0.0):
+        """
+        Give back a slot. build_time is the time of a build slot that
+        was spent running the container build.
+        """
+        self.used[kind].discard(slot)
+        self.busy[kind] += time.time() - self.started.pop((kind, slot))
+        if kind == 'build':
+            self.cpus_used -= self.build_cpus
+            self.build_time += build_time
+
+    def dict(self):
+        """
+        Number, use and utilization (share of the time in use since the
+        start) of the slots of each kind.
+        """
+        now = time.time()
+        uptime = max(now - self.since, 1)
+        statistics = {'cpu_budget': self.cpu_budget, 'cpus_used': self.cpus_used}
+        for kind in SLOT_KINDS:
+            busy = self.busy[kind] + sum(now - start for (started_kind, _), start
+                                         in self.started.items() if started_kind == kind)
+            statistics[kind] = {
+                'slots': self.size[kind],
+                'used': len(self.used[kind]),
+                'utilization': busy / (uptime * self.size[kind]),
+            }
+        # Share of the time the build slots spent in container builds,
+        # to size build_slots. Other stages of the deliverables (output
+        # transfer, titles) and git and publish work are not counted.
+        statistics['utilization_per_build_slot'] = (
+            self.build_time / (uptime * self.size['build']))
+        return statistics
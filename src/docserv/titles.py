@@ -0,0 +1,83 @@
+import logging
+
+from lxml import etree
+
+logger = logging.getLogger('docserv')
+
+
+def local_name(name):
+    return etree.QName(name).localname
+
+
+def element_id(element):
+    """
+    Value of the id attribute of an element (id or xml:id), None if it
+    has none.
+    """
+    for name, value in element.attrib.items():
+        if local_name(name) == 'id':
+            return value
+    return None
+
+
+def owners(title):
+    """
+    Keys of the elements a title belongs to: the ID of its parent, and of
+    its grandparent if the parent is an info element (info, bookinfo,
+    ...). None stands for the root element.
+    """
+    keys = set()
+    parent = title.getparent()
+    if parent is None:
+        return keys
+    candidates = [parent]
+    if 'info' in local_name(parent.tag) and parent.getparent() is not None:
+        candidates.append(parent.getparent())
+    for candidate in candidates:
+        if candidate.getparent() is None:
+            keys.add(None)
+        if element_id(candidate) is not None:
+            keys.add(element_id(candidate))
+    return keys
+
+
+def extract_titles(bigfile_path, ids):
+    """
+    Find the titles of the elements with the given IDs in a DocBook
+    bigfile with a single pass over the file. The ID None stands for the
+    root element. The title of an element is its first title child or
+    the first title in an info child, whichever comes first.
+    Elements are removed as soon as they are parsed, so the memory used
+    does not grow with the size of the file.
+    Returns a dict that maps each ID to its title, IDs without title
+    are left out.
+    """
+    wanted = set(ids)
+    titles = {}
+    # Number of open title elements. Inline elements of a title are
+    # kept until the title is complete.
+    in_title = 0
+    context = etree.iterparse(bigfile_path, events=('start', 'end'), huge_tree=True,
+                              resolve_entities=True, remove_comments=True,
+                              remove_pis=True)
+    for event, element in context:
+        is_title = local_name(element.tag) == 'title'
+        if event == 'start':
+            if is_title:
+                in_title += 1
+            continue
+        if is_title:
+            in_title -= 1
+            for key in (owners(element) & wanted) - set(titles):
+                titles[key] = ''.join(element.itertext())
+            if len(titles) == len(wanted):
+                break
+        if in_title:
+            continue
+        # The ancestors are still needed to find the owners of titles,
+        # everything before the current element is not.
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    del context
+    return titles
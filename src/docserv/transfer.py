@@ -0,0 +1,152 @@
+import fcntl
+import logging
+import os
+import shutil
+import stat
+import threading
+
+logger = logging.getLogger('docserv')
+
+# ioctl of Linux that makes a file share the data blocks of another one
+# (copy-on-write), supported by btrfs, XFS and others
+FICLONE = 0x40049409
+
+# Ways a file can get to its destination, from cheapest to most
+# expensive. Only 'copied' writes the data again.
+METHODS = ('moved', 'linked', 'reflinked', 'copied')
+
+
+class TransferStats:
+    """
+    Number of files and bytes that were moved, hard linked, reflinked or
+    copied by transfer().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = dict((method, 0) for method in METHODS)
+        self.bytes = dict((method, 0) for method in METHODS)
+
+    def add(self, method, size):
+        with self.lock:
+            self.files[method] += 1
+            self.bytes[method] += size
+
+    def bytes_copied(self):
+        with self.lock:
+            return self.bytes['copied']
+
+    def dict(self):
+        with self.lock:
+            return {'files': dict(self.files), 'bytes': dict(self.bytes)}
+
+
+def reflink(source, destination):
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+    shutil.copystat(source, destination)
+
+
+def is_local(path):
+    """
+    False for rsync URLs like ssh://server/path or server:path.
+    """
+    return '://' not in path and ':' not in path.split('/')[0]
+
+
+def transfer_file(source, destination, same_device, move, stats):
+    """
+    Put the file source at destination, replacing what is there. Files
+    are renamed (move), hard linked or reflinked when source and
+    destination are on the same file system, and copied otherwise. A new
+    file is first created next to the destination and then renamed, so
+    readers never see a partial file.
+    """
+    size = os.lstat(source).st_size
+    if same_device and move:
+        try:
+            os.replace(source, destination)
+            stats.add('moved', size)
+            return
+        except OSError:
+            pass
+    tmp = os.path.join(os.path.dirname(destination),
+                       '.docserv-%s' % os.path.basename(destination))
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    method = 'copied'
+    if same_device:
+        for method, function in (('linked', os.link), ('reflinked', reflink),
+                                 ('copied', shutil.copy2)):
+            try:
+                function(source, tmp)
+                break
+            except OSError:
+                if method == 'copied':
+                    raise
+    else:
+        shutil.copy2(source, tmp)
+    os.replace(tmp, destination)
+    stats.add(method, size)
+
+
+def transfer(source, destination, stats=None, move=False):
+    """
+    Copy source into the directory destination, like `rsync -lr source
+    destination`: if source ends with a slash, its contents are copied,
+    otherwise source itself. Existing files are replaced, other files in
+    destination are kept. Symbolic links are copied as links.
+
+    Instead of copying the data, files are hard linked or reflinked if
+    possible. With move=True, source is not needed afterwards and files
+    are renamed instead. Only across file systems, the data is copied.
+    Raises OSError if a file cannot be transferred.
+    """
+    if stats is None:
+        stats = TransferStats()
+    if not source.endswith('/'):
+        destination = os.path.join(destination, os.path.basename(source))
+        if not os.path.isdir(source) or os.path.islink(source):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            same_device = os.lstat(source).st_dev == os.stat(os.path.dirname(destination)).st_dev
+            transfer_link_or_file(source, destination, same_device, move, stats)
+            return stats
+    source = source.rstrip('/') or '/'
+    os.makedirs(destination, exist_ok=True)
+    same_device = os.stat(source).st_dev == os.stat(destination).st_dev
+    for dirpath, dirnames, filenames in os.walk(source):
+        relative = os.path.relpath(dirpath, source)
+        target_dir = os.path.normpath(os.path.join(destination, relative))
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                # os.walk() does not follow links, copy them as links
+                dirnames.remove(name)
+                filenames.append(name)
+            else:
+                target = os.path.join(target_dir, name)
+                # Links to directories are kept, like rsync --keep-dirlinks
+                # does, see generations.py.
+                if os.path.lexists(target) and not os.path.isdir(target):
+                    os.remove(target)
+                os.makedirs(target, exist_ok=True)
+        for name in filenames:
+            transfer_link_or_file(os.path.join(dirpath, name), os.path.join(target_dir, name),
+                                  same_device, move, stats)
+    return stats
+
+
+def transfer_link_or_file(source, destination, same_device, move, stats):
+    if os.path.isdir(destination) and not os.path.islink(destination):
+        shutil.rmtree(destination)
+    if stat.S_ISLNK(os.lstat(source).st_mode):
+        if os.path.lexists(destination):
+            os.remove(destination)
+        os.symlink(os.readlink(source), destination)
+        return
+    transfer_file(source, destination, same_device, move, stats)
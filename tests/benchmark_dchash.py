@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Compare the speed of docserv.dchash with the former shell implementation
+of docserv-dchash on real DC files and check that both return the same
+hashes.
+
+Usage: benchmark_dchash.py DIRECTORY_OR_DC_FILE...
+For example: benchmark_dchash.py ~/doc-sle ~/doc-modular
+"""
+import os
+import subprocess
+import sys
+import time
+
+from docserv import dchash
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docserv-dchash.sh')
+
+
+def dc_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [name for name in dirs if name != '.git']
+            for name in sorted(files):
+                if name.startswith('DC-'):
+                    yield os.path.join(root, name)
+
+
+def main():
+    files = list(dc_files(sys.argv[1:]))
+    if not files:
+        sys.exit(__doc__)
+
+    start = time.time()
+    shell = [subprocess.check_output(['bash', REFERENCE, path],
+                                     env=dict(os.environ, LC_ALL='C')).decode('utf-8')
+             for path in files]
+    shell_time = time.time() - start
+
+    start = time.time()
+    python = [dchash.dc_hash(path) for path in files]
+    python_time = time.time() - start
+
+    # The same DC files again, as for every format and subdeliverable
+    start = time.time()
+    for path in files:
+        dchash.dc_hash(path)
+    cached_time = time.time() - start
+
+    different = [path for path, a, b in zip(files, shell, python) if a != b]
+    for path in different:
+        print("Different hash: %s" % path)
+    print("%i DC files, %i different hashes" % (len(files), len(different)))
+    print("shell:          %8.3f s" % shell_time)
+    print("python:         %8.3f s (%.0fx faster)" % (python_time, shell_time / max(python_time, 1e-9)))
+    print("python, cached: %8.3f s (%.0fx faster)" % (cached_time, shell_time / max(cached_time, 1e-9)))
+    sys.exit(1 if different else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import os
+
+from docserv import artifacts
+from docserv.artifacts import ArtifactStore
+
+
+def write(path, content='x'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_store_one_format(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, 'CACHE_DIR', str(tmp_path / 'cache'))
+    out = str(tmp_path / 'out')
+    write(os.path.join(out, 'html', 'book', 'index.html'))
+    write(os.path.join(out, 'pdf', 'book.pdf'))
+    write(os.path.join(out, '.tmp', 'book_bigfile.xml'))
+    write(os.path.join(out, 'filelist'), '%s/html/book/\n%s/pdf/book.pdf\n' % (out, out))
+    store = ArtifactStore('test', 1024 * 1024)
+    store.store('abc', out, ['%s/pdf/book.pdf' % out])
+
+    destination = str(tmp_path / 'lookup')
+    os.makedirs(destination)
+    assert store.lookup('abc', destination)
+    assert os.path.isfile(os.path.join(destination, 'pdf', 'book.pdf'))
+    assert os.path.isfile(os.path.join(destination, '.tmp', 'book_bigfile.xml'))
+    assert not os.path.exists(os.path.join(destination, 'html'))
+    with open(os.path.join(destination, 'filelist')) as f:
+        assert f.read() == '%s/pdf/book.pdf\n' % destination
+
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, 'CACHE_DIR', str(tmp_path / 'cache'))
+    store = ArtifactStore('test', 1024 * 1024)
+    for fingerprint in ('a', 'b'):
+        out = str(tmp_path / fingerprint)
+        write(os.path.join(out, 'pdf', 'book.pdf'), fingerprint * 100)
+        write(os.path.join(out, 'filelist'), '%s/pdf/book.pdf\n' % out)
+        store.store(fingerprint, out)
+    # room for two of the artifacts
+    store.max_size = store.size * 5 // 4
+    assert store.lookup('a', str(tmp_path / 'lookup-a'))
+
+    out = str(tmp_path / 'c')
+    write(os.path.join(out, 'pdf', 'book.pdf'), 'c' * 100)
+    write(os.path.join(out, 'filelist'), '%s/pdf/book.pdf\n' % out)
+    store.store('c', out)
+    # b was used least recently
+    assert not store.lookup('b', str(tmp_path / 'lookup-b'))
+    assert store.lookup('a', str(tmp_path / 'lookup-a2'))
+    assert store.dict()['evicted'] == 1
+
+    # the store is loaded again after a restart
+    assert sorted(ArtifactStore('test', store.max_size).artifacts) == ['a', 'c']
@@ -0,0 +1,86 @@
+import importlib.machinery
+import importlib.util
+import os
+import zipfile
+
+import pytest
+
+BIN_DIR = os.path.join(os.path.dirname(__file__), '..', 'bin')
+
+
+def load_script():
+    loader = importlib.machinery.SourceFileLoader(
+        'docserv_create_archive', os.path.join(BIN_DIR, 'docserv-create-archive'))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def create_archive():
+    return load_script()
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def build(tmp_path):
+    write(str(tmp_path / 'in' / 'html' / 'doc' / 'index.html'), b'<html>' * 1000)
+    write(str(tmp_path / 'in' / 'html' / 'doc' / 'images' / 'logo.png'), b'png' * 100)
+    write(str(tmp_path / 'in' / 'pdf' / 'doc.pdf'), b'%PDF' * 100)
+    write(str(tmp_path / 'in' / 'epub' / 'doc.epub'), b'epub' * 100)
+    write(str(tmp_path / 'in' / 'single-html' / 'doc' / 'index.html'), b'single')
+    return tmp_path
+
+
+def test_formats_and_methods(create_archive, build):
+    output = str(build / 'a.zip')
+    create_archive.create_zip_archive(str(build / 'in'), output, 'pdf,epub,html')
+    with zipfile.ZipFile(output) as zip:
+        assert zip.testzip() is None
+        # names are relative to the input path, without a leading slash
+        assert zip.namelist() == ['epub/doc.epub', 'html/doc/index.html',
+                                  'html/doc/images/logo.png', 'pdf/doc.pdf']
+        methods = dict((info.filename, info.compress_type) for info in zip.infolist())
+        assert zip.read('html/doc/index.html') == b'<html>' * 1000
+    assert methods == {
+        'epub/doc.epub': zipfile.ZIP_STORED,
+        'html/doc/index.html': zipfile.ZIP_DEFLATED,
+        'html/doc/images/logo.png': zipfile.ZIP_STORED,
+        'pdf/doc.pdf': zipfile.ZIP_STORED,
+    }
+
+
+def test_reproducible(create_archive, build):
+    first = str(build / 'first.zip')
+    second = str(build / 'second.zip')
+    create_archive.create_zip_archive(str(build / 'in'), first, 'pdf,html')
+    os.utime(str(build / 'in' / 'pdf' / 'doc.pdf'), (0, 0))
+    create_archive.create_zip_archive(str(build / 'in'), second, 'pdf,html')
+    with open(first, 'rb') as f, open(second, 'rb') as g:
+        assert f.read() == g.read()
+    assert not os.path.samefile(first, second)
+
+
+def test_previous_archive(create_archive, build):
+    first = str(build / 'first.zip')
+    second = str(build / 'second.zip')
+    create_archive.create_zip_archive(str(build / 'in'), first, 'pdf,html')
+    create_archive.create_zip_archive(str(build / 'in'), second, 'pdf,html', first)
+    # unchanged archives are linked, not written again
+    assert os.path.samefile(first, second)
+
+    write(str(build / 'in' / 'pdf' / 'doc.pdf'), b'%PDF changed')
+    third = str(build / 'third.zip')
+    create_archive.create_zip_archive(str(build / 'in'), third, 'pdf,html', first)
+    assert not os.path.samefile(first, third)
+    with zipfile.ZipFile(third) as zip:
+        assert zip.testzip() is None
+        assert zip.read('pdf/doc.pdf') == b'%PDF changed'
+        assert zip.read('html/doc/index.html') == b'<html>' * 1000
+
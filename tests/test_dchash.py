@@ -0,0 +1,70 @@
+import os
+import subprocess
+
+import pytest
+from docserv.dchash import dc_hash
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docserv-dchash.sh')
+
+DC_FILES = {
+    'DC-SLES-admin': b"""## ----------------------------
+## Doc Config File for SLES
+## Administration Guide
+## ----------------------------
+##
+## Basics
+MAIN="MAIN.SLEDS.xml"
+ROOTID="book-admin"
+
+## Profiling
+PROFOS="sles"
+PROFARCH="x86_64;zseries;power;aarch64"
+PROFCONDITION="suse-product"
+
+## stylesheet location
+STYLEROOT="/usr/share/xml/docbook/stylesheet/suse2022-ns"
+FALLBACK_STYLEROOT="/usr/share/xml/docbook/stylesheet/suse-ns"
+""",
+    'DC-SLES-all': b"""MAIN = 'MAIN.SLEDS.xml'\r
+PROFOS = sles;osuse; sles\r
+PROFARCH="zseries ; x86_64;;"\r
+PROFCONDITION=""\r
+XSLTPARAM="--stringparam homepage='https://www.suse.com'"\r
+""",
+    'DC-escapes': b"""MAIN="main.xml"
+ROOTID=book\\tone
+PROFOS=a\\x3bb;\\0101
+PROFARCH=\\u00e9\\c
+ROOTID=again
+""",
+    'DC-empty': b"""# nothing relevant
+STYLEROOT=/usr/share/xml/docbook/stylesheet/suse2022-ns
+""",
+}
+
+
+@pytest.fixture
+def dc_dir(tmp_path):
+    for name, content in DC_FILES.items():
+        (tmp_path / name).write_bytes(content)
+    return tmp_path
+
+
+def reference(path, root_id=None):
+    cmd = ['bash', REFERENCE, path] + ([root_id] if root_id else [])
+    return subprocess.check_output(cmd, env=dict(os.environ, LC_ALL='C')).decode('utf-8')
+
+
+@pytest.mark.parametrize("name", sorted(DC_FILES))
+@pytest.mark.parametrize("root_id", [None, 'book-reference', 'set\\ttwo'])
+def test_same_as_shell_version(dc_dir, name, root_id):
+    path = str(dc_dir / name)
+    assert dc_hash(path, root_id) == reference(path, root_id)
+
+
+def test_cache_notices_changes(dc_dir):
+    path = dc_dir / 'DC-SLES-admin'
+    first = dc_hash(str(path))
+    assert dc_hash(str(path)) == first
+    path.write_bytes(DC_FILES['DC-SLES-admin'].replace(b'PROFOS="sles"', b'PROFOS="sled;sles"'))
+    assert dc_hash(str(path)) != first
@@ -0,0 +1,216 @@
+import os
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+from docserv import artifacts
+from docserv import deliverable as deliverable_module
+from docserv.artifacts import ArtifactStore
+from docserv.deliverable import Deliverable
+
+
+class FakeBIH:
+    """
+    The parts of a BuildInstructionHandler a Deliverable uses.
+    """
+
+    def __init__(self, tmp_path, runner):
+        self.config = {
+            'server': {'name': 'test', 'container_runner': str(runner),
+                       'container_engine': 'docker'},
+            'targets': {'internal': {'remarks': 'no', 'draft': 'no', 'meta': 'no',
+                                     'default_xslt_params': str(tmp_path / 'xslt-params.txt'),
+                                     'backup_path': str(tmp_path / 'backup')}},
+        }
+        self.build_instruction = {'id': 'bi', 'target': 'internal', 'product': 'sles',
+                                  'docset': '15', 'lang': 'en-us', 'commit': 'c1'}
+        self.deliverables = {}
+        self.deliverables_open_lock = threading.Lock()
+        self.deliverables_building = []
+        self.deliverables_building_lock = threading.Lock()
+        self.deliverables_running = {}
+        self.deliverable_cache_base_dir = str(tmp_path / 'cache')
+        self.history = None
+        self.artifacts = None
+        self.container_image = 'sha256:1'
+        self.lifecycle = 'supported'
+        self.trees = {'.': 'tree1'}
+
+    def source_tree_hashes(self, source_dir):
+        return dict(self.trees)
+
+    def add(self, deliverable):
+        self.deliverables[deliverable.id] = deliverable.dict()
+        self.deliverables_building.append(deliverable.id)
+        return deliverable
+
+
+def script(path, text):
+    path.write_text("#!/bin/sh\n" + text)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return path
+
+
+def make_deliverable(tmp_path, parent, build_format='pdf'):
+    source_dir = tmp_path / 'source'
+    if not source_dir.exists():
+        source_dir.mkdir()
+        (source_dir / 'DC-book').write_text('MAIN="book.xml"\n')
+    tmp_dir_bi = tmp_path / 'bi'
+    return parent.add(Deliverable(parent, 'DC-book',
+                                  (str(source_dir), str(tmp_dir_bi), 'en-us/sles/15'),
+                                  build_format, [], []))
+
+
+def running(pid):
+    try:
+        with open('/proc/%i/stat' % pid) as f:
+            return f.read().split(') ')[1][0] != 'Z'
+    except OSError:
+        return False
+
+
+def test_cancel_kills_the_process_group(tmp_path):
+    # The runner starts a child that would keep running if only the
+    # runner itself was killed.
+    runner = script(tmp_path / 'runner', "sleep 30 &\necho $! > %s\nwait\n" % (tmp_path / 'pid'))
+    parent = FakeBIH(tmp_path, runner)
+    deliverable = make_deliverable(tmp_path, parent)
+    deliverable.tmp_dir_docker = str(tmp_path / 'out')
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        deliverable.build([deliverable], 0)))
+    start = time.time()
+    thread.start()
+    while not (deliverable.processes and os.path.exists(str(tmp_path / 'pid'))):
+        assert time.time() - start < 10
+        time.sleep(0.05)
+    deliverable.cancel()
+    thread.join(10)
+    # the worker gets its build slot back right away
+    assert not thread.is_alive()
+    assert results == [False]
+    assert time.time() - start < 10
+    pid = int((tmp_path / 'pid').read_text())
+    for _ in range(100):
+        if not running(pid):
+            break
+        time.sleep(0.05)
+    assert not running(pid)
+    assert parent.deliverables[deliverable.id]['status'] == 'cancelled'
+    assert parent.deliverables_building == []
+
+
+def test_shared_build_is_killed_when_all_formats_are_cancelled(tmp_path):
+    parent = FakeBIH(tmp_path, 'true')
+    leader = make_deliverable(tmp_path, parent, 'pdf')
+    member = make_deliverable(tmp_path, parent, 'epub')
+    member.leader = leader
+    leader.group = [member]
+    process = subprocess.Popen(['sleep', '30'], start_new_session=True)
+    try:
+        leader.process_started(process)
+        member.cancel()
+        assert process.poll() is None
+        leader.cancel()
+        assert process.wait(10) != 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+
+
+def test_fingerprint(tmp_path):
+    parent = FakeBIH(tmp_path, 'true')
+    deliverable = make_deliverable(tmp_path, parent)
+    fingerprint = deliverable.fingerprint()
+    assert fingerprint is not None
+    assert deliverable.fingerprint() == fingerprint
+
+    # a changed input file changes the fingerprint
+    (tmp_path / 'source' / 'DC-book').write_text('MAIN="other.xml"\n')
+    assert deliverable.fingerprint() != fingerprint
+    (tmp_path / 'source' / 'DC-book').write_text('MAIN="book.xml"\n')
+    assert deliverable.fingerprint() == fingerprint
+
+    parent.trees = {'.': 'tree2'}
+    assert deliverable.fingerprint() != fingerprint
+    parent.trees = {'.': 'tree1'}
+    parent.container_image = 'sha256:2'
+    assert deliverable.fingerprint() != fingerprint
+    assert make_deliverable(tmp_path, parent, 'epub').fingerprint() != fingerprint
+    # without a pinned image there is nothing to compare
+    parent.container_image = None
+    assert deliverable.fingerprint() is None
+
+
+def test_unchanged_deliverable_is_reused(tmp_path, monkeypatch):
+    monkeypatch.setattr(deliverable_module, 'CACHE_DIR', str(tmp_path / 'var'))
+    parent = FakeBIH(tmp_path, 'false')
+    parent.config['server']['incremental_builds'] = 'yes'
+    first = make_deliverable(tmp_path, parent)
+    first.set_paths()
+    # the last successful build
+    parent.deliverables[first.id].update({
+        'successful_build_fingerprint': first.fingerprint(),
+        'path': 'en-us/sles/15/pdf/book.pdf',
+        'title': 'Book',
+    })
+    pdf = tmp_path / 'backup' / 'en-us' / 'sles' / '15' / 'pdf' / 'book.pdf'
+    pdf.parent.mkdir(parents=True)
+    pdf.write_text('pdf')
+    os.makedirs(os.path.dirname(first.incremental_cache_file))
+    with open(first.incremental_cache_file, 'w') as f:
+        f.write('<document/>')
+
+    deliverable = make_deliverable(tmp_path, parent)
+    deliverable.start(0)
+    assert deliverable.reuse_unchanged(0)
+    assert parent.deliverables[deliverable.id]['status'] == 'unchanged'
+    assert parent.deliverables[deliverable.id]['title'] == 'Book'
+    assert (tmp_path / 'bi' / 'en-us' / 'sles' / '15' / 'pdf' / 'book.pdf').read_text() == 'pdf'
+    assert os.path.isfile(os.path.join(deliverable.deliverable_cache_dir, 'DC-book.xml'))
+
+    # the DC file changed, it is built again
+    (tmp_path / 'source' / 'DC-book').write_text('MAIN="other.xml"\n')
+    deliverable = make_deliverable(tmp_path, parent)
+    deliverable.start(0)
+    assert not deliverable.reuse_unchanged(0)
+
+
+def test_same_fingerprint_reuses_the_artifact(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, 'CACHE_DIR', str(tmp_path / 'var'))
+    runner = script(tmp_path / 'runner', """
+for arg; do case "$arg" in --out=*) out="${arg#--out=}" ;; esac; done
+echo run >> %s
+mkdir -p "$out/pdf"
+echo pdf > "$out/pdf/book.pdf"
+echo "$out/pdf/book.pdf" > "$out/filelist"
+""" % (tmp_path / 'runs'))
+    parent = FakeBIH(tmp_path, runner)
+    parent.artifacts = ArtifactStore('test', 1024 * 1024)
+
+    def prepare():
+        deliverable = make_deliverable(tmp_path, parent)
+        deliverable.start(0)
+        deliverable.tmp_dir_docker = tempfile.mkdtemp(dir=str(tmp_path))
+        return deliverable
+
+    first = prepare()
+    assert not first.lookup_artifact(0)
+    assert first.build([first], 0)
+
+    second = prepare()
+    assert second.input_fingerprint == first.input_fingerprint
+    assert second.lookup_artifact(0)
+    assert (tmp_path / 'runs').read_text() == 'run\n'
+    with open(os.path.join(second.tmp_dir_docker, 'pdf', 'book.pdf')) as f:
+        assert f.read() == 'pdf\n'
+    # the paths in the file list point to the new directory
+    with open(os.path.join(second.tmp_dir_docker, 'filelist')) as f:
+        assert f.read() == '%s/pdf/book.pdf\n' % second.tmp_dir_docker
+    assert parent.artifacts.dict()['hits'] == 1
+
+    (tmp_path / 'source' / 'DC-book').write_text('MAIN="other.xml"\n')
+    assert not prepare().lookup_artifact(0)
@@ -0,0 +1,142 @@
+import threading
+
+import pytest
+from docserv import journal, retention
+from docserv.docserv import DocservState
+from docserv.journal import StateJournal
+from docserv.retention import PastBuilds
+from docserv.scheduler import Scheduler
+
+
+class FakeBIH:
+    def __init__(self, build_instruction):
+        self.build_instruction = build_instruction
+        self.cancelled = False
+        self.cleaned_up = False
+
+    def cancel(self, deliverable_id=None):
+        self.cancelled = True
+        return True
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+    def dict(self):
+        return dict(self.build_instruction)
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(retention, 'CACHE_DIR', str(tmp_path))
+    state = DocservState()
+    state.config = {'server': {}}
+    state.scheduler = Scheduler(state.config)
+    state.journal = StateJournal('test', 1000)
+    state.past_builds = PastBuilds('test')
+    state.scheduled_build_instruction = {}
+    state.updating_build_instruction = []
+    state.bih_dict = {}
+    state.pending_rebuilds = {}
+    state.bih_queue = []
+    state.work_condition = threading.Condition()
+    return state
+
+
+def request(commit=None):
+    build_instruction = {'target': 'internal', 'product': 'sles', 'docset': '15',
+                         'lang': 'en-us'}
+    if commit is not None:
+        build_instruction['commit'] = commit
+    return build_instruction
+
+
+def start_building(state):
+    """
+    Take the scheduled build instruction up like parse_build_instruction().
+    """
+    build_instruction = state.get_scheduled_build_instruction()
+    bih = FakeBIH(build_instruction)
+    state.bih_dict[build_instruction['id']] = bih
+    state.remove_scheduled_build_instruction(build_instruction['id'])
+    return bih
+
+
+def test_repeated_requests_are_queued_once(state):
+    assert state.queue_build_instruction(request())
+    # already queued, the latest commit is built anyway
+    assert not state.queue_build_instruction(request())
+    assert len(state.scheduled_build_instruction) == 1
+    assert state.pending_rebuilds == {}
+
+
+def test_requests_during_a_build_give_one_rebuild(state):
+    state.queue_build_instruction(request())
+    bih = start_building(state)
+    build_instruction_id = bih.build_instruction['id']
+    for commit in ('a', 'b', 'c'):
+        assert state.queue_build_instruction(request(commit))
+    assert state.scheduled_build_instruction == {}
+    assert list(state.pending_rebuilds) == [build_instruction_id]
+    assert bih.build_instruction['rebuild_pending']
+    # the running build is not preempted by default
+    assert not bih.cancelled
+
+    state.finish_build_instruction(build_instruction_id)
+    assert bih.cleaned_up
+    assert list(state.scheduled_build_instruction) == [build_instruction_id]
+    # the rebuild is for the latest request
+    assert state.scheduled_build_instruction[build_instruction_id]['commit'] == 'c'
+    assert state.pending_rebuilds == {}
+
+    # nothing more is queued after the rebuild
+    start_building(state)
+    state.finish_build_instruction(build_instruction_id)
+    assert state.scheduled_build_instruction == {}
+    assert state.past_builds.get(build_instruction_id)['commit'] == 'c'
+
+
+def test_request_while_updating_gives_one_rebuild(state):
+    state.queue_build_instruction(request())
+    build_instruction = state.get_scheduled_build_instruction()
+    state.queue_build_instruction(request('a'))
+    state.queue_build_instruction(request('b'))
+    assert list(state.pending_rebuilds) == [build_instruction['id']]
+    state.bih_dict[build_instruction['id']] = FakeBIH(build_instruction)
+    state.remove_scheduled_build_instruction(build_instruction['id'])
+
+    state.finish_build_instruction(build_instruction['id'])
+    assert state.scheduled_build_instruction[build_instruction['id']]['commit'] == 'b'
+
+
+def test_cancel_scheduled_build_instruction(state):
+    state.queue_build_instruction(request())
+    build_instruction_id = list(state.scheduled_build_instruction)[0]
+    assert state.cancel_build_instruction(build_instruction_id)
+    assert state.scheduled_build_instruction == {}
+    assert state.past_builds.get(build_instruction_id)['status'] == 'cancelled'
+    assert not state.cancel_build_instruction(build_instruction_id)
+
+
+def test_cancel_drops_the_pending_rebuild(state):
+    state.queue_build_instruction(request())
+    bih = start_building(state)
+    state.queue_build_instruction(request('a'))
+    assert state.cancel_build_instruction(bih.build_instruction['id'])
+    assert bih.cancelled
+    assert state.pending_rebuilds == {}
+    state.finish_build_instruction(bih.build_instruction['id'])
+    assert state.scheduled_build_instruction == {}
+
+
+def test_preempt_obsolete_builds(state):
+    state.config['server']['preempt_obsolete_builds'] = 'yes'
+    state.queue_build_instruction(request('a'))
+    bih = start_building(state)
+    # the commit that is building already
+    state.queue_build_instruction(request('a'))
+    assert not bih.cancelled
+    state.queue_build_instruction(request('b'))
+    assert bih.cancelled
+    state.finish_build_instruction(bih.build_instruction['id'])
+    assert state.scheduled_build_instruction[bih.build_instruction['id']]['commit'] == 'b'
@@ -0,0 +1,66 @@
+import os
+
+from docserv.generations import (activate, collect_garbage, current_generation,
+                                 generation_path, list_generations, new_generation,
+                                 prune_inherited, valid_name)
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_activate_and_rollback(tmp_path):
+    backup = str(tmp_path)
+    docset = 'en-us/sles/15'
+    # docset directory of an older version
+    write(os.path.join(backup, docset, 'index.html'), 'navigation')
+    write(os.path.join(backup, docset, 'html', 'book', 'index.html'), 'old')
+
+    first = new_generation(backup, docset)
+    write(os.path.join(generation_path(backup, docset, first), 'html', 'book', 'index.html'), 'new')
+    activate(backup, docset, first)
+    assert os.path.islink(os.path.join(backup, docset))
+    assert current_generation(backup, docset) == first
+    with open(os.path.join(backup, docset, 'html', 'book', 'index.html')) as f:
+        assert f.read() == 'new'
+    # the navigation page is kept
+    assert os.path.isfile(os.path.join(backup, docset, 'index.html'))
+    assert len(list_generations(backup, docset)) == 2
+
+    second = new_generation(backup, docset)
+    activate(backup, docset, second)
+    activate(backup, docset, first)
+    assert current_generation(backup, docset) == first
+
+    # the live generation is kept
+    collect_garbage(backup, docset, 1).join()
+    assert list_generations(backup, docset) == [first, second]
+
+
+def test_valid_name():
+    assert valid_name('15-SP5')
+    assert valid_name('20240101T000000.000000-abc')
+    for name in ('', '.', '..', '../../etc', 'a/b', None, ['15']):
+        assert not valid_name(name)
+
+
+def test_prune_inherited(tmp_path):
+    backup = str(tmp_path)
+    docset = 'en-us/sles/15'
+    first = new_generation(backup, docset)
+    write(os.path.join(generation_path(backup, docset, first), 'index.html'), 'navigation')
+    write(os.path.join(generation_path(backup, docset, first), 'old.zip'), 'archive')
+    activate(backup, docset, first)
+
+    second = new_generation(backup, docset)
+    activate(backup, docset, second)
+    assert os.path.isfile(os.path.join(backup, docset, 'old.zip'))
+    # the navigation page is regenerated, the archive is not
+    os.remove(os.path.join(backup, docset, 'index.html'))
+    write(os.path.join(backup, docset, 'index.html'), 'new navigation')
+    assert prune_inherited(backup, docset, second) == ['old.zip']
+    assert os.path.isfile(os.path.join(backup, docset, 'index.html'))
+    assert not os.path.exists(os.path.join(backup, docset, 'old.zip'))
+    assert prune_inherited(backup, docset, second) == []
@@ -0,0 +1,26 @@
+from docserv import journal
+from docserv.journal import StateJournal
+
+
+def test_replay_updates(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, 'CACHE_DIR', str(tmp_path))
+    state = StateJournal('test')
+    build_instruction = {'id': 'a', 'status': None, 'deliverables': dict(
+        (str(i), {'status': 'building'}) for i in range(10))}
+    state.record('a', lambda build_instruction_id: build_instruction)
+    for i in range(10):
+        build_instruction['deliverables'][str(i)]['status'] = 'success'
+        state.record('a', lambda build_instruction_id: build_instruction)
+    del build_instruction['deliverables']['0']
+    build_instruction['finished'] = 1
+    build_instruction.pop('status')
+    state.record('a', lambda build_instruction_id: build_instruction)
+    state.record('b', lambda build_instruction_id: None)
+
+    with open(state.journal_path) as f:
+        lines = f.readlines()
+    # header, the full BI, one update per change
+    assert len(lines) == 1 + 1 + 10 + 1 + 1
+    # only the deliverable that changed
+    assert '"0"' in lines[2] and '"1"' not in lines[2]
+    assert StateJournal('test').load() == {'a': build_instruction}
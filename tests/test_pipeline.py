@@ -0,0 +1,99 @@
+import os
+import time
+
+from docserv.pipeline import Pipeline, execute
+
+
+class Owner:
+    def __init__(self):
+        self.cancelled = False
+        self.step_durations = {}
+        self.step_rusage = {}
+        self.failed = []
+
+    def step_failed(self, command, result):
+        self.failed.append((command['step'], result['err']))
+
+    def fill_in(self, command, thread_id):
+        command['cmd'] = command['cmd'].replace('__SECONDS__', '0.5')
+        return command
+
+    def broken_hook(self, command, thread_id):
+        raise ValueError("broken")
+
+
+def test_execute():
+    result = execute("sh -c 'echo out; echo err >&2; exit 3'")
+    assert (result['returncode'], result['out'], result['err']) == (3, b'out\n', b'err\n')
+    assert result['rusage'] is not None
+
+
+def test_timeout():
+    result = execute("sleep 10", timeout=0.2)
+    assert result['timed_out']
+    assert result['returncode'] != 0
+
+
+def test_independent_steps_run_concurrently(tmp_path):
+    owner = Owner()
+    start = time.time()
+    assert Pipeline(owner).run([
+        {'cmd': "sleep __SECONDS__", 'step': 'first', 'pre_cmd_hook': 'fill_in'},
+        {'cmd': "sleep __SECONDS__", 'step': 'second', 'pre_cmd_hook': 'fill_in', 'after': []},
+        {'action': 'mkdir', 'args': [str(tmp_path / 'out')], 'step': 'mkdir',
+         'after': ['first', 'second']},
+    ])
+    assert time.time() - start < 0.9
+    assert os.path.isdir(str(tmp_path / 'out'))
+    # hooks are recorded per step
+    assert set(owner.step_durations) == {'first:fill_in', 'first', 'second:fill_in',
+                                         'second', 'mkdir'}
+    assert set(owner.step_rusage) == {'first', 'second'}
+
+
+def test_cleanup_steps_run_after_failure(tmp_path):
+    owner = Owner()
+    (tmp_path / 'params').write_text('')
+    assert not Pipeline(owner).run([
+        {'action': 'write_param_file', 'args': [str(tmp_path / 'params'), 'a=1'],
+         'step': 'write'},
+        {'cmd': "sh -c 'echo broken >&2; exit 1'", 'step': 'build'},
+        {'cmd': "true", 'step': 'skipped'},
+        {'action': 'remove', 'args': [str(tmp_path / 'params')], 'step': 'remove',
+         'cleanup': True},
+    ])
+    assert owner.failed == [('build', b'broken\n')]
+    assert 'skipped' not in owner.step_durations
+    assert not os.path.exists(str(tmp_path / 'params'))
+
+
+def test_dependencies():
+    owner = Owner()
+    start = time.time()
+    result = Pipeline(owner, stop_on_failure=False).run([
+        {'cmd': "sleep 0.5", 'step': 'archive', 'after': []},
+        {'cmd': "sleep 0.5", 'step': 'navigation', 'after': []},
+        {'cmd': "false", 'step': 'backup', 'after': []},
+        {'cmd': "true", 'step': 'activate', 'after': ['archive', 'backup'],
+         'after_success': True},
+        {'cmd': "true", 'step': 'sync', 'after': ['navigation', 'activate'],
+         'after_success': ['navigation']},
+    ])
+    # independent stages run at the same time
+    assert time.time() - start < 0.9
+    assert not result
+    assert 'activate' not in owner.step_durations
+    assert 'sync' in owner.step_durations
+
+
+def test_exceptions_fail_the_step(tmp_path):
+    owner = Owner()
+    assert not Pipeline(owner, stop_on_failure=False).run([
+        {'cmd': "true", 'step': 'pre', 'pre_cmd_hook': 'broken_hook'},
+        {'cmd': "true", 'step': 'post', 'post_cmd_hook': 'broken_hook'},
+        {'action': 'mkdir', 'args': [None], 'step': 'action'},
+        {'action': 'remove', 'args': [str(tmp_path / 'missing')], 'step': 'remove',
+         'cleanup': True},
+    ])
+    assert [step for step, _ in owner.failed] == ['action']
+    assert 'remove' in owner.step_durations
@@ -0,0 +1,139 @@
+import os
+
+from docserv import publisher
+from docserv.generations import activate, collect_garbage, generation_path, new_generation
+from docserv.publisher import Publisher, docset_paths, excluded
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(publisher, 'CACHE_DIR', str(tmp_path / 'cache'))
+    backup = str(tmp_path / 'backup')
+    write(os.path.join(backup, 'en-us/sles/15/html/index.html'), 'one')
+    write(os.path.join(backup, 'en-us/sles/15/html/old.html'), 'old')
+    write(os.path.join(backup, 'en-us/sled/15/html/index.html'), 'other docset')
+    write(os.path.join(backup, 'index.html'), 'navigation')
+    pub = Publisher('test', 3600)
+    assert pub.full_sync_due('internal')
+
+    scopes = {'en-us/sles/15': None, 'navigation': ['index.html']}
+    manifests, transfer, delete = pub.changes('internal', backup, scopes)
+    assert transfer == ['en-us/sles/15/html/index.html', 'en-us/sles/15/html/old.html',
+                        'index.html']
+    assert delete == []
+    pub.commit('internal', manifests, full=True)
+    assert not pub.full_sync_due('internal')
+
+    # unchanged content with a new modification time is not published
+    write(os.path.join(backup, 'en-us/sles/15/html/index.html'), 'one')
+    write(os.path.join(backup, 'en-us/sles/15/pdf/book.pdf'), 'pdf')
+    os.remove(os.path.join(backup, 'en-us/sles/15/html/old.html'))
+    manifests, transfer, delete = pub.changes('internal', backup, scopes)
+    assert transfer == ['en-us/sles/15/pdf/book.pdf']
+    assert delete == ['en-us/sles/15/html/old.html']
+    pub.commit('internal', manifests, len(transfer), len(delete))
+    assert pub.dict()['files_deleted'] == 1
+    assert pub.changes('internal', backup, scopes)[1:] == ([], [])
+
+
+def test_excludes_and_moved_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(publisher, 'CACHE_DIR', str(tmp_path / 'cache'))
+    assert excluded('en-us/sles/15/index.html.bak', ['*.bak'])
+    assert excluded('en-us/.git/config', ['.git/'])
+    assert not excluded('en-us/sles/15/index.html', ['*.bak', '.git/'])
+
+    backup = str(tmp_path / 'backup')
+    write(os.path.join(backup, 'en-us/sles/15/index.html'), 'docset')
+    write(os.path.join(backup, 'en-us/sles/15/index.html.bak'), 'backup')
+    pub = Publisher('test', 3600)
+    pub.excludes = ['*.bak']
+    scopes = {'en-us/sles/15': None}
+    manifests, transfer, delete = pub.changes('internal', backup, scopes)
+    assert transfer == ['en-us/sles/15/index.html']
+    assert 'en-us/sles/15/index.html.bak' not in manifests['en-us/sles/15']
+    pub.commit('internal', manifests)
+
+    # the page moves to the navigation scope, which is not published now
+    manifests, transfer, delete = pub.changes('internal', backup, {
+        'en-us/sles/15': ['en-us/sles/15/index.html.bak']})
+    assert transfer == ['en-us/sles/15/index.html']
+    assert delete == []
+
+
+def test_generations(tmp_path, monkeypatch):
+    monkeypatch.setattr(publisher, 'CACHE_DIR', str(tmp_path / 'cache'))
+    backup = str(tmp_path / 'backup')
+    docset = 'en-us/sles/15'
+    pub = Publisher('test', 3600)
+
+    def publish():
+        manifests, transfer, delete = pub.changes(
+            'internal', backup, {docset: docset_paths(backup, docset)})
+        pub.commit('internal', manifests, len(transfer), len(delete))
+        return transfer, delete
+
+    first = new_generation(backup, docset)
+    write(os.path.join(generation_path(backup, docset, first), 'html', 'index.html'), 'one')
+    activate(backup, docset, first)
+    transfer, delete = publish()
+    assert transfer == ['.docserv-generations/en-us/sles/15/%s/html/index.html' % first, docset]
+    assert delete == []
+
+    second = new_generation(backup, docset)
+    write(os.path.join(generation_path(backup, docset, second), 'html', 'index.html'), 'two')
+    activate(backup, docset, second)
+    collect_garbage(backup, docset, 1).join()
+    transfer, delete = publish()
+    # the old generation is deleted and not transferred again
+    assert transfer == ['.docserv-generations/en-us/sles/15/%s/html/index.html' % second, docset]
+    assert delete == ['.docserv-generations/en-us/sles/15/%s/html/index.html' % first]
+    assert publish() == ([], [])
+
+
+class FakeBIH:
+    def __init__(self, backup, product, docset, lang):
+        self.config = {'targets': {'internal': {'backup_path': backup,
+                                                'enable_target_sync': 'no'}}}
+        self.product = product
+        self.docset = docset
+        self.docset_relative_path = os.path.join(lang, product, docset)
+        self.build_instruction = {'id': '%s-%s-%s' % (product, docset, lang),
+                                  'target': 'internal',
+                                  'publish_status': 'awaiting publish'}
+        self.navigation_runs = 0
+
+    def navigation_command(self, output_dir):
+        self.navigation_runs += 1
+        return {'cmd': "sh -c 'echo %s > %s/index.html'" % (self.product, output_dir),
+                'step': 'build_navigation', 'output_dir': output_dir,
+                'post_cmd_hook': 'record_navigation'}
+
+    def transfer_command(self, source_dir, destination, step, move=False):
+        return {'action': 'transfer', 'args': [source_dir + '/', destination, None, move],
+                'step': step}
+
+
+def test_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(publisher, 'CACHE_DIR', str(tmp_path / 'cache'))
+    backup = str(tmp_path / 'backup')
+    published = []
+    pub = Publisher('test', 3600, batch_window=60, batch_size=3)
+    pub.on_published = published.append
+    bihs = [FakeBIH(backup, 'sles', '15', lang) for lang in ('en-us', 'de-de')]
+    for bih in bihs:
+        pub.enqueue(bih)
+    assert published == []
+    assert pub.dict()['awaiting_publish'] == 2
+
+    pub.flush()
+    assert published == ['sles-15-en-us', 'sles-15-de-de']
+    assert [bih.build_instruction['publish_status'] for bih in bihs] == ['published'] * 2
+    # one navigation build for both languages of the docset
+    assert bihs[0].navigation_runs + bihs[1].navigation_runs == 1
+    assert os.path.isfile(os.path.join(backup, 'index.html'))
+    assert pub.dict()['batches'] == 1
@@ -0,0 +1,41 @@
+import stat
+
+import pytest
+from docserv.runner import ContainerImage
+
+# Stand-in for the container engine: images are files in $STATE/images.
+ENGINE = """#!/bin/sh
+state=%s
+case "$1" in
+  pull) cp "$state/remote" "$state/images/$2" ;;
+  image) cat "$state/images/$5" 2>/dev/null || exit 1 ;;
+esac
+"""
+
+
+@pytest.fixture
+def engine(tmp_path):
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'remote').write_text('sha256:1\n')
+    script = tmp_path / 'engine'
+    script.write_text(ENGINE % tmp_path)
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return tmp_path
+
+
+def test_pinned_image_is_pulled_once(engine):
+    image = ContainerImage(str(engine / 'engine'), 'daps')
+    assert image.pinned_image() == 'sha256:1'
+    (engine / 'remote').write_text('sha256:2\n')
+    assert image.pinned_image() == 'sha256:1'
+    assert image.update_image() == {'image': 'sha256:2', 'previous': 'sha256:1', 'changed': True}
+    assert image.pinned_image() == 'sha256:2'
+    assert image.dict()['updates'] == 2
+
+
+def test_failed_pull_keeps_the_image(engine):
+    image = ContainerImage(str(engine / 'engine'), 'daps')
+    assert image.pinned_image() == 'sha256:1'
+    (engine / 'engine').write_text("#!/bin/sh\nexit 1\n")
+    assert image.update_image() == {'image': 'sha256:1', 'previous': 'sha256:1', 'changed': False}
+    assert image.pinned_image() == 'sha256:1'
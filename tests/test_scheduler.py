@@ -0,0 +1,22 @@
+from docserv.scheduler import FairScheduler, valid_priority
+
+
+def make_scheduler():
+    return FairScheduler({'server': {}})
+
+
+def test_valid_priority():
+    assert valid_priority(0)
+    assert valid_priority(-20)
+    assert not valid_priority(1024)
+    assert not valid_priority(True)
+    assert not valid_priority('1')
+
+
+def test_weight_is_bounded():
+    scheduler = make_scheduler()
+    build_instruction = {'target': 'internal', 'product': 'sles', 'lang': 'en-us'}
+    for priority in (1024, -100000):
+        build_instruction['priority'] = priority
+        weight = scheduler.weight(build_instruction)
+        assert 0 < weight < float('inf')
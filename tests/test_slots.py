@@ -0,0 +1,46 @@
+from docserv.slots import Slots
+
+
+def make_slots(**settings):
+    server = {'max_threads': 4, 'git_slots': 0, 'build_slots': 0,
+              'publish_slots': 0, 'cpu_budget': 0, 'build_cpus': 0}
+    server.update(settings)
+    return Slots({'server': server})
+
+
+def test_kinds_are_independent():
+    slots = make_slots(build_slots=1, git_slots=1, publish_slots=1, cpu_budget=4)
+    assert slots.workers() == 3
+    assert slots.acquire('build') == 0
+    assert not slots.available('build')
+    assert slots.available('git')
+    assert slots.available('publish')
+    slots.release('build', 0)
+    assert slots.available('build')
+
+
+def test_cpu_budget():
+    slots = make_slots(build_slots=4, cpu_budget=4, build_cpus=2)
+    assert slots.builds() == 2
+    assert [slots.acquire('build'), slots.acquire('build')] == [0, 1]
+    assert not slots.available('build')
+    slots.release('build', 0)
+    assert slots.acquire('build') == 0
+
+
+def test_build_larger_than_budget():
+    slots = make_slots(build_slots=2, cpu_budget=2, build_cpus=4)
+    assert slots.available('build')
+    slots.acquire('build')
+    assert not slots.available('build')
+
+
+def test_statistics():
+    slots = make_slots(build_slots=2, cpu_budget=4)
+    slots.acquire('git')
+    slots.release('build', slots.acquire('build'), build_time=0.5)
+    statistics = slots.dict()
+    assert statistics['git']['used'] == 1
+    assert statistics['build']['slots'] == 2
+    # only the time of the container build counts
+    assert statistics['utilization_per_build_slot'] == 0.5 / 2
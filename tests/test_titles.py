@@ -0,0 +1,31 @@
+from docserv.titles import extract_titles
+
+BIGFILE = """<?xml version="1.0"?>
+<!DOCTYPE set [ <!ENTITY product "SUSE &amp; Friends"> ]>
+<set xmlns="http://docbook.org/ns/docbook" xml:id="set">
+ <info><title>All of &product; <phrase>Docs</phrase></title></info>
+ <book xml:id="book-1">
+  <title>Book &lt;1&gt;</title>
+  <chapter xml:id="chapter"><title>Chapter</title></chapter>
+ </book>
+ <book id="book-2"><bookinfo><title>Book 2</title></bookinfo></book>
+</set>
+"""
+
+
+def test_extract_titles(tmp_path):
+    bigfile = tmp_path / 'set_bigfile.xml'
+    bigfile.write_text(BIGFILE)
+    assert extract_titles(str(bigfile), [None, 'set', 'book-1', 'book-2', 'chapter']) == {
+        None: 'All of SUSE & Friends Docs',
+        'set': 'All of SUSE & Friends Docs',
+        'book-1': 'Book <1>',
+        'book-2': 'Book 2',
+        'chapter': 'Chapter',
+    }
+
+
+def test_missing_titles_are_left_out(tmp_path):
+    bigfile = tmp_path / 'set_bigfile.xml'
+    bigfile.write_text(BIGFILE)
+    assert extract_titles(str(bigfile), ['book-2', 'missing']) == {'book-2': 'Book 2'}
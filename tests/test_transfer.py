@@ -0,0 +1,56 @@
+import os
+
+from docserv.transfer import TransferStats, is_local, transfer
+
+
+def make_tree(path):
+    os.makedirs(os.path.join(path, 'html', 'images'))
+    with open(os.path.join(path, 'html', 'index.html'), 'w') as f:
+        f.write('<html/>')
+    with open(os.path.join(path, 'html', 'images', 'logo.png'), 'wb') as f:
+        f.write(b'\0' * 100)
+    os.symlink('index.html', os.path.join(path, 'html', 'start.html'))
+
+
+def test_link_contents(tmp_path):
+    source = str(tmp_path / 'out')
+    make_tree(source)
+    destination = str(tmp_path / 'backup')
+    stats = transfer(source + '/', destination)
+    assert os.path.islink(os.path.join(destination, 'html', 'start.html'))
+    logo = os.path.join(destination, 'html', 'images', 'logo.png')
+    assert os.path.samefile(logo, os.path.join(source, 'html', 'images', 'logo.png'))
+    assert stats.dict()['bytes']['linked'] == 107
+    assert stats.bytes_copied() == 0
+
+
+def test_move_replaces_files(tmp_path):
+    source = str(tmp_path / 'out')
+    make_tree(source)
+    destination = str(tmp_path / 'backup')
+    os.makedirs(os.path.join(destination, 'html'))
+    with open(os.path.join(destination, 'html', 'index.html'), 'w') as f:
+        f.write('old')
+    with open(os.path.join(destination, 'other.html'), 'w') as f:
+        f.write('kept')
+    stats = TransferStats()
+    transfer(source + '/', destination, stats, move=True)
+    with open(os.path.join(destination, 'html', 'index.html')) as f:
+        assert f.read() == '<html/>'
+    assert os.path.exists(os.path.join(destination, 'other.html'))
+    assert not os.path.exists(os.path.join(source, 'html', 'index.html'))
+    assert stats.dict()['files']['moved'] == 2
+
+
+def test_single_file(tmp_path):
+    source = str(tmp_path / 'book.pdf')
+    with open(source, 'w') as f:
+        f.write('%PDF')
+    transfer(source, str(tmp_path / 'pdf'))
+    assert os.path.isfile(str(tmp_path / 'pdf' / 'book.pdf'))
+
+
+def test_is_local():
+    assert is_local('/mnt/builds/')
+    assert not is_local('ssh://user@server:/srv/www')
+    assert not is_local('server:/srv/www')